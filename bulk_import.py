@@ -0,0 +1,184 @@
+import io
+import os
+import csv
+import sys
+import json
+import time
+from datetime import datetime
+from itertools import islice
+from sms_client import validate_phones
+from sms_admission import REASON_AGE, REASON_DEPTH, REASON_QUOTA
+from sms_schedule import parse_send_at
+
+
+def iter_rows(stream, fmt='csv'):
+    """Đọc từng dòng (phone, message, idempotency_key) từ CSV hoặc JSONL, không nạp cả file vào bộ nhớ
+
+    Cột/trường idempotency_key là tùy chọn. Dòng không đọc được trả về (None, None, None)
+    để được tính là bị từ chối.
+    """
+    if fmt == 'jsonl':
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                values = data.get('phone'), data.get('message'), data.get('idempotency_key')
+            except (ValueError, AttributeError):
+                yield None, None, None
+                continue
+            # {"phone": 84912345678} vẫn nhận; object/list là dòng không hợp lệ
+            if not all(value is None or isinstance(value, (str, int, float)) for value in values):
+                yield None, None, None
+            else:
+                yield tuple(None if value is None else str(value) for value in values)
+        return
+
+    reader = csv.reader(stream)
+    first = next(reader, None)
+    if first is None:
+        return
+    # Có header thì lấy theo tên cột, không thì cột 1 là số điện thoại, cột 2 là tin nhắn
+    header = [column.strip().lower() for column in first]
+    key_col = None
+    if 'phone' in header and 'message' in header:
+        phone_col, message_col = header.index('phone'), header.index('message')
+        if 'idempotency_key' in header:
+            key_col = header.index('idempotency_key')
+    else:
+        phone_col, message_col = 0, 1
+        reader = _prepend(first, reader)
+
+    width = max(phone_col, message_col)
+    for row in reader:
+        if not row:
+            continue
+        if len(row) <= width:
+            yield None, None, None
+        else:
+            key = row[key_col] if key_col is not None and key_col < len(row) else None
+            yield row[phone_col], row[message_col], key or None
+
+
+def _prepend(first, rows):
+    yield first
+    yield from rows
+
+
+class BulkImporter:
+    """Nhập hàng loạt tin nhắn vào queue theo lô lớn
+
+    wait=True: khi admission control từ chối, chờ retry_after rồi thêm tiếp phần còn lại
+    (nhập theo tốc độ gửi của modem); wait=False: phần bị từ chối được đếm vào over_limit.
+    send_at/throttle: cả đợt được hẹn giờ và nhả dần theo throttle thay vì vào queue ngay
+    (send_at không hợp lệ: ValueError). Lô ghi lỗi được đếm vào failed.
+    """
+    def __init__(self, handler, batch_size=20000, producer=None, wait=False, send_at=None, throttle=None):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.producer = producer
+        self.wait = wait
+        # '+30m' tính một lần cho cả đợt, không theo từng lô
+        self.send_at = parse_send_at(send_at)
+        self.throttle = throttle
+        self.stats = {'read': 0, 'accepted': 0, 'duplicate': 0, 'invalid_phone': 0, 'empty_message': 0,
+                      'parse_error': 0, 'over_limit': 0, 'failed': 0}
+
+    def import_stream(self, stream, fmt='csv', progress=None):
+        """Nhập toàn bộ stream, trả về thống kê"""
+        start = time.perf_counter()
+        rows = iter_rows(stream, fmt)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            self._import_batch(batch)
+            if progress:
+                progress(self.stats)
+
+        elapsed = time.perf_counter() - start
+        self.stats['elapsed'] = elapsed
+        self.stats['rows_per_second'] = self.stats['read'] / elapsed if elapsed else 0.0
+        return self.stats
+
+    def _import_batch(self, batch):
+        self.stats['read'] += len(batch)
+        valid = validate_phones([phone or '' for phone, _, _ in batch])
+
+        accepted = []
+        for (phone, message, key), phone_ok in zip(batch, valid):
+            if phone is None and message is None:
+                self.stats['parse_error'] += 1
+            elif not phone_ok:
+                self.stats['invalid_phone'] += 1
+            elif not message or not message.strip():
+                self.stats['empty_message'] += 1
+            else:
+                accepted.append((phone.strip(), message.strip(), key))
+
+        while accepted:
+            result = self.handler.add_many_to_queue(accepted, self.producer, self.send_at, self.throttle)
+            self.stats['duplicate'] += result.duplicates
+            if result.error:
+                self.stats['failed'] += len(accepted) - result.duplicates
+                self.stats['error'] = result.error
+                break
+            self.stats['accepted'] += result.queued
+            if result.send_at is not None:
+                self.stats['send_at'] = result.send_at
+            accepted = result.rejected
+            if accepted:
+                if not self.wait:
+                    self.stats['over_limit'] += len(accepted)
+                    self.stats['over_limit_reason'] = result.rejection.error
+                    break
+                time.sleep(result.rejection.retry_after)
+
+
+def run_bulk_import(handler, source, fmt=None, batch_size=20000, producer=None, wait=False, send_at=None,
+                    throttle=None):
+    """Chạy nhập hàng loạt từ file (hoặc '-' cho stdin) và in thống kê"""
+    if fmt is None:
+        fmt = 'jsonl' if source.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+    try:
+        importer = BulkImporter(handler, batch_size, producer, wait, send_at, throttle)
+    except ValueError as e:
+        print(f"❌ Thời điểm gửi không hợp lệ: {e}")
+        return None
+
+    if source == '-':
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+    else:
+        stream = open(source, 'r', encoding='utf-8', newline='')
+
+    def progress(stats):
+        print(f"\r📥 Đã đọc {stats['read']:,} dòng, nhận {stats['accepted']:,}", end='', file=sys.stderr)
+
+    try:
+        stats = importer.import_stream(stream, fmt, progress)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    print(file=sys.stderr)
+
+    rejected = stats['read'] - stats['accepted'] - stats['duplicate'] - stats['over_limit'] - stats['failed']
+    print(f"✅ Đã thêm {stats['accepted']:,}/{stats['read']:,} tin nhắn vào queue "
+          f"trong {stats['elapsed']:.2f}s ({stats['rows_per_second']:,.0f} dòng/giây)")
+    if 'send_at' in stats:
+        when = datetime.fromtimestamp(stats['send_at']).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"⏰ Hẹn giờ gửi từ {when}" + (f", nhả theo throttle '{throttle}'" if throttle else ''))
+    if stats['duplicate']:
+        print(f"⚠️ Bỏ qua {stats['duplicate']:,} tin nhắn trùng")
+    if stats['over_limit']:
+        reasons = {REASON_DEPTH: 'queue vượt SMS_MAX_QUEUE_DEPTH', REASON_AGE: 'thời gian chờ vượt SMS_MAX_QUEUE_AGE',
+                   REASON_QUOTA: 'producer hết SMS_PRODUCER_QUOTA'}
+        reason = reasons.get(stats.get('over_limit_reason'), stats.get('over_limit_reason'))
+        print(f"⏳ Admission control từ chối ({reason}): {stats['over_limit']:,} tin nhắn chưa được thêm "
+              f"(dùng --wait để chờ)")
+    if stats['failed']:
+        print(f"❌ Lỗi ghi queue ({stats['error']}): {stats['failed']:,} tin nhắn chưa được thêm")
+    if rejected:
+        print(f"❌ Từ chối {rejected:,} dòng: số không hợp lệ {stats['invalid_phone']:,}, "
+              f"tin nhắn trống {stats['empty_message']:,}, lỗi định dạng {stats['parse_error']:,}")
+    return stats
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+
+MAX_SINGLE_LENGTH = 70
+MAX_PART_LENGTH = 67
+
+
+class LRUCache:
+    """Cache LRU có giới hạn kích thước, an toàn với thread, kèm thống kê"""
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Lấy giá trị theo key, đánh dấu là vừa được dùng"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Thêm giá trị, loại bỏ phần tử cũ nhất nếu vượt giới hạn"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Thống kê hit/miss/eviction"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+class PDUEncoder:
+    """Mã hóa SMS-SUBMIT PDU (UCS2) với cache cho nội dung và số điện thoại"""
+    def __init__(self, segment_cache_size=256, number_cache_size=1024):
+        # (text, encoding) -> tuple các segment user data đã dựng sẵn
+        self.segment_cache = LRUCache(segment_cache_size)
+        # số gốc -> số đã chuẩn hóa và đảo semi-octet
+        self.number_cache = LRUCache(number_cache_size)
+
+    def encode_number(self, phone_number):
+        """Chuẩn hóa số điện thoại và đảo semi-octet"""
+        swapped_number = self.number_cache.get(phone_number)
+        if swapped_number is None:
+            number = phone_number.lstrip("+").replace(" ", "")
+            if len(number) % 2 != 0:
+                number += 'F'
+            swapped_number = ''.join([number[i+1] + number[i] for i in range(0, len(number), 2)])
+            self.number_cache.put(phone_number, swapped_number)
+        return swapped_number
+
+    def user_data_segments(self, message, encoding='ucs2'):
+        """Trả về các segment (udh_tail, ucs2_hex, user_data_length) của tin nhắn"""
+        key = (message, encoding)
+        segments = self.segment_cache.get(key)
+        if segments is None:
+            segments = self._build_segments(message, encoding)
+            self.segment_cache.put(key, segments)
+        return segments
+
+    def _build_segments(self, message, encoding):
+        if encoding != 'ucs2':
+            raise ValueError(f"Encoding không được hỗ trợ: {encoding}")
+
+        if len(message) <= MAX_SINGLE_LENGTH:
+            # Tin nhắn đơn: không có UDH
+            ucs2_msg = message.encode('utf-16-be').hex().upper()
+            return (('', ucs2_msg, len(ucs2_msg) // 2),)
+
+        total_parts = (len(message) + MAX_PART_LENGTH - 1) // MAX_PART_LENGTH
+        segments = []
+        for part_num in range(1, total_parts + 1):
+            start = (part_num - 1) * MAX_PART_LENGTH
+            part = message[start:start + MAX_PART_LENGTH]
+            ucs2_part = part.encode('utf-16-be').hex().upper()
+            # UDH: 05 00 03 <ref> <total> <part> - ref thay đổi theo mỗi lần gửi
+            udh_tail = f"{total_parts:02X}{part_num:02X}"
+            segments.append((udh_tail, ucs2_part, 6 + len(ucs2_part) // 2))
+        return tuple(segments)
+
+    def build_pdus(self, phone_number, message, ref_number=0):
+        """Dựng danh sách (pdu, độ_dài_cho_CMGS) cho tin nhắn"""
+        swapped_number = self.encode_number(phone_number)
+        segments = self.user_data_segments(message)
+
+        pdus = []
+        for udh_tail, ucs2_hex, user_data_length in segments:
+            if udh_tail:
+                pdu = (f"0051000C91{swapped_number}0008AA{user_data_length:02X}"
+                       f"050003{ref_number:02X}{udh_tail}{ucs2_hex}")
+            else:
+                pdu = f"0011000C91{swapped_number}0008AA{user_data_length:02X}{ucs2_hex}"
+            pdus.append((pdu, (len(pdu) // 2) - 1))
+        return pdus
+
+    def stats(self):
+        return {
+            'segments': self.segment_cache.stats(),
+            'numbers': self.number_cache.stats()
+        }
+
+
+# Hàm utility để benchmark
+def benchmark(iterations=50000, templates=20, recipients=500):
+    """So sánh tốc độ dựng PDU có và không có cache"""
+    print("=== BENCHMARK PDU ENCODER ===\n")
+
+    messages = [f"Mã OTP của bạn là {i:06d}. Không chia sẻ mã này với bất kỳ ai. " * (1 + i % 3)
+                for i in range(templates)]
+    phones = [f"+8490{i:07d}" for i in range(recipients)]
+
+    results = {}
+    for label, encoder in (('Không cache', PDUEncoder(0, 0)), ('Có cache', PDUEncoder())):
+        start = time.perf_counter()
+        for i in range(iterations):
+            encoder.build_pdus(phones[i % recipients], messages[i % templates], i & 0xFF)
+        elapsed = time.perf_counter() - start
+        results[label] = elapsed
+        print(f"{label}: {iterations / elapsed:,.0f} tin/giây ({elapsed * 1e6 / iterations:.1f} µs/tin)")
+        print(f"   {encoder.stats()}")
+
+    print(f"\nTăng tốc: x{results['Không cache'] / results['Có cache']:.1f}")
+
+
+if __name__ == '__main__':
+    benchmark()
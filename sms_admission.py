@@ -0,0 +1,216 @@
+import os
+import json
+import math
+import time
+import threading
+from sms_queue import ShardedFileQueue, file_lock
+from sms_records import EnqueueResult
+from sms_logging import fields, get_logger
+
+log = get_logger('admission')
+
+# Giới hạn mặc định (0: không giới hạn). Mặc định tắt: nhập hàng loạt không bị chặn bất ngờ,
+# bật bằng env khi cần (ví dụ SMS_MAX_QUEUE_DEPTH=10000, SMS_MAX_QUEUE_AGE=3600)
+MAX_QUEUE_DEPTH = int(os.environ.get('SMS_MAX_QUEUE_DEPTH', '0'))
+# Thời gian chờ dự kiến tối đa của tin nhắn mới (độ sâu queue / tốc độ gửi), giây
+MAX_QUEUE_AGE = float(os.environ.get('SMS_MAX_QUEUE_AGE', '0'))
+# Quota mỗi producer trong QUOTA_WINDOW giây: "200" hoặc "otp=0,marketing=1000,*=200"
+PRODUCER_QUOTA = os.environ.get('SMS_PRODUCER_QUOTA', '0')
+QUOTA_WINDOW = int(os.environ.get('SMS_QUOTA_WINDOW', '3600'))
+
+# Tốc độ gửi giả định của một modem khi chưa có số đo (~15 tin/phút)
+DEFAULT_DRAIN_RATE = 15 / 60
+# Số đo cũ hơn: sender không chạy, dùng DEFAULT_DRAIN_RATE
+DRAIN_STALE = 600
+
+REASON_DEPTH = 'queue_full'
+REASON_AGE = 'queue_too_slow'
+REASON_QUOTA = 'quota_exceeded'
+
+
+def quota_path(queue_file, queue_dir=None):
+    return os.path.join(queue_dir, 'quota') if queue_dir else queue_file + '.quota'
+
+
+def parse_quotas(spec):
+    """'200' hoặc 'otp=0,marketing=1000,*=200' -> (quota mặc định, {producer: quota})"""
+    default, quotas = 0, {}
+    for item in str(spec).split(','):
+        name, sep, value = item.strip().rpartition('=')
+        if not value:
+            continue
+        if not sep or name == '*':
+            default = int(value)
+        else:
+            quotas[name] = int(value)
+    return default, quotas
+
+
+def read_drain_rate(path, now=None):
+    """Tốc độ gửi (tin nhắn/giây) sender đã ghi cho một shard, None nếu chưa có hoặc đã cũ"""
+    try:
+        with open(path) as f:
+            rate, updated = map(float, f.read().split())
+    except (OSError, ValueError):
+        return None
+    if (now or time.time()) - updated > DRAIN_STALE:
+        return None
+    return rate
+
+
+class DrainMeter:
+    """Ước lượng tốc độ gửi của một modem từ thời gian xử lý mỗi tin nhắn, ghi ra file của shard
+
+    Thời gian tính cả chờ pacer và các lần gửi lỗi trước đó nên là năng lực gửi thực tế
+    khi queue có việc; producer ở process khác đọc qua read_drain_rate.
+    """
+    def __init__(self, path, alpha=0.2, publish_interval=5):
+        self.path = path
+        self.alpha = alpha
+        self.publish_interval = publish_interval
+        self.service_time = None    # EWMA số giây cho một tin nhắn
+        self._carry = 0.0           # thời gian của các lần gửi lỗi, cộng vào tin nhắn thành công tiếp theo
+        self._published = 0.0
+
+    @property
+    def rate(self):
+        return 1.0 / self.service_time if self.service_time else None
+
+    def record(self, elapsed, ok=True):
+        if not ok:
+            self._carry += elapsed
+            return
+        elapsed += self._carry
+        self._carry = 0.0
+        if self.service_time is None:
+            self.service_time = elapsed
+        else:
+            self.service_time += self.alpha * (elapsed - self.service_time)
+        self.publish()
+
+    def publish(self, force=False):
+        """Ghi tốc độ hiện tại (cũng là heartbeat khi queue rỗng)"""
+        now = time.time()
+        if self.rate is None or (not force and now - self._published < self.publish_interval):
+            return
+        self._published = now
+        try:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(f"{self.rate:.6f} {now:.0f}\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.debug("Không ghi được tốc độ gửi: %s", e, extra=fields(path=self.path))
+
+
+class AdmissionController:
+    """Nhận hay từ chối tin nhắn mới theo độ sâu queue, thời gian chờ dự kiến và quota producer
+
+    Thời gian chờ dự kiến = độ sâu / tổng tốc độ gửi các shard (DrainMeter của sender).
+    Tin nhắn bị từ chối nhận EnqueueResult 'rejected' kèm retry_after (giây).
+    Producer chỉ ghi vào một shard vẫn thấy mọi shard đang có trên đĩa.
+    queue: queue dùng để đếm (LeasedQueue của cluster), None: file queue của queue_file/queue_dir.
+    """
+    def __init__(self, queue_file='/tmp/sms_queue.txt', queue_dir=None, max_depth=MAX_QUEUE_DEPTH,
+                 max_age=MAX_QUEUE_AGE, quotas=PRODUCER_QUOTA, quota_window=QUOTA_WINDOW, refresh=1.0, queue=None):
+        self.queue_file = queue_file
+        self.queue_dir = queue_dir
+        self.queue = queue
+        self.quota_path = quota_path(queue_file, queue_dir)
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.default_quota, self.quotas = parse_quotas(quotas) if isinstance(quotas, (str, int)) else (0, quotas)
+        self.quota_window = quota_window
+        # Đếm dòng queue phải đọc file: dùng lại độ sâu và tốc độ gửi trong refresh giây
+        self.refresh = refresh
+        self._depth = None
+        self._rate = None
+        self._refreshed = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'admitted': 0, 'rejected': 0, REASON_DEPTH: 0, REASON_AGE: 0, REASON_QUOTA: 0}
+
+    @property
+    def enabled(self):
+        return bool(self.max_depth or self.max_age or self.default_quota or self.quotas)
+
+    def _refresh(self):
+        now = time.time()
+        if self._depth is None or now - self._refreshed >= self.refresh:
+            file_queue = self.queue or ShardedFileQueue(self.queue_file, None, queue_dir=self.queue_dir)
+            self._depth = file_queue.count()
+            rates = (read_drain_rate(path, now) for path in file_queue.drain_paths())
+            # Cluster chưa có gateway nào ghi tốc độ: coi như một modem
+            self._rate = sum(DEFAULT_DRAIN_RATE if rate is None else rate for rate in rates) or DEFAULT_DRAIN_RATE
+            self._refreshed = now
+
+    def depth(self):
+        """Số tin nhắn đang chờ trên mọi shard"""
+        self._refresh()
+        return self._depth
+
+    def drain_rate(self):
+        """Tổng tốc độ gửi (tin nhắn/giây) của các shard"""
+        self._refresh()
+        return self._rate
+
+    def admit(self, count=1, producer=None, phone=None):
+        """Số tin nhắn được nhận (<= count) và EnqueueResult rejected cho phần còn lại (None nếu nhận hết)"""
+        if not self.enabled or count <= 0:
+            return count, None
+        with self.lock:
+            depth = self.depth()
+            rate = self.drain_rate()
+            allowed, reason, retry_after = count, None, None
+            if self.max_depth and depth + count > self.max_depth:
+                allowed, reason = max(0, self.max_depth - depth), REASON_DEPTH
+                retry_after = (depth + 1 - self.max_depth) / rate
+            if self.max_age and (depth + count) / rate > self.max_age:
+                room = max(0, math.floor(self.max_age * rate) - depth)
+                if room < allowed:
+                    allowed, reason = room, REASON_AGE
+                    retry_after = max(retry_after or 0, (depth + 1) / rate - self.max_age)
+            if allowed:
+                granted, quota_retry = self._take_quota(producer or 'default', allowed)
+                if granted < allowed:
+                    allowed, reason, retry_after = granted, REASON_QUOTA, max(retry_after or 0, quota_retry)
+            self._depth = depth + allowed
+
+        self.stats['admitted'] += allowed
+        if allowed == count:
+            return allowed, None
+        self.stats['rejected'] += count - allowed
+        self.stats[reason] += count - allowed
+        log.warning("Từ chối tin nhắn", extra=fields(
+            producer=producer, reason=reason, rejected=count - allowed, depth=depth,
+            drain_per_minute=round(rate * 60, 1), retry_after=round(retry_after, 1)))
+        return allowed, EnqueueResult(EnqueueResult.REJECTED, phone, reason, max(1.0, retry_after))
+
+    def _take_quota(self, producer, count):
+        """Trừ quota trong cửa sổ hiện tại, trả về (số được nhận, giây tới cửa sổ mới)"""
+        limit = self.quotas.get(producer, self.default_quota)
+        if not limit or not self.quota_path:
+            return count, None
+        now = time.time()
+        window_start = now - now % self.quota_window
+        with file_lock(self.quota_path):
+            try:
+                with open(self.quota_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            # Chỉ giữ các producer trong cửa sổ hiện tại
+            state = {name: used for name, (start, used) in state.items() if start == window_start}
+            granted = max(0, min(count, limit - state.get(producer, 0)))
+            state[producer] = state.get(producer, 0) + granted
+            tmp_path = self.quota_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({name: [window_start, used] for name, used in state.items()}, f)
+            os.replace(tmp_path, self.quota_path)
+        return granted, window_start + self.quota_window - now
+
+    def status(self):
+        """Độ sâu, tốc độ gửi và thời gian chờ dự kiến hiện tại"""
+        depth = self.depth()
+        rate = self.drain_rate()
+        return {'depth': depth, 'drain_per_minute': round(rate * 60, 1), 'estimated_wait_s': round(depth / rate),
+                'max_depth': self.max_depth, 'max_age': self.max_age}
@@ -0,0 +1,185 @@
+import time
+import queue
+import threading
+from sms_logging import fields, get_logger
+
+log = get_logger('arbiter')
+
+# Kết quả cuối của một lệnh AT
+FINAL_ERRORS = ('ERROR', '+CMS ERROR', '+CME ERROR')
+# URC, trừ khi là dòng trả lời có tiền tố của lệnh đang chờ (+CREG: của AT+CREG?)
+URC_PREFIXES = ('+CMT:', '+CDS:', '+CMTI:', '+CDSI:', 'RING', '+CREG:', '+CEREG:')
+PROMPT_TIMEOUT = 5
+COMMAND_TIMEOUT = 2
+
+
+class ATCommand:
+    """Một giao dịch AT: lệnh, dữ liệu gửi sau dấu nhắc '>' (PDU), các dòng trả lời và kết quả cuối"""
+    def __init__(self, command, prefixes=(), data=None, timeout=COMMAND_TIMEOUT, prompt_timeout=PROMPT_TIMEOUT):
+        self.command = command
+        self.prefixes = tuple(prefixes)     # dòng trả lời có tiền tố (+CSQ:, +CMGS:...) thuộc lệnh này
+        self.data = data
+        self.timeout = timeout
+        self.prompt_timeout = prompt_timeout
+        self.lines = []
+        self.result = None                  # 'OK', 'ERROR', '+CMS ERROR: <n>'...
+        self.error = None                   # 'timeout', 'no_prompt', 'disconnected'... khi không có kết quả
+        self.submitted_at = time.time()
+        self.written_at = None
+        self.data_written_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def ok(self):
+        return self.result == 'OK'
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self
+
+    def _finish(self, result=None, error=None):
+        if self.done.is_set():
+            return
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+
+
+class CommandArbiter:
+    """Chủ duy nhất ghi lên cổng serial sau khi kết nối: hàng đợi giao dịch AT, mỗi lúc một lệnh
+
+    Luồng gửi và lấy mẫu health chỉ submit/execute rồi chờ kết quả. Vòng đọc chuyển mọi dòng
+    cho feed_line: dòng thuộc lệnh đang chờ được gom vào giao dịch, còn lại (+CMT, +CDS,
+    +CREG...) trả về False để handler đưa vào luồng nhận, nên việc nhận không dừng khi đang gửi.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+        self.commands = queue.Queue()
+        self.current = None
+        self.lock = threading.Lock()
+        # Dấu nhắc '>' hoặc lệnh kết thúc sớm (ví dụ +CMS ERROR trước dấu nhắc)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'commands': 0, 'timeouts': 0, 'errors': 0, 'urcs': 0}
+
+    def start(self):
+        with self.lock:
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.abort('stopped')
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+        # Lệnh chưa kịp gửi
+        while True:
+            try:
+                self.commands.get_nowait()._finish(error='stopped')
+            except queue.Empty:
+                return
+
+    def submit(self, command, prefixes=(), data=None, timeout=COMMAND_TIMEOUT, prompt_timeout=PROMPT_TIMEOUT):
+        """Đưa lệnh vào hàng đợi, trả về ATCommand để chờ kết quả"""
+        at_command = ATCommand(command, prefixes, data, timeout, prompt_timeout)
+        self.start()
+        self.commands.put(at_command)
+        return at_command
+
+    def execute(self, command, prefixes=(), data=None, timeout=COMMAND_TIMEOUT, prompt_timeout=PROMPT_TIMEOUT):
+        """submit rồi chờ tới khi có kết quả (timeout do luồng điều phối đảm bảo)"""
+        return self.submit(command, prefixes, data, timeout, prompt_timeout).wait()
+
+    def abort(self, reason='disconnected'):
+        """Kết thúc lệnh đang chờ (mất kết nối) để người gọi không phải chờ hết timeout"""
+        with self.lock:
+            if self.current is not None:
+                self.current._finish(error=reason)
+        self._wakeup.set()
+
+    def feed_line(self, line):
+        """Gom dòng vào lệnh đang chờ, trả về False nếu dòng là URC/không thuộc lệnh nào"""
+        with self.lock:
+            at_command = self.current
+            if at_command is not None and not at_command.done.is_set():
+                # +CREG: trả lời AT+CREG? thuộc lệnh, ngoài lúc đó là URC
+                if at_command.prefixes and line.startswith(at_command.prefixes):
+                    at_command.lines.append(line)
+                    return True
+                if not line.startswith(URC_PREFIXES):
+                    if line == at_command.command:
+                        return True     # echo (ATE0 chưa có hiệu lực)
+                    if line == 'OK' or line.startswith(FINAL_ERRORS):
+                        at_command._finish(line)
+                        self._wakeup.set()
+                        return True
+                    if not at_command.prefixes and not line.startswith('+'):
+                        at_command.lines.append(line)
+                        return True
+        if line.startswith(URC_PREFIXES):
+            self.stats['urcs'] += 1
+        return False
+
+    def feed_prompt(self):
+        """Dấu nhắc '>' của AT+CMGS"""
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                at_command = self.commands.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if not self.handler.connected.wait(at_command.timeout):
+                at_command._finish(error='disconnected')
+                continue
+            self._dispatch(at_command)
+
+    def _write(self, data):
+        with self.handler.ser_lock:
+            self.handler.ser.write(data)
+
+    def _dispatch(self, at_command):
+        self._wakeup.clear()
+        with self.lock:
+            self.current = at_command
+        self.stats['commands'] += 1
+        try:
+            # Thời điểm ghi đặt trước khi ghi: trả lời có thể đến (vòng đọc xử lý) trước khi write() trả về
+            at_command.written_at = time.time()
+            self._write(f'{at_command.command}\r'.encode())
+            if at_command.data is not None:
+                self._wakeup.wait(at_command.prompt_timeout)
+                if at_command.done.is_set():
+                    return
+                if not self._wakeup.is_set():
+                    # Hủy lệnh đang chờ dữ liệu để modem không nuốt lệnh tiếp theo
+                    self._write(b'\x1b')
+                    at_command._finish(error='no_prompt')
+                    return
+                at_command.data_written_at = time.time()
+                self._write(at_command.data)
+            if not at_command.done.wait(at_command.timeout):
+                at_command._finish(error='timeout')
+        except Exception as e:
+            at_command._finish(error=str(e))
+        finally:
+            with self.lock:
+                self.current = None
+            if at_command.error:
+                self.stats['timeouts' if at_command.error in ('timeout', 'no_prompt') else 'errors'] += 1
+                log.debug("Lệnh AT không có kết quả", extra=fields(
+                    modem=self.handler.port, command=at_command.command, error=at_command.error))
+
+    def metrics(self):
+        metrics = dict(self.stats)
+        metrics.update({'modem': self.handler.port, 'pending': self.commands.qsize(),
+                        'current': self.current.command if self.current else None})
+        return metrics
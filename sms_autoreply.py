@@ -0,0 +1,279 @@
+import os
+import re
+import json
+import time
+import threading
+import unicodedata
+from collections import deque
+from sms_logging import fields, get_logger
+
+log = get_logger('autoreply')
+
+# Mỗi người gửi nhận tối đa REPLY_LIMIT tin trả lời trong REPLY_WINDOW giây
+REPLY_LIMIT = int(os.environ.get('SMS_AUTOREPLY_LIMIT', '3'))
+REPLY_WINDOW = float(os.environ.get('SMS_AUTOREPLY_WINDOW', '3600'))
+# Khoảng thời gian tối thiểu giữa hai lần kiểm tra file luật đã đổi chưa
+RELOAD_INTERVAL = 2.0
+
+# Tên group do người viết luật đặt: đổi thành r<i>_<tên> để các luật không trùng tên group
+GROUP_RE = re.compile(r'\(\?P<(\w+)>')
+BACKREF_RE = re.compile(r'\(\?P=(\w+)\)')
+# Tham chiếu group theo số (\1, \g<1>, (?(1)...)) và cờ toàn cục ((?i)) không dùng được trong regex gộp
+STANDALONE_RE = re.compile(r'\\[1-9]|\\g<\d+>|\(\?\(\d+\)|\(\?[aiLmsux]+\)')
+WORD_RE = re.compile(r'\w+')
+
+
+def normalize(text):
+    """Bỏ dấu tiếng Việt và khoảng trắng thừa: 'Hủy  ' -> 'Huy' (so khớp không phân biệt dấu)"""
+    text = unicodedata.normalize('NFD', text.strip()).replace('đ', 'd').replace('Đ', 'D')
+    return ''.join(ch for ch in text if not unicodedata.combining(ch))
+
+
+class ReplyRule:
+    """Một luật: từ khóa đầu tin nhắn (keyword) hoặc regex (pattern, khớp cả tin nhắn) và mẫu trả lời
+
+    So khớp không phân biệt hoa thường và dấu. Mẫu trả lời dùng str.format với group có tên
+    của pattern và {sender}.
+    """
+    __slots__ = ('name', 'pattern', 'reply', 'keywords')
+
+    def __init__(self, name, pattern, reply, keywords=()):
+        self.name = name
+        self.pattern = pattern
+        self.reply = reply
+        self.keywords = tuple(keywords)     # từ khóa một từ (đã bỏ dấu, casefold), tra bằng dict
+
+    @classmethod
+    def from_dict(cls, data, index=0):
+        name = data.get('name') or f'rule{index}'
+        keywords = ()
+        if data.get('pattern'):
+            # So khớp trên nội dung đã bỏ dấu nên pattern cũng bỏ dấu
+            pattern = normalize(data['pattern'])
+        elif data.get('keyword'):
+            keywords = data['keyword'] if isinstance(data['keyword'], list) else [data['keyword']]
+            keywords = [normalize(keyword) for keyword in keywords]
+            # Từ khóa là cả từ đầu tin nhắn: 'STOP', 'STOP ALL' nhưng không 'STOPPED'
+            pattern = '(?:' + '|'.join(re.escape(keyword) for keyword in keywords) + r')\b.*'
+            if not all(WORD_RE.fullmatch(keyword) for keyword in keywords):
+                keywords = ()
+        else:
+            raise ValueError(f"Luật {name}: cần 'keyword' hoặc 'pattern'")
+        if not data.get('reply'):
+            raise ValueError(f"Luật {name}: thiếu 'reply'")
+        re.compile(pattern)
+        return cls(name, pattern, data['reply'], (keyword.casefold() for keyword in keywords))
+
+
+class RuleMatcher:
+    """Khớp mọi luật trong một lượt: dict cho từ khóa một từ, một regex gộp cho phần còn lại
+
+    Regex gộp có dạng (?P<r0>...)|(?P<r1>...), group có tên của luật i đổi thành r<i>_<tên>.
+    Luật tham chiếu group theo số hoặc có cờ toàn cục như (?i) được khớp bằng regex riêng.
+
+    Thứ tự luật trong file là thứ tự ưu tiên. Group ngoài cùng của luật khớp là m.lastindex
+    (group đóng sau cùng), tra ra luật và các group có tên của nó.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.keywords = {}      # từ đầu tin nhắn -> chỉ số luật (luật đầu tiên thắng)
+        self.by_group = {}
+        self.groups = {}        # chỉ số luật -> [(tên group gốc, tên group trong regex gộp)]
+        self.standalone = []    # [(chỉ số luật, regex riêng)] theo thứ tự ưu tiên
+        alternatives = []
+        for i, rule in enumerate(self.rules):
+            if rule.keywords:
+                for keyword in rule.keywords:
+                    self.keywords.setdefault(keyword, i)
+                continue
+            if STANDALONE_RE.search(rule.pattern):
+                self.standalone.append((i, re.compile(rule.pattern, re.IGNORECASE | re.DOTALL)))
+                continue
+            names = GROUP_RE.findall(rule.pattern)
+            pattern = GROUP_RE.sub(lambda m: f'(?P<r{i}_{m.group(1)}>', rule.pattern)
+            pattern = BACKREF_RE.sub(lambda m: f'(?P=r{i}_{m.group(1)})', pattern)
+            alternatives.append(f'(?P<r{i}>{pattern})')
+            self.groups[i] = [(name, f'r{i}_{name}') for name in names]
+        self.regex = re.compile('|'.join(alternatives), re.IGNORECASE | re.DOTALL) if alternatives else None
+        for i in self.groups:
+            self.by_group[self.regex.groupindex[f'r{i}']] = i
+        # Luật regex đầu tiên: từ khóa đứng trước nó thì không cần chạy regex
+        self.first_pattern = min([*self.groups, *(i for i, _ in self.standalone)], default=len(self.rules))
+
+    def match(self, text):
+        """(luật, {tên group: giá trị}) của luật đầu tiên khớp với cả tin nhắn, None nếu không khớp"""
+        text = normalize(text)
+        word = WORD_RE.match(text)
+        i = self.keywords.get(word.group().casefold()) if word else None
+        if i is not None and i < self.first_pattern:
+            return self.rules[i], {}
+        best = (i, {}) if i is not None else None
+        m = self.regex.fullmatch(text) if self.regex else None
+        if m is not None:
+            j = self.by_group[m.lastindex]
+            if best is None or j < best[0]:
+                best = j, {name: m.group(group) or '' for name, group in self.groups[j]}
+        for j, regex in self.standalone:
+            if best is not None and j >= best[0]:
+                break
+            m = regex.fullmatch(text)
+            if m is not None:
+                best = j, {name: value or '' for name, value in m.groupdict().items()}
+                break
+        return (self.rules[best[0]], best[1]) if best is not None else None
+
+
+def load_rules(path):
+    """Đọc file luật JSON: danh sách {"name", "keyword"|"pattern", "reply"}"""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get('rules', [])
+    return [ReplyRule.from_dict(item, index) for index, item in enumerate(data)]
+
+
+class AutoReplyEngine:
+    """Sink cho SMSReassembler: trả lời tự động tin nhắn đến theo luật, thêm thẳng vào queue gửi
+
+    enqueue(phone, message, idempotency_key, producer) là add_to_queue của handler; idempotency key
+    theo người gửi + SCTS + luật nên tin nhắn nhận lại (modem gửi lại URC) không được trả lời hai lần.
+    File luật được nạp lại khi thay đổi (luật lỗi: giữ bộ luật cũ).
+    """
+    def __init__(self, rules_path, enqueue, limit=REPLY_LIMIT, window=REPLY_WINDOW, producer='autoreply'):
+        self.rules_path = rules_path
+        self.enqueue = enqueue
+        self.limit = limit
+        self.window = window
+        self.producer = producer
+        self.matcher = RuleMatcher([])
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._sent = {}         # người gửi -> deque thời điểm đã trả lời trong cửa sổ
+        self._pruned = time.time()
+        self.stats = {'messages': 0, 'matched': 0, 'replied': 0, 'rate_limited': 0, 'reloads': 0,
+                      'reload_errors': 0}
+        self.reload()
+
+    def reload(self, force=False):
+        """Nạp lại file luật nếu đã đổi, trả về True khi đã nạp"""
+        try:
+            mtime = os.stat(self.rules_path).st_mtime_ns
+        except OSError as e:
+            if self._mtime is None:
+                log.warning("Không đọc được file luật trả lời: %s", e, extra=fields(path=self.rules_path))
+            return False
+        if not force and mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            rules = load_rules(self.rules_path)
+            self.matcher = RuleMatcher(rules)
+        except (OSError, ValueError, re.error) as e:
+            self.stats['reload_errors'] += 1
+            log.error("File luật trả lời không hợp lệ, giữ bộ luật cũ: %s", e, extra=fields(path=self.rules_path))
+            return False
+        self.stats['reloads'] += 1
+        log.info("Đã nạp luật trả lời tự động", extra=fields(path=self.rules_path, rules=len(rules)))
+        return True
+
+    def _maybe_reload(self, now):
+        if now - self._checked >= RELOAD_INTERVAL:
+            self._checked = now
+            self.reload()
+
+    def _allow(self, sender, now):
+        """Giới hạn số tin trả lời cho một người gửi trong cửa sổ"""
+        if not self.limit:
+            return True
+        sent = self._sent.setdefault(sender, deque())
+        while sent and now - sent[0] >= self.window:
+            sent.popleft()
+        if len(sent) >= self.limit:
+            return False
+        sent.append(now)
+        # Dọn người gửi đã hết cửa sổ để bộ nhớ không tăng theo số người gửi
+        if now - self._pruned >= self.window:
+            self._sent = {key: times for key, times in self._sent.items() if times and now - times[-1] < self.window}
+            self._pruned = now
+        return True
+
+    def add(self, message):
+        """Sink: so khớp tin nhắn hoàn chỉnh, thêm tin trả lời vào queue"""
+        now = time.time()
+        with self._lock:
+            self._maybe_reload(now)
+            self.stats['messages'] += 1
+            result = self.matcher.match(message.content)
+            if result is None:
+                return None
+            rule, values = result
+            self.stats['matched'] += 1
+            if not self._allow(message.sender, now):
+                self.stats['rate_limited'] += 1
+                log.info("Bỏ qua trả lời tự động (giới hạn)", extra=fields(sender=message.sender, rule=rule.name))
+                return None
+        try:
+            reply = rule.reply.format(sender=message.sender, **values)
+        except (KeyError, IndexError, ValueError) as e:
+            log.error("Mẫu trả lời lỗi: %s", e, extra=fields(rule=rule.name))
+            return None
+        scts = message.time.isoformat() if hasattr(message.time, 'isoformat') else message.time
+        result = self.enqueue(message.sender, reply, f'autoreply:{message.sender}:{scts}:{rule.name}', self.producer)
+        if result and not getattr(result, 'duplicate', False):
+            self.stats['replied'] += 1
+        log.info("Trả lời tự động", extra=fields(sender=message.sender, rule=rule.name,
+                                                 status=getattr(result, 'status', result)))
+        return result
+
+    def metrics(self):
+        metrics = dict(self.stats)
+        metrics.update({'rules': len(self.matcher.rules), 'senders': len(self._sent)})
+        return metrics
+
+
+# Hàm utility để đo tốc độ so khớp
+def bench(rules_path, count=100000, extra_rules=200):
+    """So sánh regex gộp với vòng lặp từng luật trên count tin nhắn (thêm extra_rules từ khóa giả)"""
+    rules = load_rules(rules_path)
+    rules += [ReplyRule.from_dict({'name': f'kw{i}', 'keyword': f'KM{i:03d}', 'reply': 'x'}) for i in range(extra_rules)]
+    matcher = RuleMatcher(rules)
+    compiled = [(rule, re.compile(rule.pattern, re.IGNORECASE | re.DOTALL)) for rule in rules]
+    samples = ['STOP', 'yes 123456', 'Info', 'Cảm ơn shop nhiều', 'Tôi muốn hủy đơn hàng', 'ok'] * (count // 6)
+
+    start = time.perf_counter()
+    combined = sum(1 for text in samples if matcher.match(text))
+    combined_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    naive = 0
+    for text in samples:
+        text = normalize(text)
+        for rule, regex in compiled:
+            if regex.fullmatch(text):
+                naive += 1
+                break
+    naive_time = time.perf_counter() - start
+
+    print(f"Luật: {len(rules)}, tin nhắn: {len(samples):,}")
+    print(f"Luật gộp:   {combined_time:.3f}s ({len(samples) / combined_time:,.0f} tin/giây), khớp {combined:,}")
+    print(f"Từng luật:  {naive_time:.3f}s ({len(samples) / naive_time:,.0f} tin/giây), khớp {naive:,}")
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) >= 4 and sys.argv[1] == 'test':
+        # Thử một tin nhắn với file luật
+        result = RuleMatcher(load_rules(sys.argv[2])).match(' '.join(sys.argv[3:]))
+        if result is None:
+            print("❌ Không khớp luật nào")
+        else:
+            rule, values = result
+            print(f"✅ Luật '{rule.name}': {rule.reply.format(sender='<sender>', **values)}")
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'bench':
+        bench(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 100000)
+    else:
+        print("Sử dụng:")
+        print("  python sms_autoreply.py test <rules.json> <tin nhắn>  # Thử tin nhắn với file luật")
+        print("  python sms_autoreply.py bench <rules.json> [số tin]   # So sánh regex gộp với từng luật")
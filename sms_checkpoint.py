@@ -0,0 +1,326 @@
+import os
+import json
+import time
+from datetime import datetime
+from collections import defaultdict
+from sms_records import InboundPart, MultipartBuffer
+from sms_logging import fields, get_logger
+
+log = get_logger('checkpoint')
+
+# File snapshot trạng thái ghép tin nhắn (log ghi thêm là <file>.log), không đặt thì không lưu
+REASSEMBLY_CHECKPOINT = os.environ.get('SMS_REASSEMBLY_CHECKPOINT')
+# Số bản ghi trong log trước khi ghi snapshot mới và cắt log
+SNAPSHOT_EVERY = int(os.environ.get('SMS_CHECKPOINT_SNAPSHOT_EVERY', '1000'))
+SNAPSHOT_VERSION = 1
+
+
+def _part_row(part):
+    return [part.time.isoformat(), part.content, part.timestamp, part.modem]
+
+
+def _part_from_row(row):
+    scts, content, received_at, modem = row
+    return InboundPart(datetime.fromisoformat(scts), content, received_at, modem)
+
+
+def _buffer_row(sender, ref, buffer):
+    # Buffer chỉ giữ SCTS sớm nhất: đủ để ghép lại đúng như trước khi dừng
+    return [sender, ref, buffer.total, buffer.first_seen, buffer.modem, buffer.timestamp.isoformat(), buffer.parts]
+
+
+def _buffer_from_row(row):
+    sender, ref, total, first_seen, modem, scts, parts = row
+    buffer = MultipartBuffer(total, first_seen, modem)
+    scts = datetime.fromisoformat(scts)
+    for seq, content in enumerate(parts, 1):
+        if content is not None:
+            buffer.add(seq, content, scts)
+    return sender, ref, buffer
+
+
+class ReassemblyCheckpoint:
+    """Lưu multipart_messages/pending_messages của SMSReassembler: snapshot gọn + log ghi thêm
+
+    Mỗi phần tin nhắn nhận được và mỗi lần xuất tin nhắn là một dòng JSON ngắn trong log
+    (ghi và flush ngay, không fsync: chịu được process bị kill, không chịu được mất điện
+    trừ khi fsync=True). Sau snapshot_every dòng, toàn bộ trạng thái (các phần đang chờ và
+    tin nhắn đã ghép nhưng chưa ack) được ghi ra snapshot (file tạm + os.replace) rồi log
+    được cắt về 0.
+    Khi khởi động: đọc snapshot, chạy lại log (bỏ dòng cuối ghi dở) rồi snapshot lại. Thời
+    điểm nhận được giữ nguyên nên merge window tiếp tục chạy như chưa khởi động lại.
+    Tin nhắn được đánh dấu đã xuất sau khi các sink nhận nên có thể xuất lại (không mất)
+    nếu process chết giữa hai bước. Mọi lời gọi nằm trong lock của SMSReassembler.
+    """
+    def __init__(self, path, snapshot_every=SNAPSHOT_EVERY, fsync=False):
+        self.path = path
+        self.log_path = path + '.log'
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self._log = None
+        self._records = 0
+        self.stats = {'appended': 0, 'snapshots': 0, 'loaded_parts': 0, 'load_ms': None}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    # --- khôi phục ---
+
+    def load(self):
+        """Trạng thái đã lưu: (multipart_messages, pending_messages, multipart đã ghép chưa ack)
+
+        Phần tử cuối là list ('m', sender, ref, MultipartBuffer) cần xuất lại; tin nhắn rời chưa
+        ack được trả lại vào pending_messages (đã quá merge window nên xuất ngay lần kiểm tra sau).
+        """
+        start = time.perf_counter()
+        multipart = defaultdict(dict)
+        pending = defaultdict(list)
+        # (sender, ref, first_seen) -> MultipartBuffer đã đủ phần, chờ ack
+        complete = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') == SNAPSHOT_VERSION:
+                for row in state['multipart']:
+                    sender, ref, buffer = _buffer_from_row(row)
+                    multipart[sender][ref] = buffer
+                for sender, rows in state['pending']:
+                    pending[sender] = [_part_from_row(row) for row in rows]
+                for kind, *row in state.get('inflight', ()):
+                    if kind == 'm':
+                        sender, ref, buffer = _buffer_from_row(row)
+                        complete[sender, ref, buffer.first_seen] = buffer
+                    else:
+                        sender, rows = row
+                        pending[sender].extend(_part_from_row(part) for part in rows)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.error("Snapshot ghép tin nhắn hỏng, bỏ qua: %s", e, extra=fields(path=self.path))
+
+        replayed = 0
+        try:
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._replay(json.loads(line), multipart, pending, complete)
+                        replayed += 1
+                    except (ValueError, KeyError, TypeError, IndexError):
+                        # Dòng cuối ghi dở khi process bị dừng
+                        log.warning("Bỏ qua dòng log checkpoint hỏng", extra=fields(path=self.log_path))
+        except FileNotFoundError:
+            pass
+
+        parts = sum(buffer.received for buffers in multipart.values() for buffer in buffers.values())
+        parts += sum(len(rows) for rows in pending.values())
+        parts += sum(buffer.received for buffer in complete.values())
+        self.stats['loaded_parts'] = parts
+        self.stats['load_ms'] = round((time.perf_counter() - start) * 1000, 2)
+        if parts:
+            log.info("Đã khôi phục trạng thái ghép tin nhắn", extra=fields(
+                parts=parts, senders=len(set(multipart) | set(pending)), replayed=replayed,
+                load_ms=self.stats['load_ms']))
+        return multipart, pending, [('m', sender, ref, buffer) for (sender, ref, _), buffer in complete.items()]
+
+    @staticmethod
+    def _replay(record, multipart, pending, complete):
+        kind, sender = record[0], record[1]
+        if kind == 'p':
+            # Phần multipart: ref, total, seq, first_seen, scts, content, received_at, modem
+            _, _, ref, total, seq, first_seen, *row = record
+            buffers = multipart[sender]
+            buffer = buffers.get(ref)
+            if buffer is None:
+                buffer = buffers[ref] = MultipartBuffer(total, first_seen, row[3])
+            part = _part_from_row(row)
+            if buffer.add(seq, part.content, part.time):
+                # Như SMSReassembler: buffer đủ phần rời khỏi multipart (ref có thể được dùng lại ngay)
+                complete[sender, ref, buffer.first_seen] = buffer
+                del buffers[ref]
+            if not buffers:
+                del multipart[sender]
+        elif kind == 's':
+            pending[sender].append(_part_from_row(record[2:]))
+        elif kind == 'm':
+            # Multipart đã xuất: chỉ xóa đúng buffer (cùng first_seen), không xóa buffer mới cùng ref
+            complete.pop((sender, record[2], record[3]), None)
+        elif kind == 'd':
+            # Tin nhắn rời đã xuất: xóa theo thời điểm nhận, giữ phần đến sau
+            done = set(record[2])
+            rows = [part for part in pending.get(sender, []) if part.timestamp not in done]
+            if rows:
+                pending[sender] = rows
+            else:
+                pending.pop(sender, None)
+
+    # --- ghi ---
+
+    def part(self, sender, scts, content, received_at, modem, multipart_info=None, first_seen=None):
+        """Ghi một phần vừa nhận"""
+        row = [scts.isoformat(), content, received_at, modem]
+        if multipart_info:
+            ref, total, seq = multipart_info
+            self._append(['p', sender, ref, total, seq, first_seen, *row])
+        else:
+            self._append(['s', sender, *row])
+
+    def emitted_multipart(self, sender, ref, first_seen):
+        self._append(['m', sender, ref, first_seen])
+
+    def emitted_pending(self, sender, parts):
+        self._append(['d', sender, [part.timestamp for part in parts]])
+
+    def _append(self, record):
+        if self._log is None:
+            self._log = open(self.log_path, 'a', encoding='utf-8')
+        self._log.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._log.flush()
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self._records += 1
+        self.stats['appended'] += 1
+
+    @property
+    def due(self):
+        """Log đã đủ dài để snapshot"""
+        return self._records >= self.snapshot_every
+
+    def snapshot(self, multipart, pending, inflight=()):
+        """Ghi toàn bộ trạng thái hiện tại ra snapshot rồi cắt log
+
+        inflight: (kind, sender, ref, buffer|parts) đã ghép nhưng chưa ack ('m' multipart, 'd' tin rời).
+        """
+        state = {
+            'version': SNAPSHOT_VERSION,
+            'time': time.time(),
+            'multipart': [_buffer_row(sender, ref, buffer)
+                          for sender, buffers in multipart.items() for ref, buffer in buffers.items()],
+            'pending': [[sender, [_part_row(part) for part in parts]] for sender, parts in pending.items() if parts],
+            'inflight': [['m', *_buffer_row(sender, ref, payload)] if kind == 'm'
+                         else ['d', sender, [_part_row(part) for part in payload]]
+                         for kind, sender, ref, payload in inflight],
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Log chỉ được cắt sau khi snapshot đã thay thế file cũ
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, 'w', encoding='utf-8')
+        self._records = 0
+        self.stats['snapshots'] += 1
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def bench(senders=2000, parts=3):
+    """Thời gian khôi phục khi có senders tin nhắn multipart đang ghép dở (mỗi tin thiếu một phần)"""
+    import tempfile
+    from sms_inbound import LOCAL_TZ, SMSReassembler
+
+    received = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'reassembly.ckpt')
+        reassembler = SMSReassembler(sinks=[received.append], checkpoint_path=path)
+        scts = datetime.now(LOCAL_TZ).replace(microsecond=0)
+        start = time.perf_counter()
+        for i in range(senders):
+            sender = f'849{i:09d}'
+            for seq in range(1, parts):
+                reassembler.add(sender, scts, f'Phần {seq} của tin nhắn {i} ' * 5, (i % 256, parts, seq))
+            reassembler.add(sender, scts, f'Tin nhắn rời {i}', None)
+        elapsed = time.perf_counter() - start
+        added = senders * parts
+        print(f"✍️ Ghi {added:,} phần trong {elapsed * 1000:.0f} ms ({elapsed / added * 1e6:.1f} µs/phần), "
+              f"{reassembler.checkpoint.stats['snapshots']} snapshot, log {os.path.getsize(path + '.log'):,} byte")
+
+        # Process bị dừng đột ngột: không snapshot lúc dừng, khôi phục từ snapshot + log
+        reassembler.checkpoint._log.close()
+        restored = SMSReassembler(sinks=[received.append], checkpoint_path=path)
+        stats = restored.checkpoint.stats
+        print(f"♻️ Khôi phục {stats['loaded_parts']:,} phần của {len(restored.multipart_messages):,} sender "
+              f"trong {stats['load_ms']} ms (snapshot {os.path.getsize(path):,} byte)")
+
+        # Phần còn thiếu đến sau khi khởi động lại: tin nhắn ghép đủ, không mất phần nào
+        for i in range(senders):
+            restored.add(f'849{i:09d}', scts, f'Phần {parts} của tin nhắn {i}', (i % 256, parts, parts))
+        restored.check_pending(float('inf'))
+        complete = sum(1 for message in received if message.kind == 'multipart' and message.parts == parts)
+        print(f"✅ {complete:,}/{senders:,} tin nhắn multipart ghép đủ sau khi khởi động lại, "
+              f"{sum(1 for message in received if message.kind == 'single'):,} tin nhắn rời")
+        restored.close()
+
+
+def check():
+    """Kiểm tra ghép tin nhắn có/không có checkpoint và khởi động lại khi tin nhắn chưa ack"""
+    import tempfile
+    from sms_inbound import LOCAL_TZ, SMSReassembler
+
+    scts = datetime.now(LOCAL_TZ).replace(microsecond=0)
+    results = []
+
+    def report(name, ok):
+        results.append(ok)
+        print(f"{'✅' if ok else '❌'} {name}")
+
+    # Không có checkpoint: mọi phần (kể cả phần chưa đủ) không được lỗi
+    received = []
+    reassembler = SMSReassembler(sinks=[received.append])
+    reassembler.add('84900000001', scts, 'Xin ', (1, 2, 1))
+    reassembler.add('84900000001', scts, 'chào', (1, 2, 2))
+    report("Multipart 2 phần không có checkpoint",
+           [(m.kind, m.content) for m in received] == [('multipart', 'Xin chào')] and reassembler.close() is False)
+    received.clear()
+    reassembler.add('84900000001', scts, 'Thiếu ', (2, 3, 1), received_at=time.time() - reassembler.multipart_timeout - 1)
+    reassembler.add('84900000001', scts, 'phần', (2, 3, 3))
+    reassembler.check_pending()
+    report("Multipart thiếu phần quá hạn được xuất phần đã nhận",
+           [(m.content, m.parts) for m in received] == [('Thiếu phần', 2)] and not reassembler.multipart_messages)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'reassembly.ckpt')
+        # Sink cuối chưa ack (tin nhắn còn trong SenderOrderBuffer), snapshot xảy ra trong lúc đó, rồi dừng đột ngột
+        received = []
+        reassembler = SMSReassembler(sinks=[received.append], checkpoint_path=path, deferred_ack=True)
+        reassembler.checkpoint.snapshot_every = 1
+        reassembler.add('84900000002', scts, 'Phần 1 ', (7, 2, 1))
+        reassembler.add('84900000002', scts, 'phần 2', (7, 2, 2))
+        reassembler.add('84900000002', scts, 'Tin mới cùng ref', (7, 2, 1))
+        reassembler.add('84900000003', scts, 'Tin rời', None, received_at=time.time() - 60)
+        reassembler.check_pending()
+        reassembler.checkpoint.close()
+
+        received = []
+        restored = SMSReassembler(sinks=[received.append], checkpoint_path=path)
+        restored.check_pending()
+        report("Tin nhắn chưa ack được xuất lại sau khi khởi động lại",
+               sorted((m.kind, m.content) for m in received) == [('multipart', 'Phần 1 phần 2'), ('single', 'Tin rời')])
+        buffer = restored.multipart_messages.get('84900000002', {}).get(7)
+        report("Buffer mới cùng ref được giữ nguyên",
+               buffer is not None and buffer.parts == ['Tin mới cùng ref', None])
+        restored.close()
+
+        received = []
+        SMSReassembler(sinks=[received.append], checkpoint_path=path).check_pending()
+        report("Tin nhắn đã ack không xuất lại", not received)
+    return all(results)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 2000, int(sys.argv[3]) if len(sys.argv) > 3 else 3)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'check':
+        sys.exit(0 if check() else 1)
+    else:
+        print("Sử dụng:")
+        print("  python sms_checkpoint.py bench [số_sender] [số_phần]  # Ghi/khôi phục trạng thái ghép tin nhắn")
+        print("  python sms_checkpoint.py check  # Kiểm tra ghép tin nhắn và khôi phục tin nhắn chưa ack")
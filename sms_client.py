@@ -3,7 +3,30 @@ import json
 import time
 import os
 import base64
+import re
 from datetime import datetime
+from itertools import islice
+from sms_records import EnqueueResult
+
+# Thư mục queue của service (SMS_QUEUE_DIR): FileSMSClient ghi vào đúng shard service đọc
+QUEUE_DIR = os.environ.get('SMS_QUEUE_DIR')
+# Database queue dùng chung của cluster (SMS_CLUSTER_QUEUE): có thì ghi vào đó thay cho file queue
+CLUSTER_QUEUE = os.environ.get('SMS_CLUSTER_QUEUE')
+# Ký tự bị bỏ qua khi kiểm tra số điện thoại
+PHONE_STRIP_TABLE = str.maketrans('', '', ' -()')
+# +84xxxxxxxxx, 84xxxxxxxxx hoặc 0xxxxxxxxx (ít nhất 9 chữ số sau tiền tố)
+PHONE_RE = re.compile(r'(?:\+84|84|0)\d{9,}')
+
+def validate_phone(phone_number):
+    """Kiểm tra tính hợp lệ của số điện thoại"""
+    if not phone_number:
+        return False
+    return PHONE_RE.fullmatch(phone_number.translate(PHONE_STRIP_TABLE)) is not None
+
+def validate_phones(phone_numbers):
+    """Kiểm tra cả lô số điện thoại trong một lượt, trả về list bool"""
+    fullmatch = PHONE_RE.fullmatch
+    return [bool(phone) and fullmatch(phone.translate(PHONE_STRIP_TABLE)) is not None for phone in phone_numbers]
 
 # Client giao tiếp qua Socket
 class SMSClient:
@@ -11,8 +34,15 @@ class SMSClient:
         self.host = host
         self.port = port
     
-    def send_message(self, phone_number, message):
-        """Gửi tin nhắn qua socket connection"""
+    def send_message(self, phone_number, message, idempotency_key=None, producer=None, send_at=None,
+                     throttle=None):
+        """Gửi tin nhắn qua socket connection
+        
+        Gửi lại với cùng idempotency_key (ví dụ khi timeout) không tạo tin nhắn thứ hai,
+        server trả về status 'duplicate'. Queue quá tải hoặc producer hết quota: status
+        'rejected' kèm retry_after (giây). send_at (datetime, epoch, ISO hoặc '+30m'): status
+        'scheduled' kèm send_at; throttle: tên throttle đã khai báo trên server.
+        """
         sock = None
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -25,6 +55,14 @@ class SMSClient:
                 'message': message,
                 'timestamp': datetime.now().isoformat()
             }
+            if idempotency_key:
+                data['idempotency_key'] = idempotency_key
+            if producer:
+                data['producer'] = producer
+            if send_at is not None:
+                data['send_at'] = send_at.isoformat() if isinstance(send_at, datetime) else send_at
+            if throttle:
+                data['throttle'] = throttle
             
             # Gửi dữ liệu
             message_data = json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n'
@@ -46,38 +84,141 @@ class SMSClient:
 
 # Client giao tiếp qua File
 class FileSMSClient:
-    def __init__(self, queue_file='/tmp/sms_queue.txt', use_json=False):
+    def __init__(self, queue_file='/tmp/sms_queue.txt', use_json=False, dedupe_window=None, queue_dir=QUEUE_DIR,
+                 queue_shards=None, cluster_queue=CLUSTER_QUEUE):
         self.queue_file = queue_file
+        # queue_dir: queue dạng thư mục segment của service (mặc định SMS_QUEUE_DIR), None: dùng queue_file
+        self.queue_dir = queue_dir
+        # Số shard (chọn shard theo số điện thoại như handler), None: tự phát hiện trên đĩa
+        self.queue_shards = queue_shards
+        # cluster_queue: database LeasedQueue của service (mặc định SMS_CLUSTER_QUEUE), None: file queue
+        self.cluster_queue = cluster_queue
         self.use_json = use_json  # True: dùng JSON, False: dùng Base64 encoding
+        # Cửa sổ chống trùng theo nội dung (giây), None: theo SMS_DEDUPE_WINDOW
+        self.dedupe_window = dedupe_window
+        self._file_queue = None
+        self._dedupe = None
+        self._admission = None
+        self._scheduler = None
         # Tạo thư mục nếu chưa tồn tại
         os.makedirs(os.path.dirname(self.queue_file), exist_ok=True)
     
-    def send_message(self, phone_number, message):
-        """Ghi tin nhắn vào file queue"""
+    @property
+    def file_queue(self):
+        """Queue dùng chung với SimpleSMSHandler: LeasedQueue (cluster_queue) hoặc ShardedFileQueue"""
+        if self._file_queue is None:
+            if self.cluster_queue:
+                from sms_cluster import LeasedQueue
+                self._file_queue = LeasedQueue(self.cluster_queue)
+            else:
+                from sms_queue import ShardedFileQueue
+                self._file_queue = ShardedFileQueue(self.queue_file, self.queue_shards, queue_dir=self.queue_dir)
+        return self._file_queue
+    
+    @property
+    def dedupe(self):
+        """Index chống trùng dùng chung với SimpleSMSHandler (cùng file queue)"""
+        if self._dedupe is None:
+            from sms_dedupe import DEFAULT_WINDOW, DedupeIndex, dedupe_path
+            self._dedupe = DedupeIndex(dedupe_path(self.queue_file, self.queue_dir))
+            if self.dedupe_window is None:
+                self.dedupe_window = DEFAULT_WINDOW
+        return self._dedupe
+    
+    @property
+    def admission(self):
+        """Giới hạn độ sâu/thời gian chờ/quota dùng chung với SimpleSMSHandler (cùng file queue)"""
+        if self._admission is None:
+            from sms_admission import AdmissionController
+            self._admission = AdmissionController(self.queue_file, self.queue_dir,
+                                                  queue=self.file_queue if self.cluster_queue else None)
+        return self._admission
+    
+    @property
+    def scheduler(self):
+        """Lịch gửi dùng chung với SimpleSMSHandler (cùng file queue)"""
+        if self._scheduler is None:
+            from sms_schedule import open_scheduler
+            self._scheduler = open_scheduler(self.queue_file, self.queue_dir)
+        return self._scheduler
+    
+    def send_message(self, phone_number, message, idempotency_key=None, producer=None, send_at=None,
+                     throttle=None):
+        """Ghi tin nhắn vào file queue, trả về EnqueueResult
+        
+        duplicate: đã gửi trong cửa sổ chống trùng; rejected: queue quá tải hoặc producer
+        hết quota, thử lại sau retry_after giây; scheduled: hẹn giờ lúc send_at (service nhả
+        vào queue khi đến hạn, theo throttle nếu có).
+        """
+        claimed = False
         try:
             # Validate số điện thoại
             if not self._validate_phone(phone_number):
                 print(f"Số điện thoại không hợp lệ: {phone_number}")
-                return False
+                return EnqueueResult(EnqueueResult.ERROR, phone_number, 'Số điện thoại không hợp lệ')
             
             # Validate tin nhắn
             if not message or len(message.strip()) == 0:
                 print("Tin nhắn không được để trống")
-                return False
+                return EnqueueResult(EnqueueResult.ERROR, phone_number, 'Tin nhắn trống')
             
-            # Phương pháp 1: Sử dụng JSON (khuyến nghị)
-            if hasattr(self, 'use_json') and self.use_json:
-                return self._write_json_format(phone_number, message)
-            else:
-                # Phương pháp 2: Encode Base64 để tránh conflict
-                return self._write_encoded_format(phone_number, message)
+            due = None
+            if send_at is not None or throttle:
+                from sms_schedule import parse_send_at
+                due = parse_send_at(send_at)
+                # Như handler: đã đến hạn thì thêm thẳng vào queue, trừ khi có throttle
+                if due is not None and due <= time.time():
+                    due = None
+                if due is None and throttle:
+                    due = time.time()
+            
+            # Chống gửi trùng khi ứng dụng gọi lại (retry)
+            dedupe = self.dedupe
+            if idempotency_key or self.dedupe_window:
+                if not dedupe.claim(phone_number, message, idempotency_key, self.dedupe_window):
+                    print(f"⚠️ Bỏ qua tin nhắn trùng: {phone_number}")
+                    return EnqueueResult(EnqueueResult.DUPLICATE, phone_number)
+                claimed = True
+            
+            # Lỗi sau khi đã claim: trả lại claim để lần gửi lại không bị coi là trùng
+            try:
+                # Hẹn giờ: lưu vào scheduler, service chuyển vào queue khi đến hạn
+                if due is not None:
+                    self.scheduler.add(phone_number, message, due, throttle)
+                    print(f"⏰ Đã hẹn giờ gửi {phone_number} lúc {datetime.fromtimestamp(due):%Y-%m-%d %H:%M:%S}")
+                    return EnqueueResult(EnqueueResult.SCHEDULED, phone_number, send_at=due)
+            
+                # Queue quá tải: báo cho ứng dụng thử lại sau thay vì xếp hàng hàng giờ
+                _, rejection = self.admission.admit(1, producer, phone_number)
+                if rejection is not None:
+                    if claimed:
+                        dedupe.release(phone_number, message, idempotency_key)
+                    print(f"⏳ Queue quá tải ({rejection.error}), thử lại sau {rejection.retry_after:.0f} giây")
+                    return rejection
+            
+                # Phương pháp 1: Sử dụng JSON (khuyến nghị)
+                if hasattr(self, 'use_json') and self.use_json:
+                    written = self._write_json_format(phone_number, message)
+                else:
+                    # Phương pháp 2: Encode Base64 để tránh conflict
+                    written = self._write_encoded_format(phone_number, message)
+            
+                if written:
+                    return EnqueueResult(EnqueueResult.QUEUED, phone_number)
+                if claimed:
+                    dedupe.release(phone_number, message, idempotency_key)
+                return EnqueueResult(EnqueueResult.ERROR, phone_number, 'Lỗi ghi file queue')
+            except Exception:
+                if claimed:
+                    dedupe.release(phone_number, message, idempotency_key)
+                raise
             
         except PermissionError:
             print(f"Lỗi: Không có quyền ghi file {self.queue_file}")
-            return False
+            return EnqueueResult(EnqueueResult.ERROR, phone_number, 'Không có quyền ghi file queue')
         except Exception as e:
             print(f"Lỗi ghi file: {e}")
-            return False
+            return EnqueueResult(EnqueueResult.ERROR, phone_number, str(e))
     
     def _write_json_format(self, phone_number, message):
         """Ghi dưới dạng JSON - an toàn nhất"""
@@ -90,8 +231,7 @@ class FileSMSClient:
             
             json_line = json.dumps(data, ensure_ascii=False) + '\n'
             
-            with open(self.queue_file, 'a', encoding='utf-8') as f:
-                f.write(json_line)
+            self._append_line(json_line, phone_number)
             
             print(f"✓ Đã thêm tin nhắn vào hàng đợi (JSON): {phone_number}")
             return True
@@ -111,8 +251,7 @@ class FileSMSClient:
             # Format: timestamp|phone|base64_message|END
             line = f"{timestamp}|{phone_number}|{encoded_message}|END\n"
             
-            with open(self.queue_file, 'a', encoding='utf-8') as f:
-                f.write(line)
+            self._append_line(line, phone_number)
             
             print(f"✓ Đã thêm tin nhắn vào hàng đợi (Encoded): {phone_number}")
             return True
@@ -121,83 +260,61 @@ class FileSMSClient:
             print(f"Lỗi ghi encoded: {e}")
             return False
     
+    def _append_line(self, line, phone_number):
+        """Ghi vào shard của số điện thoại qua ShardedFileQueue (cùng khóa với steal/compact của handler)
+        hoặc vào LeasedQueue của cluster"""
+        self.file_queue.append(line.rstrip('\n'), phone_number)
+    
     def _validate_phone(self, phone_number):
         """Kiểm tra tính hợp lệ của số điện thoại"""
-        if not phone_number:
-            return False
-        
-        # Loại bỏ khoảng trắng và ký tự đặc biệt
-        clean_phone = phone_number.replace(' ', '').replace('-', '').replace('(', '').replace(')', '')
-        
-        # Kiểm tra định dạng cơ bản
-        if clean_phone.startswith('+84'):
-            return len(clean_phone) >= 12 and clean_phone[3:].isdigit()
-        elif clean_phone.startswith('84'):
-            return len(clean_phone) >= 11 and clean_phone[2:].isdigit()
-        elif clean_phone.startswith('0'):
-            return len(clean_phone) >= 10 and clean_phone[1:].isdigit()
+        return validate_phone(phone_number)
+    
+    def iter_queue_messages(self, phone=None, since=None, until=None, offset=None, record=0):
+        """Duyệt lười tin nhắn trong queue file (mmap), không nạp cả file vào bộ nhớ
         
-        return False
+        Mặc định chỉ các tin nhắn chưa gửi (từ cursor của service); offset/record: đọc từ byte
+        hoặc số thứ tự dòng trong file (kể cả phần đã gửi chưa được dọn). phone, since/until
+        (datetime, epoch hoặc 'YYYY-MM-DD HH:MM:SS'): lọc trong lúc duyệt.
+        """
+        from sms_queue import iter_records
+        if offset is None and not record:
+            return self.file_queue.records(phone, since, until)
+        if self.queue_dir or self.cluster_queue:
+            raise ValueError("offset/record chỉ dùng với queue_file (không có queue_dir/cluster_queue)")
+        return iter_records(self.queue_file, offset or 0, record, phone, since, until)
     
-    def read_queue_messages(self):
-        """Đọc và parse các tin nhắn từ queue file"""
+    def read_queue_messages(self, limit=None, **filters):
+        """Danh sách dict (timestamp, phone, message) các tin nhắn trong queue, tối đa limit tin
+        
+        filters như iter_queue_messages; queue lớn nên dùng iter_queue_messages.
+        """
         try:
-            if not os.path.exists(self.queue_file):
-                return []
-            
-            messages = []
-            with open(self.queue_file, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    
-                    try:
-                        if self.use_json:
-                            # Parse JSON format
-                            data = json.loads(line)
-                            messages.append(data)
-                        else:
-                            # Parse encoded format
-                            parts = line.split('|')
-                            if len(parts) >= 4 and parts[-1] == 'END':
-                                timestamp = parts[0]
-                                phone = parts[1]
-                                encoded_msg = parts[2]
-                                
-                                # Decode base64 message
-                                decoded_msg = base64.b64decode(encoded_msg.encode('ascii')).decode('utf-8')
-                                
-                                messages.append({
-                                    'timestamp': timestamp,
-                                    'phone': phone,
-                                    'message': decoded_msg
-                                })
-                            else:
-                                print(f"Dòng {line_num}: Format không hợp lệ")
-                                
-                    except (json.JSONDecodeError, base64.binascii.Error) as e:
-                        print(f"Dòng {line_num}: Lỗi parse - {e}")
-                        continue
-            
-            return messages
-            
+            records = islice(self.iter_queue_messages(**filters), limit)
+            return [record.as_dict() for record in records]
         except Exception as e:
             print(f"Lỗi đọc queue: {e}")
             return []
     
     def get_queue_status(self):
-        """Lấy thông tin trạng thái hàng đợi"""
+        """Lấy thông tin trạng thái hàng đợi (đếm dòng chưa gửi theo khối, không parse)"""
         try:
-            if not os.path.exists(self.queue_file):
-                return {'count': 0, 'size': 0, 'format': 'N/A'}
+            if self.cluster_queue:
+                # Database dùng chung: không có shard/cursor, đếm tin nhắn chưa gửi xong
+                count = self.file_queue.count()
+                if not count:
+                    return {'count': 0, 'size': 0, 'format': 'N/A'}
+                return {'count': count, 'size': os.path.getsize(self.cluster_queue),
+                        'format': 'JSON' if self.use_json else 'Base64'}
             
-            messages = self.read_queue_messages()
-            file_size = os.path.getsize(self.queue_file)
+            shards = self.file_queue.shards
+            size = sum(shard.size() for shard in shards)
+            if not size:
+                return {'count': 0, 'size': 0, 'format': 'N/A'}
             
             return {
-                'count': len(messages), 
-                'size': file_size,
+                'count': self.file_queue.count(),
+                'size': size,
+                'pending_bytes': sum(shard.pending_bytes() for shard in shards),
                 'format': 'JSON' if self.use_json else 'Base64'
             }
             
@@ -226,7 +343,7 @@ Kết thúc tin nhắn."""
         print(f"   Queue status: {status['count']} tin nhắn, {status['size']} bytes, Format: {status['format']}")
         
         # Đọc lại để kiểm tra
-        messages = json_client.read_queue_messages()
+        messages = json_client.read_queue_messages(limit=1)
         if messages:
             print(f"   ✓ Đọc lại thành công: {len(messages[0]['message'])} ký tự")
     
@@ -238,14 +355,15 @@ Kết thúc tin nhắn."""
         print(f"   Queue status: {status['count']} tin nhắn, {status['size']} bytes, Format: {status['format']}")
         
         # Đọc lại để kiểm tra
-        messages = b64_client.read_queue_messages()
+        messages = b64_client.read_queue_messages(limit=1)
         if messages:
             print(f"   ✓ Đọc lại thành công: {len(messages[0]['message'])} ký tự")
     
     print("\n3. So sánh nội dung:")
-    if len(json_client.read_queue_messages()) > 0 and len(b64_client.read_queue_messages()) > 0:
-        json_msg = json_client.read_queue_messages()[0]['message']
-        b64_msg = b64_client.read_queue_messages()[0]['message']
+    json_first = next(json_client.iter_queue_messages(), None)
+    b64_first = next(b64_client.iter_queue_messages(), None)
+    if json_first and b64_first:
+        json_msg, b64_msg = json_first.message, b64_first.message
         print(f"   Nội dung giống nhau: {json_msg == b64_msg == problematic_message}")
     
     # Test SMSClient
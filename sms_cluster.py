@@ -0,0 +1,390 @@
+import os
+import glob
+import time
+import socket
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime
+from sms_queue import QueueClaim, as_datetime
+from sms_records import QueueRecord
+from sms_logging import fields, get_logger
+
+log = get_logger('cluster')
+
+# Database queue dùng chung cho nhiều gateway (đĩa chung/NFS), không đặt thì mỗi máy dùng file queue riêng
+CLUSTER_QUEUE = os.environ.get('SMS_CLUSTER_QUEUE')
+# Tên gateway trong cluster (chủ của lease), mặc định là hostname
+NODE_ID = os.environ.get('SMS_NODE_ID') or socket.gethostname()
+# Gateway chết thì tin nhắn nó đang giữ được gateway khác lấy lại sau LEASE_SECONDS giây
+LEASE_SECONDS = float(os.environ.get('SMS_LEASE_SECONDS', '300'))
+# Số tin nhắn mỗi lần claim (một transaction cho cả lô)
+CLAIM_BATCH = int(os.environ.get('SMS_CLAIM_BATCH', '20'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,  -- không dùng lại id: ack muộn không xóa nhầm tin mới
+    line        TEXT    NOT NULL,                   -- dòng queue (OutboundJob.to_line)
+    phone       TEXT,
+    created     REAL    NOT NULL,
+    owner       TEXT,                               -- 'node/shard' đang giữ lease
+    lease_until REAL    NOT NULL DEFAULT 0,         -- 0: chưa ai claim
+    attempts    INTEGER NOT NULL DEFAULT 0          -- số lần được claim
+);
+CREATE INDEX IF NOT EXISTS idx_messages_lease ON messages(lease_until, id);
+CREATE INDEX IF NOT EXISTS idx_messages_owner ON messages(owner);
+
+CREATE TABLE IF NOT EXISTS nodes (
+    name      TEXT    PRIMARY KEY,
+    heartbeat REAL    NOT NULL,
+    claimed   INTEGER NOT NULL DEFAULT 0,
+    completed INTEGER NOT NULL DEFAULT 0,
+    reclaimed INTEGER NOT NULL DEFAULT 0    -- tin nhắn lấy lại từ lease hết hạn của gateway khác
+);
+"""
+
+
+class LeasedQueue:
+    """Queue gửi dùng chung cho nhiều gateway trên một file SQLite, claim theo lô có thời hạn
+
+    Mỗi sender (node/shard) claim CLAIM_BATCH tin nhắn trong một transaction BEGIN IMMEDIATE
+    và giữ chúng trong bộ nhớ, gia hạn lease khi đã qua nửa thời hạn. Lease hết hạn (gateway
+    chết/mất mạng) được gateway khác lấy lại trước tin nhắn mới; gateway khởi động lại lấy
+    lại ngay lô của chính nó. Ack xóa tin nhắn theo id nên gọi lại (hoặc ack sau khi mất
+    lease) không có tác dụng phụ; gửi là at-least-once như file queue.
+    Có cùng giao diện với ShardedFileQueue mà SimpleSMSHandler dùng; thứ tự theo số nhận
+    chỉ được giữ trong một gateway.
+    journal_mode=DELETE vì WAL không chạy trên NFS; đĩa chung cục bộ có thể dùng WAL.
+    """
+    def __init__(self, path, node=NODE_ID, lease=LEASE_SECONDS, batch=CLAIM_BATCH, journal_mode='DELETE'):
+        self.path = path
+        self.node = node
+        self.lease = lease
+        self.batch = batch
+        self.journal_mode = journal_mode
+        self.lock = threading.Lock()
+        # shard -> deque[(id, line)] đã claim chưa gửi; thời điểm gia hạn tiếp theo
+        self._held = {}
+        self._inflight = {}
+        self._renew_at = {}
+        self.stats = {'claimed': 0, 'completed': 0, 'reclaimed': 0, 'lost': 0, 'released': 0}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute(f'PRAGMA journal_mode={self.journal_mode}')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def owner(self, shard_index=0):
+        return f"{self.node}/{shard_index}"
+
+    # --- producer ---
+
+    def append(self, line, phone_number=None):
+        self.append_many([(line, phone_number)])
+
+    def append_many(self, items):
+        """Ghi nhiều (line, phone_number) trong một transaction"""
+        now = time.time()
+        rows = [(line, phone, now) for line, phone in items]
+        if not rows:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('INSERT INTO messages (line, phone, created) VALUES (?, ?, ?)', rows)
+        finally:
+            conn.close()
+
+    # --- consumer ---
+
+    def next_job(self, shard_index=0, steal=True):
+        """Tin nhắn tiếp theo của sender: từ lô đang giữ, hết thì claim lô mới
+
+        steal=False (sóng yếu): chỉ gửi nốt lô đang giữ, không claim thêm.
+        """
+        with self.lock:
+            held = self._held.setdefault(shard_index, deque())
+            if (held or shard_index in self._inflight) and time.time() >= self._renew_at.get(shard_index, 0):
+                self._renew(shard_index, held)
+            if not held and steal:
+                self._claim(shard_index, held)
+            if not held:
+                return None
+            row_id, line = held.popleft()
+            self._inflight[shard_index] = row_id
+        return QueueClaim(line, shard_index, position=row_id)
+
+    def _claim(self, shard_index, held):
+        owner = self.owner(shard_index)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Lô của chính sender này từ process trước (khởi động lại trước khi lease hết hạn)
+            rows = conn.execute('SELECT id, line, 0 FROM messages WHERE owner = ? AND lease_until > ? AND id != ? '
+                                'ORDER BY id LIMIT ?',
+                                (owner, now, self._inflight.get(shard_index, 0), self.batch)).fetchall()
+            # Lease hết hạn của gateway khác trước, rồi tin nhắn mới theo thứ tự thêm vào
+            if len(rows) < self.batch:
+                rows += conn.execute('SELECT id, line, 1 FROM messages WHERE lease_until > 0 AND lease_until <= ? '
+                                     'ORDER BY lease_until, id LIMIT ?', (now, self.batch - len(rows))).fetchall()
+            if len(rows) < self.batch:
+                rows += conn.execute('SELECT id, line, 0 FROM messages WHERE lease_until = 0 ORDER BY id LIMIT ?',
+                                     (self.batch - len(rows),)).fetchall()
+            reclaimed = sum(expired for _, _, expired in rows)
+            if rows:
+                conn.executemany('UPDATE messages SET owner = ?, lease_until = ?, attempts = attempts + 1 '
+                                 'WHERE id = ?', ((owner, now + self.lease, row_id) for row_id, _, _ in rows))
+            self._heartbeat(conn, now, claimed=len(rows), reclaimed=reclaimed)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+        held.extend((row_id, line) for row_id, line, _ in rows)
+        self._renew_at[shard_index] = now + self.lease / 2
+        self.stats['claimed'] += len(rows)
+        if reclaimed:
+            self.stats['reclaimed'] += reclaimed
+            log.warning("Lấy lại tin nhắn từ lease hết hạn", extra=fields(node=owner, count=reclaimed))
+
+    def _renew(self, shard_index, held):
+        """Gia hạn lease của lô đang giữ và tin nhắn đang gửi, bỏ những tin nhắn đã bị gateway khác lấy lại"""
+        owner = self.owner(shard_index)
+        now = time.time()
+        ids = [row_id for row_id, _ in held]
+        inflight = self._inflight.get(shard_index)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                renew = ids + [inflight] if inflight is not None else ids
+                kept = {row_id for row_id, in conn.execute(
+                    f"SELECT id FROM messages WHERE owner = ? AND id IN ({','.join('?' * len(renew))})",
+                    [owner, *renew])}
+                conn.executemany('UPDATE messages SET lease_until = ? WHERE id = ?',
+                                 ((now + self.lease, row_id) for row_id in kept))
+                self._heartbeat(conn, now)
+        finally:
+            conn.close()
+        lost = len(ids) - len(kept - {inflight})
+        if lost:
+            remaining = [item for item in held if item[0] in kept]
+            held.clear()
+            held.extend(remaining)
+            self.stats['lost'] += lost
+            log.warning("Mất lease, tin nhắn đã được gateway khác lấy lại", extra=fields(node=owner, count=lost))
+        self._renew_at[shard_index] = now + self.lease / 2
+
+    def _heartbeat(self, conn, now, claimed=0, completed=0, reclaimed=0):
+        conn.execute('INSERT INTO nodes (name, heartbeat, claimed, completed, reclaimed) VALUES (?, ?, ?, ?, ?) '
+                     'ON CONFLICT(name) DO UPDATE SET heartbeat = excluded.heartbeat, '
+                     'claimed = claimed + excluded.claimed, completed = completed + excluded.completed, '
+                     'reclaimed = reclaimed + excluded.reclaimed', (self.node, now, claimed, completed, reclaimed))
+
+    def ack(self, claim):
+        """Đã gửi xong: xóa tin nhắn (idempotent, kể cả khi lease đã bị lấy lại)"""
+        with self.lock:
+            if self._inflight.get(claim.shard) == claim.position:
+                del self._inflight[claim.shard]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                deleted = conn.execute('DELETE FROM messages WHERE id = ?', (claim.position,)).rowcount
+                if deleted:
+                    self._heartbeat(conn, time.time(), completed=1)
+        finally:
+            conn.close()
+        if deleted:
+            self.stats['completed'] += 1
+        else:
+            log.debug("Tin nhắn đã được ack trước đó", extra=fields(id=claim.position))
+
+    def nack(self, claim):
+        """Gửi lỗi: giữ tin nhắn ở đầu lô để thử lại (như dòng đầu file queue)"""
+        with self.lock:
+            self._inflight.pop(claim.shard, None)
+            self._held.setdefault(claim.shard, deque()).appendleft((claim.position, claim.line))
+
+    def release(self, shard_index=None):
+        """Trả lại lease các tin nhắn đang giữ (chưa gửi) cho gateway khác, trả về số tin nhắn"""
+        with self.lock:
+            shards = list(self._held) if shard_index is None else [shard_index]
+            ids = []
+            for index in shards:
+                held = self._held.get(index)
+                if held:
+                    ids.extend((row_id, self.owner(index)) for row_id, _ in held)
+                    held.clear()
+            if not ids:
+                return 0
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany('UPDATE messages SET owner = NULL, lease_until = 0 WHERE id = ? AND owner = ?', ids)
+            finally:
+                conn.close()
+        self.stats['released'] += len(ids)
+        log.info("Trả lại tin nhắn chưa gửi", extra=fields(node=self.node, count=len(ids)))
+        return len(ids)
+
+    def set_paused(self, shard_index, paused):
+        """Sender tạm dừng (mất sóng): trả lại lô đang giữ để gateway khác gửi ngay"""
+        if paused:
+            self.release(shard_index)
+
+    # --- trạng thái ---
+
+    def drain_path(self, shard_index=0):
+        """File tốc độ gửi (DrainMeter) của sender, cạnh database để mọi gateway cùng đọc"""
+        return f"{self.path}.drain-{self.node}-{shard_index}"
+
+    def drain_paths(self):
+        return [path for path in glob.glob(glob.escape(self.path) + '.drain-*') if not path.endswith('.tmp')]
+
+    def records(self, phone=None, since=None, until=None):
+        """Duyệt lười tin nhắn chưa gửi xong (cursor SQLite), lọc theo số nhận/thời điểm thêm vào"""
+        since, until = as_datetime(since), as_datetime(until)
+        query, args = 'SELECT id, line, created FROM messages WHERE 1', []
+        if phone:
+            query, args = query + ' AND phone = ?', args + [phone]
+        if since:
+            query, args = query + ' AND created >= ?', args + [since.timestamp()]
+        if until:
+            query, args = query + ' AND created <= ?', args + [until.timestamp()]
+        conn = self._connect()
+        try:
+            for row_id, line, created in conn.execute(query + ' ORDER BY id', args):
+                item = QueueRecord.parse(line, row_id)
+                if item is not None:
+                    item.timestamp = datetime.fromtimestamp(created).isoformat(sep=' ', timespec='seconds')
+                    yield item
+        finally:
+            conn.close()
+
+    def counts(self):
+        return [self.count()]
+
+    def count(self):
+        """Số tin nhắn chưa gửi xong (kể cả đang được giữ)"""
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        finally:
+            conn.close()
+
+    def status(self, now=None):
+        """Số tin nhắn chờ/đang giữ/lease hết hạn và số liệu từng gateway"""
+        now = now or time.time()
+        conn = self._connect()
+        try:
+            waiting, = conn.execute('SELECT COUNT(*) FROM messages WHERE lease_until = 0').fetchone()
+            expired, = conn.execute('SELECT COUNT(*) FROM messages WHERE lease_until > 0 AND lease_until <= ?',
+                                    (now,)).fetchone()
+            held = dict(conn.execute('SELECT owner, COUNT(*) FROM messages WHERE lease_until > ? GROUP BY owner',
+                                     (now,)))
+            nodes = [{'name': name, 'heartbeat': heartbeat, 'claimed': claimed, 'completed': completed,
+                      'reclaimed': reclaimed}
+                     for name, heartbeat, claimed, completed, reclaimed in
+                     conn.execute('SELECT name, heartbeat, claimed, completed, reclaimed FROM nodes ORDER BY name')]
+        finally:
+            conn.close()
+        return {'waiting': waiting, 'expired': expired, 'held': held, 'nodes': nodes}
+
+    # Cùng vòng đời với ShardedFileQueue: không có segment để dọn, đóng thì trả lại lô đang giữ
+
+    def compact(self):
+        return 0
+
+    def start_compactor(self, interval=60):
+        pass
+
+    def stop_compactor(self):
+        pass
+
+    def close(self):
+        """Dừng gửi: trả lại lô đang giữ cho gateway khác"""
+        self.release()
+
+
+def _bench_node(path, node, send_time, result_queue):
+    """Một gateway giả: claim/ack tới khi queue rỗng, mỗi tin nhắn mất send_time giây"""
+    queue = LeasedQueue(path, node=node)
+    sent = 0
+    while True:
+        claim = queue.next_job()
+        if claim is None:
+            break
+        time.sleep(send_time)
+        queue.ack(claim)
+        sent += 1
+    result_queue.put((node, sent))
+
+
+def bench(count=2000, nodes=(1, 2, 4), send_time=0.005):
+    """Tin nhắn/giây theo số gateway (process) cùng claim một database, mỗi tin gửi mất send_time giây"""
+    import tempfile
+    import multiprocessing as mp
+    from sms_records import OutboundJob
+
+    results = {}
+    for node_count in nodes:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cluster.db')
+            queue = LeasedQueue(path)
+            queue.append_many((OutboundJob(f'849{i:08d}', f'Tin nhắn {i}').to_line(), f'849{i:08d}')
+                              for i in range(count))
+            result_queue = mp.Queue()
+            workers = [mp.Process(target=_bench_node, args=(path, f'node{i}', send_time, result_queue))
+                       for i in range(node_count)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            sent = dict(result_queue.get() for _ in workers)
+            elapsed = time.perf_counter() - start
+            for worker in workers:
+                worker.join()
+            remaining = queue.count()
+        results[node_count] = sum(sent.values()) / elapsed
+        print(f"🖧 {node_count} gateway: {sum(sent.values())}/{count} tin trong {elapsed:.2f}s "
+              f"({results[node_count]:,.0f} tin/giây, x{results[node_count] / results[nodes[0]]:.2f}), "
+              f"còn lại {remaining}, chia {sorted(sent.values())}")
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 2000,
+              tuple(int(n) for n in sys.argv[3].split(',')) if len(sys.argv) > 3 else (1, 2, 4),
+              float(sys.argv[4]) if len(sys.argv) > 4 else 0.005)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'status':
+        path = sys.argv[2] if len(sys.argv) > 2 else CLUSTER_QUEUE
+        status = LeasedQueue(path).status()
+        print(f"📊 Chờ: {status['waiting']}, lease hết hạn: {status['expired']}, "
+              f"đang giữ: {sum(status['held'].values())}")
+        for owner, held in sorted(status['held'].items()):
+            print(f"   🔒 {owner}: {held}")
+        for node in status['nodes']:
+            print(f"   🖥️ {node['name']}: đã gửi {node['completed']}, claim {node['claimed']}, "
+                  f"lấy lại {node['reclaimed']}, heartbeat {time.time() - node['heartbeat']:.0f}s trước")
+    else:
+        print("Sử dụng:")
+        print("  python sms_cluster.py status [database]                   # Trạng thái queue dùng chung (SMS_CLUSTER_QUEUE)")
+        print("  python sms_cluster.py bench [số_tin] [1,2,4] [giây/tin]   # Tin/giây theo số gateway")
@@ -0,0 +1,128 @@
+import os
+import re
+import mmap
+import time
+import struct
+import hashlib
+from sms_queue import file_lock
+
+# Slot: digest 16 byte + thời điểm hết hạn (0: chưa dùng)
+SLOT = struct.Struct('<16sd')
+MAX_PROBE = 32
+DEFAULT_CAPACITY = 1 << 16
+IDEMPOTENCY_TTL = 24 * 3600
+# Cửa sổ chống trùng theo nội dung (số + tin nhắn) khi không có idempotency key, 0: tắt
+DEFAULT_WINDOW = float(os.environ.get('SMS_DEDUPE_WINDOW', '0'))
+
+NON_DIGIT_RE = re.compile(r'\D')
+
+
+def normalize_phone(phone_number):
+    """+84 912..., 84912... và 0912... là cùng một số"""
+    digits = NON_DIGIT_RE.sub('', phone_number)
+    return '0' + digits[2:] if digits.startswith('84') else digits
+
+
+def dedupe_path(queue_file, queue_dir=None):
+    return os.path.join(queue_dir, 'dedupe') if queue_dir else queue_file + '.dedupe'
+
+
+class DedupeIndex:
+    """Bảng băm kích thước cố định trên file (mmap) dùng chung giữa các process
+
+    Mỗi key chiếm một slot tới khi hết hạn; tra cứu/ghi O(1) (dò tối đa MAX_PROBE slot).
+    Khi vùng dò đầy, slot sắp hết hạn nhất bị ghi đè nên bộ nhớ luôn bị chặn.
+    """
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if size < SLOT.size:
+                size = capacity * SLOT.size
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # File đã có thì dùng kích thước của nó để mọi process băm giống nhau
+        self.capacity = size // SLOT.size
+        self.stats = {'checked': 0, 'duplicates': 0, 'evicted': 0}
+
+    @staticmethod
+    def key(phone_number, message, idempotency_key=None):
+        if idempotency_key:
+            raw = 'k\0' + str(idempotency_key)
+        else:
+            raw = 'c\0' + normalize_phone(phone_number) + '\0' + message.strip()
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+
+    def claim(self, phone_number, message, idempotency_key=None, window=DEFAULT_WINDOW):
+        """Ghi nhận tin nhắn sắp thêm vào queue, False nếu trùng tin nhắn còn trong cửa sổ"""
+        return self.claim_many([(phone_number, message, idempotency_key)], window)[0]
+
+    def claim_many(self, items, window=DEFAULT_WINDOW):
+        """claim cho cả lô (phone, message, idempotency_key) trong một lần khóa"""
+        now = time.time()
+        results = []
+        with file_lock(self.path):
+            for phone_number, message, idempotency_key in items:
+                ttl = IDEMPOTENCY_TTL if idempotency_key else window
+                if not ttl:
+                    results.append(True)
+                    continue
+                results.append(self._claim(self.key(phone_number, message, idempotency_key), now, now + ttl))
+        self.stats['checked'] += len(results)
+        self.stats['duplicates'] += results.count(False)
+        return results
+
+    def release(self, phone_number, message, idempotency_key=None):
+        """Bỏ ghi nhận (thêm vào queue thất bại/bị từ chối) để lần thử lại không bị coi là trùng"""
+        self.release_many([(phone_number, message, idempotency_key)])
+
+    def release_many(self, items):
+        """release cho cả lô (phone, message, idempotency_key) trong một lần khóa"""
+        now = time.time()
+        with file_lock(self.path):
+            for phone_number, message, idempotency_key in items:
+                digest = self.key(phone_number, message, idempotency_key)
+                slot = self._find(digest, now)
+                if slot is not None:
+                    # Không xóa về 0 để không cắt chuỗi dò của các key phía sau
+                    SLOT.pack_into(self.map, slot * SLOT.size, digest, 1.0)
+
+    def _slots(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self.capacity
+        for i in range(min(MAX_PROBE, self.capacity)):
+            slot = (start + i) % self.capacity
+            stored, expiry = SLOT.unpack_from(self.map, slot * SLOT.size)
+            yield slot, stored, expiry
+            if expiry == 0:
+                return  # slot chưa từng dùng: key không nằm ở các slot sau
+
+    def _find(self, digest, now):
+        for slot, stored, expiry in self._slots(digest):
+            if stored == digest and expiry > now:
+                return slot
+        return None
+
+    def _claim(self, digest, now, expiry):
+        free = oldest = None
+        for slot, stored, stored_expiry in self._slots(digest):
+            if stored_expiry <= now:
+                if free is None:
+                    free = slot
+            elif stored == digest:
+                return False
+            elif oldest is None or stored_expiry < oldest[1]:
+                oldest = (slot, stored_expiry)
+        if free is None:
+            free = oldest[0]
+            self.stats['evicted'] += 1
+        SLOT.pack_into(self.map, free * SLOT.size, digest, expiry)
+        return True
+
+    def close(self):
+        self.map.close()
@@ -322,253 +322,471 @@
 #         print("Không thể kết nối tới modem!")
 
 #========================================================================================
-import serial
 import time
-import re
+import glob
 import random
 import threading
 import os
-from smspdudecoder.fields import SMSDeliver
-from io import StringIO
-from collections import defaultdict
-from datetime import timezone, timedelta
+import logging
+from datetime import datetime
+from pdu_encoder import PDUEncoder
+from sms_queue import ShardedFileQueue
+from sms_cluster import CLUSTER_QUEUE, LeasedQueue
+from sms_dedupe import DEFAULT_WINDOW, DedupeIndex, dedupe_path
+from sms_records import BatchEnqueueResult, EnqueueResult, OutboundJob
+from sms_admission import AdmissionController, DrainMeter
+from sms_schedule import ReleaseWindow, SendScheduler, parse_send_at, schedule_path
+from sms_store import DEFAULT_STORE_PATH, SMSStore
+from sms_inbound import PDU_LINE_RE, SMSReassembler, decode_pdu, parse_pdu_raw
+from sms_health import HEALTH_PREFIXES, STEAL_MIN_SCORE, HealthSampler, ModemHealth
+from sms_pacing import SendPacer
+from sms_arbiter import CommandArbiter
+from sms_checkpoint import REASSEMBLY_CHECKPOINT
+from sms_stored import STORED_SEND, StoredSender
+from sms_trace import RecordingSerial, trace_path_for
+from sms_logging import fields, get_logger, setup_logging
+
+log = get_logger('handler')
+
+def cms_error_code(reply):
+    """Mã lỗi từ '+CMS ERROR: <n>', -1 nếu không có mã"""
+    _, _, code = reply.partition(':')
+    code = code.strip()
+    return int(code) if code.isdigit() else -1
+
+
+def stable_port_path(port):
+    """Symlink udev /dev/serial/by-id trỏ tới cổng (không đổi khi USB re-enumerate), không có thì giữ nguyên"""
+    if port.startswith('/dev/serial/'):
+        return port
+    real = os.path.realpath(port)
+    for link in sorted(glob.glob('/dev/serial/by-id/*')):
+        if os.path.realpath(link) == real:
+            return link
+    return port
+
+
+# Chuyển tin nhắn đến thẳng ra serial dạng +CMT (không lưu vào SIM)
+CNMI_SETTING = '2,2,0,0,0'
+
+ACK_TIMEOUT = 60
+
+# Thư mục queue bền vững (ví dụ /var/spool/sms), không đặt thì dùng /tmp/sms_queue.txt
+QUEUE_DIR = os.environ.get('SMS_QUEUE_DIR')
+# File luật trả lời tự động (sms_autoreply.py), không đặt thì không bật
+AUTOREPLY_RULES = os.environ.get('SMS_AUTOREPLY_RULES')
 
 class SimpleSMSHandler:
-    def __init__(self, port='/dev/ttyUSB2', baudrate=115200, timeout=3, queue_file='/tmp/sms_queue.txt'):
+    def __init__(self, port='/dev/ttyUSB2', baudrate=115200, timeout=3, queue_file='/tmp/sms_queue.txt',
+                 queue_shards=1, shard_index=0, store_path=None, store_retention_days=None, webhook_url=None,
+                 queue_dir=None, dedupe_window=None, pacer=None, transport=None, trace_path=None, admission=None,
+                 autoreply_rules=None, cluster_queue=None, stored_send=None, reassembly_checkpoint=None):
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
         self.queue_file = queue_file
+        # queue_shards=None: tự phát hiện số shard đang có trên đĩa
+        # queue_dir: lưu queue dạng thư mục segment (bền vững, tự xoay/dọn); None: dùng queue_file
+        self.queue_dir = queue_dir
+        # cluster_queue: database queue dùng chung cho nhiều gateway (claim theo lease) thay cho file queue
+        self.cluster_queue = cluster_queue
+        if cluster_queue:
+            self.file_queue = LeasedQueue(cluster_queue)
+        else:
+            self.file_queue = ShardedFileQueue(queue_file, queue_shards, queue_dir=queue_dir)
+        # Chống trùng khi thêm vào queue (idempotency key hoặc nội dung trong dedupe_window giây)
+        self.dedupe_window = DEFAULT_WINDOW if dedupe_window is None else dedupe_window
+        self._dedupe = None
+        # Giới hạn độ sâu/thời gian chờ/quota khi thêm tin nhắn; drain: tốc độ gửi đo được của modem này
+        self.admission = admission or AdmissionController(queue_file, queue_dir,
+                                                          queue=self.file_queue if cluster_queue else None)
+        self.shard_index = shard_index
+        self.drain = DrainMeter(self.file_queue.drain_path(shard_index))
+        # Tin nhắn hẹn giờ (send_at/throttle) nằm trong scheduler tới khi đến hạn
+        self._scheduler = None
+        # Thread gửi đang chờ việc được đánh thức khi scheduler nhả tin nhắn
+        self.wakeup = threading.Event()
+        self._current_job = None
         self.ser = None
+        # Hàm mở cổng transport(path, baudrate, timeout=...), mặc định serial.Serial (ReplaySerial.transport để phát lại trace)
+        self.transport = transport
+        # Ghi mọi byte đọc/ghi trên cổng vào file trace (sms_trace.py dump/bench/replay)
+        self.trace_path = trace_path
+        # Đường dẫn ổn định (/dev/serial/by-id) của cổng, dùng khi mở lại sau khi USB re-enumerate
+        self.device_path = None
+        self.connected = threading.Event()
+        self.stats = {'reconnects': 0, 'reconnect_attempts': 0, 'last_reconnect_ms': None, 'downtime_s': 0.0}
+        # Mọi lệnh AT sau khi kết nối đi qua arbiter; ser_lock chỉ giữ khi ghi và khi mở lại cổng
+        self.ser_lock = threading.Lock()
+        self.arbiter = CommandArbiter(self)
+        self.health = ModemHealth(port)
+        self.health_sampler = None
+        # Tốc độ gửi tự điều chỉnh theo độ trễ ack và +CMS ERROR của modem
+        self.pacer = pacer or SendPacer(port)
+        # Vòng đọc tách dòng từ _rx_buffer; _expect_pdu: hàm nhận dòng PDU sau +CMT/+CDS
+        self._rx_buffer = bytearray()
+        self._expect_pdu = None
+        self._paused = False
+        self.iccid = None
+        self.imsi = None
         self.is_listening = False
-        self.multipart_messages = defaultdict(lambda: defaultdict(dict))
-        self.pending_messages = defaultdict(list)
+        # reassembly_checkpoint: lưu các phần đang chờ ghép, khởi động lại không mất phần nào
+        self.reassembler = SMSReassembler(checkpoint_path=reassembly_checkpoint)
+        self.multipart_messages = self.reassembler.multipart_messages
+        self.pending_messages = self.reassembler.pending_messages
+        # Lưu tin nhắn đến vào SQLite để tra cứu sau
+        self.store = None
+        if store_path:
+            self.store = SMSStore(store_path, retention_days=store_retention_days)
+            self.reassembler.add_sink(self.store.add)
+        # Đẩy tin nhắn đến lên backend qua webhook
+        self.webhook = None
+        if webhook_url:
+            from sms_webhook import WebhookForwarder
+            self.webhook = WebhookForwarder(webhook_url)
+            self.reassembler.add_sink(self.webhook.add)
+        # Trả lời tự động theo file luật (nạp lại khi file đổi), tin trả lời vào thẳng queue gửi
+        self.autoreply = None
+        if autoreply_rules:
+            from sms_autoreply import AutoReplyEngine
+            self.autoreply = AutoReplyEngine(autoreply_rules, self.add_to_queue)
+            self.reassembler.add_sink(self.autoreply.add)
+        self.pdu_encoder = PDUEncoder()
+        # Nội dung lặp lại (broadcast) gửi từ bộ nhớ modem bằng AT+CMSS thay vì đẩy lại cả PDU
+        self.stored = StoredSender(self) if (STORED_SEND if stored_send is None else stored_send) else None
         
     def connect(self):
-        """Kết nối tới modem"""
+        """Kết nối tới modem: thăm dò bằng AT/ATE0, cấu hình PDU + CNMI rồi kiểm tra lại"""
+        transport = self.transport
+        if transport is None:
+            import serial  # chỉ service mới cần pyserial, send/status không phải chờ import
+            transport = serial.Serial
+        start = time.perf_counter()
+        if self.device_path is None:
+            self.device_path = stable_port_path(self.port) if self.transport is None else self.port
         try:
-            self.ser = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
-            self.ser.write(b'AT+CMGF=0\r')
-            time.sleep(1)
-            self.ser.write(b'AT+CNMI=2,2,0,0,0\r')
-            time.sleep(1)
-            print(f"✅ Đã kết nối tới modem trên {self.port}")
+            self.ser = transport(self.device_path, self.baudrate, timeout=self.timeout)
+            if self.trace_path:
+                self.ser = RecordingSerial(self.ser, self.trace_path)
+            self._rx_buffer.clear()
+            self._expect_pdu = None
+            if not self._probe():
+                raise IOError("modem không trả lời AT")
+            if not self.configure():
+                raise IOError("không cấu hình được PDU mode/CNMI")
+            log.info("Đã kết nối tới modem", extra=fields(
+                modem=self.port, device=self.device_path, latency_ms=round((time.perf_counter() - start) * 1000)))
+            self.connected.set()
             return True
         except Exception as e:
-            print(f"❌ Lỗi kết nối modem: {e}")
+            log.error("Lỗi kết nối modem: %s", e, extra=fields(modem=self.port, device=self.device_path))
+            if self.ser and self.ser.is_open:
+                self.ser.close()
             return False
     
+    def _probe(self, attempts=10):
+        """Bỏ dữ liệu cũ trong buffer, gửi AT tới khi modem trả OK rồi tắt echo"""
+        for _ in range(attempts):
+            if self.query('AT', timeout=0.3) is not None:
+                return self.query('ATE0', timeout=1) is not None
+        return False
+    
+    def configure(self):
+        """Đặt PDU mode và CNMI trong một lệnh, đọc lại để kiểm tra"""
+        if self.query(f'AT+CMGF=0;+CNMI={CNMI_SETTING}') is None:
+            # Firmware không nhận lệnh ghép: gửi từng lệnh
+            if self.query('AT+CMGF=0') is None or self.query(f'AT+CNMI={CNMI_SETTING}') is None:
+                return False
+        settings = self.query('AT+CMGF?;+CNMI?')
+        if settings is None:
+            settings = (self.query('AT+CMGF?') or []) + (self.query('AT+CNMI?') or [])
+        return '+CMGF: 0' in settings and f'+CNMI: {CNMI_SETTING}' in settings
+    
+    def query(self, command, timeout=2):
+        """Gửi lệnh AT và đọc các dòng trả lời tới OK/ERROR (chỉ dùng khi chưa chạy vòng đọc, sau đó dùng arbiter)"""
+        self.ser.reset_input_buffer()
+        self.ser.write(f'{command}\r'.encode())
+        lines = []
+        deadline = time.time() + timeout
+        read_timeout, self.ser.timeout = self.ser.timeout, timeout
+        try:
+            while time.time() < deadline:
+                line = self.ser.readline().decode(errors='ignore').strip()
+                if not line or line == command:
+                    continue
+                if line == 'OK' or 'ERROR' in line:
+                    return lines if line == 'OK' else None
+                lines.append(line)
+        finally:
+            self.ser.timeout = read_timeout
+        return None
+    
+    def _arbiter_query(self, command, prefixes=()):
+        result = self.arbiter.execute(command, prefixes=prefixes)
+        return result.lines if result.ok else None
+    
+    def read_sim_info(self, arbiter=False):
+        """Đọc ICCID và IMSI của SIM đang cắm (arbiter=True: khi vòng đọc đã chạy)"""
+        self.iccid = self.imsi = None
+        try:
+            if arbiter:
+                iccid_lines, imsi_lines = self._arbiter_query('AT+CICCID', ('+ICCID:',)), self._arbiter_query('AT+CIMI')
+            else:
+                iccid_lines, imsi_lines = self.query('AT+CICCID'), self.query('AT+CIMI')
+            for line in iccid_lines or []:
+                if line.startswith('+ICCID:'):
+                    self.iccid = line.split(':', 1)[1].strip()
+            for line in imsi_lines or []:
+                if line.isdigit():
+                    self.imsi = line
+            log.info("Thông tin SIM", extra=fields(modem=self.port, iccid=self.iccid, imsi=self.imsi))
+        except Exception as e:
+            log.warning("Không đọc được thông tin SIM: %s", e, extra=fields(modem=self.port))
+        return self.iccid, self.imsi
+    
     def disconnect(self):
         """Ngắt kết nối modem"""
+        self.connected.clear()
+        self.arbiter.abort()
         if self.ser and self.ser.is_open:
             self.ser.close()
-            print("✅ Đã ngắt kết nối modem")
+            log.info("Đã ngắt kết nối modem", extra=fields(modem=self.port))
+    
+    def reconnect(self, max_delay=60):
+        """Mở lại cổng với backoff tới khi được hoặc dừng nghe
+        
+        Bộ ghép tin nhắn và queue nằm trong bộ nhớ của handler nên được giữ nguyên;
+        tin nhắn đang gửi dở chưa được ack nên sẽ được gửi lại từ queue.
+        """
+        self.connected.clear()
+        self.arbiter.abort()
+        start = time.perf_counter()
+        delay = 1
+        while self.is_listening:
+            self.stats['reconnect_attempts'] += 1
+            with self.ser_lock:
+                try:
+                    if self.ser:
+                        self.ser.close()
+                except Exception:
+                    pass
+                if self.connect():
+                    elapsed = time.perf_counter() - start
+                    self.stats['reconnects'] += 1
+                    self.stats['last_reconnect_ms'] = round(elapsed * 1000)
+                    self.stats['downtime_s'] += elapsed
+                    log.warning("Đã kết nối lại modem", extra=fields(
+                        modem=self.port, device=self.device_path, reconnect_ms=self.stats['last_reconnect_ms'],
+                        reconnects=self.stats['reconnects']))
+                    return True
+            # Thêm nhiễu để nhiều modem trên cùng hub USB không thử lại cùng lúc
+            time.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, max_delay)
+        return False
     
     def _send_pdu_sms(self, phone_number, message):
-        """Gửi SMS bằng PDU mode"""
+        """Gửi SMS bằng PDU mode, khoảng cách giữa các segment do self.pacer quyết định"""
+        if self.stored is not None:
+            sent = self.stored.send(phone_number, message)
+            if sent is not None:
+                return sent
+        start = time.perf_counter()
+        ref_number = random.randint(0, 255)
+        self.pacer.wait()
         try:
-            print(f"📤 Đang gửi tin nhắn tới {phone_number}")
+            # Dựng PDU (segment và số điện thoại được cache cho template lặp lại)
+            pdus = self.pdu_encoder.build_pdus(phone_number, message, ref_number)
+            total_parts = len(pdus)
             
-            # Chuẩn hóa số điện thoại
-            phone_number = phone_number.lstrip("+").replace(" ", "")
-            if len(phone_number) % 2 != 0:
-                phone_number += 'F'
-            swapped_number = ''.join([phone_number[i+1] + phone_number[i] for i in range(0, len(phone_number), 2)])
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Bắt đầu gửi tin nhắn", extra=fields(
+                    modem=self.port, phone=phone_number, ref=ref_number, parts=total_parts, chars=len(message)))
             
-            max_single_length = 70
-            if len(message) <= max_single_length:
-                # Tin nhắn đơn
-                ucs2_msg = message.encode('utf-16-be').hex().upper()
-                pdu_length = len(ucs2_msg) // 2
-                
-                pdu = "001100"
-                pdu += f"0C91{swapped_number}0008AA{pdu_length:02X}{ucs2_msg}"
-                
-                self.ser.write(b'AT+CMGF=0\r')
-                time.sleep(0.5)
-                pdu_length_for_cmgs = (len(pdu) // 2) - 1
-                cmd = f'AT+CMGS={pdu_length_for_cmgs}\r'
-                self.ser.write(cmd.encode())
-                time.sleep(0.5)
-                self.ser.write((pdu + "\x1a").encode())
-                time.sleep(2)
-                
-                print(f"✅ Đã gửi tin nhắn đơn thành công")
-            else:
-                # Tin nhắn multipart
-                max_part_length = 67
-                total_parts = (len(message) + max_part_length - 1) // max_part_length
-                ref_number = random.randint(0, 255)
-                
-                print(f"📤 Gửi tin nhắn dài ({len(message)} ký tự) thành {total_parts} phần")
-                
-                for part_num in range(1, total_parts + 1):
-                    start = (part_num - 1) * max_part_length
-                    end = start + max_part_length
-                    part = message[start:end]
-                    
-                    udh = [0x05, 0x00, 0x03, ref_number, total_parts, part_num]
-                    udh_hex = ''.join(f"{x:02X}" for x in udh)
-                    
-                    ucs2_part = part.encode('utf-16-be').hex().upper()
-                    user_data = udh_hex + ucs2_part
-                    user_data_length = len(user_data) // 2
-                    
-                    pdu = "005100"
-                    pdu += f"0C91{swapped_number}0008AA{user_data_length:02X}{user_data}"
-                    
-                    self.ser.write(b'AT+CMGF=0\r')
-                    time.sleep(0.5)
-                    pdu_length_for_cmgs = (len(pdu) // 2) - 1
-                    cmd = f'AT+CMGS={pdu_length_for_cmgs}\r'
-                    self.ser.write(cmd.encode())
-                    time.sleep(0.5)
-                    self.ser.write((pdu + "\x1a").encode())
-                    time.sleep(3)
-                    
-                    print(f"  ✅ Đã gửi phần {part_num}/{total_parts}")
+            for part_num, (pdu, pdu_length_for_cmgs) in enumerate(pdus, 1):
+                if part_num > 1:
+                    self.pacer.wait()
+                part_start = time.perf_counter()
+                error = self._send_segment(pdu, pdu_length_for_cmgs)
+                if error:
+                    log.warning("Modem từ chối segment", extra=fields(
+                        modem=self.port, phone=phone_number, ref=ref_number, segment=f"{part_num}/{total_parts}",
+                        error=error))
+                    return False
                 
-                print(f"✅ Hoàn thành gửi tin nhắn multipart")
-            
-            # Khôi phục chế độ nhận tin nhắn
-            self.ser.write(b'AT+CNMI=2,2,0,0,0\r')
-            time.sleep(0.5)
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Đã gửi segment", extra=fields(
+                        modem=self.port, phone=phone_number, ref=ref_number, segment=f"{part_num}/{total_parts}",
+                        latency_ms=round((time.perf_counter() - part_start) * 1000)))
             
+            log.info("Đã gửi tin nhắn", extra=fields(
+                modem=self.port, phone=phone_number, ref=ref_number, parts=total_parts,
+                latency_ms=round((time.perf_counter() - start) * 1000)))
             return True
-            
+        
         except Exception as e:
-            print(f"❌ Lỗi gửi SMS: {e}")
+            log.error("Lỗi gửi SMS: %s", e, extra=fields(modem=self.port, phone=phone_number, ref=ref_number))
             return False
     
+    def _send_segment(self, pdu, cmgs_length):
+        """Gửi một segment qua arbiter (chờ '>' rồi +CMGS/+CMS ERROR), trả về None nếu thành công"""
+        command = self.arbiter.execute(f'AT+CMGS={cmgs_length}', prefixes=('+CMGS:',),
+                                       data=(pdu + "\x1a").encode(), timeout=ACK_TIMEOUT)
+        if command.data_written_at is None:
+            if command.result is None:
+                self.pacer.record(command.prompt_timeout, timeout=True)
+            else:
+                self.pacer.record(0, error_code=cms_error_code(command.result))
+            return command.result or command.error or 'không có dấu nhắc >'
+        
+        self.pacer.sent(command.data_written_at)
+        if command.result is None:
+            self.pacer.record(time.time() - command.data_written_at, timeout=True)
+            return command.error or 'không có +CMGS'
+        latency = command.finished_at - command.data_written_at
+        if command.ok:
+            self.pacer.record(latency)
+            return None
+        self.pacer.record(latency, error_code=cms_error_code(command.result))
+        return command.result
+    
     def _process_file_queue(self):
         """Xử lý hàng đợi tin nhắn từ file"""
+        # Cờ tạm dừng còn sót lại nếu process trước dừng đột ngột
+        self.file_queue.set_paused(self.shard_index, False)
         while self.is_listening:
             try:
-                if os.path.exists(self.queue_file):
-                    with open(self.queue_file, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()
+                # Đang kết nối lại: giữ nguyên tin nhắn trong queue
+                if not self.connected.wait(timeout=1):
+                    continue
+                
+                # Modem mất sóng: tạm dừng shard để modem khác lấy hết tin nhắn, kể cả dòng đầu
+                if not self.health.healthy:
+                    if not self._paused:
+                        self.file_queue.set_paused(self.shard_index, True)
+                        self._paused = True
+                        log.warning("Tạm dừng gửi tin nhắn", extra=fields(modem=self.port, shard=self.shard_index))
+                    time.sleep(5)
+                    continue
+                if self._paused:
+                    self.file_queue.set_paused(self.shard_index, False)
+                    self._paused = False
+                    log.info("Tiếp tục gửi tin nhắn", extra=fields(modem=self.port, shard=self.shard_index))
+                
+                # Sóng yếu: chỉ gửi shard của mình, không nhận thêm việc của modem khác
+                claim = self.file_queue.next_job(self.shard_index, steal=self.health.score >= STEAL_MIN_SCORE)
+                if claim is None:
+                    if self.stored is not None and self.stored.templates:
+                        # Hết đợt broadcast: xóa các ô nhớ modem đã ghi
+                        self.stored.flush()
+                    self.drain.publish()
+                    self.wakeup.wait(1)
+                    self.wakeup.clear()
+                    continue
+                
+                # Chỉ parse lại khi dòng đầu queue thay đổi (không parse lại khi thử lại)
+                job = self._current_job
+                if job is None or job.line != claim.line:
+                    job = self._current_job = OutboundJob.parse(claim.line)
+                
+                if job is not None:
+                    if claim.stolen:
+                        log.info("Lấy tin nhắn từ shard khác", extra=fields(
+                            modem=self.port, phone=job.phone, shard=self.shard_index))
                     
-                    if lines:
-                        line = lines[0].strip()
-                        if '|' in line:
-                            phone_number, message = line.split('|', 1)
-                            
-                            if self._send_pdu_sms(phone_number, message):
-                                # Xóa tin nhắn đã gửi thành công
-                                remaining_lines = lines[1:]
-                                with open(self.queue_file, 'w', encoding='utf-8') as f:
-                                    f.writelines(remaining_lines)
-                            else:
-                                time.sleep(10)  # Chờ 10 giây trước khi thử lại
-                        else:
-                            # Dòng không hợp lệ, xóa nó
-                            remaining_lines = lines[1:]
-                            with open(self.queue_file, 'w', encoding='utf-8') as f:
-                                f.writelines(remaining_lines)
+                    start = time.monotonic()
+                    if self._send_pdu_sms(job.phone, job.message):
+                        # Xóa tin nhắn đã gửi thành công
+                        self.file_queue.ack(claim)
+                        self._current_job = None
+                        self.drain.record(time.monotonic() - start)
                     else:
-                        time.sleep(1)
+                        self.file_queue.nack(claim)
+                        time.sleep(10)  # Chờ 10 giây trước khi thử lại
+                        self.drain.record(time.monotonic() - start, ok=False)
                 else:
-                    time.sleep(1)
+                    # Dòng không hợp lệ, xóa nó
+                    self.file_queue.ack(claim)
             except Exception as e:
-                print(f"❌ Lỗi xử lý file queue: {e}")
+                log.error("Lỗi xử lý file queue: %s", e, extra=fields(modem=self.port))
                 time.sleep(5)
     
     def parse_pdu_raw(self, pdu_hex):
         """Phân tích PDU thô để tìm thông tin multipart"""
-        try:
-            pdu_bytes = bytes.fromhex(pdu_hex)
-            smsc_len = pdu_bytes[0]
-            offset = 1 + smsc_len
-            
-            pdu_type = pdu_bytes[offset]
-            udhi = (pdu_type & 0x40) != 0
-            
-            if not udhi:
-                return None
-                
-            offset += 1
-            sender_len = pdu_bytes[offset]
-            offset += 1
-            offset += 1  # sender type
-            
-            sender_digits = (sender_len + 1) // 2
-            offset += sender_digits
-            offset += 1  # PID
-            offset += 1  # DCS
-            offset += 7  # Timestamp
-            
-            udl = pdu_bytes[offset]
-            offset += 1
-            
-            if offset < len(pdu_bytes):
-                udhl = pdu_bytes[offset]
-                offset += 1
-                
-                udh_end = offset + udhl
-                while offset < udh_end:
-                    iei = pdu_bytes[offset]
-                    offset += 1
-                    iedl = pdu_bytes[offset]
-                    offset += 1
-                    
-                    if iei == 0x00 and iedl == 3:
-                        ref_num = pdu_bytes[offset]
-                        total_parts = pdu_bytes[offset + 1]
-                        seq_num = pdu_bytes[offset + 2]
-                        return (ref_num, total_parts, seq_num)
-                    
-                    offset += iedl
-            
-            return None
-        except Exception as e:
-            print(f"❌ Lỗi phân tích PDU: {e}")
-            return None
+        return parse_pdu_raw(pdu_hex)
     
     def _check_pending_messages(self):
         """Kiểm tra và xử lý tin nhắn đang chờ"""
-        current_time = time.time()
-        
-        for sender in list(self.pending_messages.keys()):
-            if sender not in self.pending_messages:
-                continue
-                
-            messages = self.pending_messages[sender]
-            if not messages:
-                continue
-            
-            # Kiểm tra tin nhắn cũ nhất
-            oldest_msg = min(messages, key=lambda x: x['timestamp'])
-            
-            # Nếu tin nhắn đã chờ hơn 3 giây, xử lý nó
-            if current_time - oldest_msg['timestamp'] > 3:
-                if len(messages) == 1:
-                    # Tin nhắn đơn
-                    msg = messages[0]
-                    print(f"\n📱 Tin nhắn đơn:")
-                    print(f"Số người gửi: {sender}")
-                    print(f"Thời gian: {msg['time'].strftime('%Y-%m-%d %H:%M:%S')}")
-                    print(f"Nội dung: {msg['content']}\n")
-                else:
-                    # Ghép nhiều tin nhắn
-                    messages.sort(key=lambda x: x['time'])
-                    full_content = ''.join([msg['content'] for msg in messages])
-                    earliest_time = messages[0]['time']
-                    
-                    print(f"\n{'='*60}")
-                    print(f"📨 TIN NHẮN ĐƯỢC GHÉP ({len(messages)} phần)")
-                    print(f"Số người gửi: {sender}")
-                    print(f"Thời gian: {earliest_time.strftime('%Y-%m-%d %H:%M:%S')}")
-                    print(f"Nội dung: {full_content}")
-                    print(f"{'='*60}\n")
-                
-                # Xóa tin nhắn đã xử lý
-                del self.pending_messages[sender]
+        self.reassembler.check_pending()
+    
+    def _handle_pdu(self, pdu_line):
+        """Giải mã PDU vừa nhận và chuyển cho bộ ghép tin nhắn"""
+        try:
+            sender, scts, content, multipart_info = decode_pdu(pdu_line)
+            self.reassembler.add(sender, scts, content, multipart_info)
+        except Exception as e:
+            log.error("Lỗi phân tích PDU: %s", e, extra=fields(modem=self.port, pdu=pdu_line))
+    
+    def _read_loop(self, on_pdu):
+        """Đọc serial, gọi on_pdu(pdu_line) cho mỗi tin nhắn +CMT"""
+        while self.is_listening:
+            try:
+                # read chờ tối đa self.timeout giây khi không có dữ liệu
+                data = self.ser.read(self.ser.in_waiting or 1)
+                if data:
+                    self.feed(data, on_pdu)
+            except Exception as e:
+                if not self.is_listening:
+                    break
+                # USB re-enumerate/rút cáp: mở lại cổng rồi đọc tiếp
+                log.error("Lỗi đọc serial, đang kết nối lại: %s", e, extra=fields(modem=self.port))
+                if not self.reconnect():
+                    break
+    
+    def feed(self, data, on_pdu):
+        """Tách dữ liệu đọc từ serial thành dòng: PDU sau +CMT, trả lời AT+CMGS, mẫu health"""
+        buffer = self._rx_buffer
+        buffer += data
+        while True:
+            end = buffer.find(b'\n')
+            if end < 0:
+                break
+            line = buffer[:end].decode(errors='ignore').strip()
+            del buffer[:end + 1]
+            if line:
+                self._handle_line(line, on_pdu)
+        # Dấu nhắc '> ' của AT+CMGS không có xuống dòng
+        if buffer.strip() == b'>':
+            buffer.clear()
+            self.arbiter.feed_prompt()
+    
+    def _handle_line(self, line, on_pdu):
+        """Dòng PDU chờ sẵn, trả lời của lệnh đang chờ trong arbiter, còn lại là URC"""
+        if self._expect_pdu:
+            handle_pdu, self._expect_pdu = self._expect_pdu, None
+            if PDU_LINE_RE.fullmatch(line):
+                handle_pdu(line)
+                return
+        if self.arbiter.feed_line(line):
+            return
+        if line.startswith('+CMT:'):
+            self._expect_pdu = on_pdu
+        elif line.startswith('+CDS:'):
+            self._expect_pdu = self._handle_status_report
+        elif line.startswith(HEALTH_PREFIXES):
+            # +CREG/+CEREG không được hỏi: modem tự báo thay đổi đăng ký mạng
+            self.health.feed_line(line)
+    
+    def _handle_status_report(self, pdu_line):
+        """Báo cáo trạng thái (+CDS) của tin nhắn đã gửi"""
+        log.info("Báo cáo trạng thái tin nhắn", extra=fields(modem=self.port, pdu=pdu_line))
     
     def listen_sms(self):
         """Lắng nghe tin nhắn SMS"""
-        print("🎯 Đang lắng nghe tin nhắn SMS...")
-        print(f"📁 File queue: {self.queue_file}")
+        log.info("Đang lắng nghe tin nhắn SMS", extra=fields(modem=self.port, queue=self.queue_dir or self.queue_file))
         self.is_listening = True
+        self.file_queue.start_compactor()
+        self.scheduler.start()
+        self.health_sampler = HealthSampler([self]).start()
         
         # Khởi động thread xử lý file queue
         queue_thread = threading.Thread(target=self._process_file_queue, daemon=True)
@@ -578,80 +796,7 @@ class SimpleSMSHandler:
         check_thread = threading.Thread(target=self._periodic_check, daemon=True)
         check_thread.start()
         
-        while self.is_listening:
-            try:
-                line = self.ser.readline()
-                if line:
-                    text = line.decode(errors='ignore').strip()
-                    if text.startswith('+CMT:'):
-                        pdu_line = self.ser.readline().decode(errors='ignore').strip()
-                        if re.fullmatch(r'[0-9A-Fa-f]+', pdu_line):
-                            try:
-                                sms = SMSDeliver.decode(StringIO(pdu_line))
-                                sender = sms['sender']['number']
-                                scts = sms['scts'].astimezone(timezone(timedelta(hours=7)))
-                                content = sms['user_data']['data']
-                                
-                                # Kiểm tra multipart
-                                multipart_info = self.parse_pdu_raw(pdu_line)
-                                
-                                if multipart_info:
-                                    # Xử lý tin nhắn multipart
-                                    ref_num, total_parts, seq_num = multipart_info
-                                    print(f"📱 Nhận phần {seq_num}/{total_parts} (ref: {ref_num}) từ {sender}")
-                                    
-                                    self.multipart_messages[sender][ref_num][seq_num] = content
-                                    
-                                    if 'timestamp' not in self.multipart_messages[sender][ref_num]:
-                                        self.multipart_messages[sender][ref_num]['timestamp'] = scts
-                                    else:
-                                        if scts < self.multipart_messages[sender][ref_num]['timestamp']:
-                                            self.multipart_messages[sender][ref_num]['timestamp'] = scts
-                                    
-                                    received_parts = [k for k in self.multipart_messages[sender][ref_num] if isinstance(k, int)]
-                                    
-                                    if len(received_parts) == total_parts:
-                                        # Ghép tin nhắn hoàn chỉnh
-                                        full_message = ''
-                                        for i in range(1, total_parts + 1):
-                                            if i in self.multipart_messages[sender][ref_num]:
-                                                full_message += self.multipart_messages[sender][ref_num][i]
-                                        
-                                        timestamp = self.multipart_messages[sender][ref_num]['timestamp']
-                                        
-                                        print(f"\n{'='*60}")
-                                        print(f"📨 TIN NHẮN MULTIPART HOÀN CHỈNH")
-                                        print(f"Số người gửi: {sender}")
-                                        print(f"Thời gian: {timestamp.strftime('%Y-%m-%d %H:%M:%S')}")
-                                        print(f"Nội dung: {full_message}")
-                                        print(f"{'='*60}\n")
-                                        
-                                        del self.multipart_messages[sender][ref_num]
-                                else:
-                                    # Tin nhắn có thể là đơn hoặc cần ghép
-                                    print(f"📱 Nhận tin nhắn từ {sender}: '{content}'")
-                                    
-                                    # Thêm vào danh sách chờ
-                                    if sender not in self.pending_messages:
-                                        self.pending_messages[sender] = []
-                                    
-                                    self.pending_messages[sender].append({
-                                        'time': scts,
-                                        'content': content,
-                                        'timestamp': time.time()
-                                    })
-                                    
-                                    # Nếu có nhiều tin nhắn trong thời gian ngắn, chờ thêm
-                                    # Nếu chỉ có 1 tin nhắn, hiển thị sau 1 giây
-                                    
-                            except Exception as e:
-                                print(f"❌ Lỗi phân tích PDU: {e}")
-                                print(f"PDU: {pdu_line}")
-            except Exception as e:
-                if self.is_listening:
-                    print(f"❌ Lỗi đọc serial: {e}")
-                break
-            time.sleep(0.05)
+        self._read_loop(self._handle_pdu)
     
     def _periodic_check(self):
         """Kiểm tra định kỳ tin nhắn chờ"""
@@ -660,35 +805,159 @@ class SimpleSMSHandler:
                 self._check_pending_messages()
                 time.sleep(1)  # Kiểm tra mỗi giây
             except Exception as e:
-                print(f"❌ Lỗi kiểm tra tin nhắn chờ: {e}")
+                log.error("Lỗi kiểm tra tin nhắn chờ: %s", e)
                 time.sleep(1)
     
     def stop_listening(self):
         """Dừng lắng nghe"""
         self.is_listening = False
-        print("⏹️ Đã dừng lắng nghe tin nhắn")
+        self.file_queue.close()
+        if self._scheduler:
+            self._scheduler.stop()
+        if self.health_sampler:
+            self.health_sampler.stop()
+        self.arbiter.stop()
+        if not self.reassembler.close():
+            # Không có checkpoint: xuất nốt thay vì bỏ các phần đang chờ
+            self.reassembler.check_pending(float('inf'))
+        if self.store:
+            self.store.stop()
+        if self.webhook:
+            self.webhook.stop()
+        log.info("Đã dừng lắng nghe tin nhắn", extra=fields(modem=self.port))
+    
+    @property
+    def dedupe(self):
+        """Index chống trùng dùng chung với FileSMSClient và các process khác (chỉ mở khi cần)"""
+        if self._dedupe is None:
+            self._dedupe = DedupeIndex(dedupe_path(self.queue_file, self.queue_dir))
+        return self._dedupe
+    
+    @property
+    def scheduler(self):
+        """Lịch gửi dùng chung với các process khác cùng queue (chỉ mở khi cần)"""
+        if self._scheduler is None:
+            self._scheduler = SendScheduler(schedule_path(self.queue_file, self.queue_dir), self.file_queue,
+                                            on_release=self.wakeup.set)
+        return self._scheduler
+    
+    def _schedule_due(self, send_at, throttle):
+        """Thời điểm đưa vào scheduler (epoch), None nếu thêm thẳng vào queue"""
+        due = parse_send_at(send_at)
+        if due is not None and due <= time.time():
+            due = None
+        # Có throttle mà không hẹn giờ: nhả dần từ bây giờ
+        if due is None and throttle:
+            due = time.time()
+        return due
     
-    def add_to_queue(self, phone_number, message):
-        """Thêm tin nhắn vào file queue"""
+    def add_to_queue(self, phone_number, message, idempotency_key=None, producer=None, send_at=None, throttle=None):
+        """Thêm tin nhắn vào file queue, trả về EnqueueResult
+        
+        duplicate: đã có trong cửa sổ chống trùng; rejected: admission control từ chối
+        (queue đầy, chờ quá lâu hoặc producer hết quota), thử lại sau retry_after giây.
+        send_at (epoch, datetime, ISO hoặc '+30m'): hẹn giờ, kết quả 'scheduled'; throttle: tên
+        ReleaseWindow giới hạn tốc độ nhả. Tin nhắn hẹn giờ không qua admission control (throttle
+        điều tiết lúc chuyển vào queue).
+        """
         try:
-            with open(self.queue_file, 'a', encoding='utf-8') as f:
-                f.write(f"{phone_number}|{message}\n")
-            print(f"✅ Đã thêm tin nhắn vào queue: {phone_number}")
-            return True
+            due = self._schedule_due(send_at, throttle)
+        except ValueError as e:
+            return EnqueueResult(EnqueueResult.ERROR, phone_number, f'send_at không hợp lệ: {e}')
+        check = bool(idempotency_key or self.dedupe_window)
+        try:
+            if check and not self.dedupe.claim(phone_number, message, idempotency_key, self.dedupe_window):
+                log.info("Bỏ qua tin nhắn trùng", extra=fields(phone=phone_number, key=idempotency_key))
+                return EnqueueResult(EnqueueResult.DUPLICATE, phone_number)
         except Exception as e:
-            print(f"❌ Lỗi thêm tin nhắn vào queue: {e}")
-            return False
+            # Index hỏng không được chặn việc gửi tin nhắn
+            log.warning("Lỗi kiểm tra trùng: %s", e, extra=fields(phone=phone_number))
+            check = False
+        if due is not None:
+            try:
+                self.scheduler.add(phone_number, message, due, throttle)
+                return EnqueueResult(EnqueueResult.SCHEDULED, phone_number, send_at=due)
+            except Exception as e:
+                log.error("Lỗi hẹn giờ tin nhắn: %s", e, extra=fields(phone=phone_number))
+                if check:
+                    self.dedupe.release(phone_number, message, idempotency_key)
+                return EnqueueResult(EnqueueResult.ERROR, phone_number, str(e))
+        try:
+            _, rejection = self.admission.admit(1, producer, phone_number)
+        except Exception as e:
+            log.warning("Lỗi kiểm tra admission: %s", e, extra=fields(phone=phone_number))
+            rejection = None
+        if rejection is not None:
+            if check:
+                self.dedupe.release(phone_number, message, idempotency_key)
+            return rejection
+        try:
+            self.file_queue.append(OutboundJob(phone_number, message).to_line(), phone_number)
+            log.debug("Đã thêm tin nhắn vào queue", extra=fields(phone=phone_number, producer=producer))
+            return EnqueueResult(EnqueueResult.QUEUED, phone_number)
+        except Exception as e:
+            log.error("Lỗi thêm tin nhắn vào queue: %s", e, extra=fields(phone=phone_number))
+            if check:
+                self.dedupe.release(phone_number, message, idempotency_key)
+            return EnqueueResult(EnqueueResult.ERROR, phone_number, str(e))
+    
+    def add_many_to_queue(self, messages, producer=None, send_at=None, throttle=None):
+        """Thêm nhiều (phone_number, message[, idempotency_key]) vào file queue trong một lần ghi
+        
+        Trả về BatchEnqueueResult; phần vượt giới hạn admission nằm trong rejected (theo thứ tự).
+        send_at/throttle: cả lô được hẹn giờ trong một transaction (như add_to_queue).
+        Lỗi (send_at không hợp lệ, lỗi ghi): BatchEnqueueResult có error, cả lô chưa được thêm
+        và không bị giữ trong index chống trùng (gửi lại được).
+        """
+        try:
+            due = self._schedule_due(send_at, throttle)
+        except ValueError as e:
+            return BatchEnqueueResult(error=f'send_at không hợp lệ: {e}')
+        items = [(item[0], item[1], item[2] if len(item) > 2 else None) for item in messages]
+        check = bool(self.dedupe_window or any(key for _, _, key in items))
+        kept = items
+        if check:
+            try:
+                fresh = self.dedupe.claim_many(items, self.dedupe_window)
+                kept = [item for item, is_new in zip(items, fresh) if is_new]
+            except Exception as e:
+                # Index hỏng không được chặn việc gửi tin nhắn
+                log.warning("Lỗi kiểm tra trùng: %s", e, extra=fields(messages=len(items)))
+                check = False
+        duplicates = len(items) - len(kept)
+        if due is not None:
+            try:
+                if kept:
+                    self.scheduler.add_many(kept, due, throttle)
+            except Exception as e:
+                log.error("Lỗi hẹn giờ lô tin nhắn: %s", e, extra=fields(messages=len(kept)))
+                if check:
+                    self.dedupe.release_many(kept)
+                return BatchEnqueueResult(duplicates=duplicates, error=str(e))
+            return BatchEnqueueResult(len(kept), duplicates, send_at=due)
+        try:
+            allowed, rejection = self.admission.admit(len(kept), producer)
+        except Exception as e:
+            log.warning("Lỗi kiểm tra admission: %s", e, extra=fields(messages=len(kept)))
+            allowed, rejection = len(kept), None
+        kept, rejected = kept[:allowed], kept[allowed:]
+        if rejected and check:
+            self.dedupe.release_many(rejected)
+        try:
+            self.file_queue.append_many((OutboundJob(phone, message).to_line(), phone) for phone, message, _ in kept)
+        except Exception as e:
+            log.error("Lỗi thêm lô tin nhắn vào queue: %s", e, extra=fields(messages=len(kept)))
+            if check:
+                self.dedupe.release_many(kept)
+            return BatchEnqueueResult(duplicates=duplicates, error=str(e))
+        return BatchEnqueueResult(len(kept), duplicates, rejected, rejection)
     
     def get_queue_status(self):
         """Kiểm tra trạng thái hàng đợi"""
         try:
-            if os.path.exists(self.queue_file):
-                with open(self.queue_file, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                return len(lines)
-            return 0
+            return self.file_queue.count()
         except Exception as e:
-            print(f"❌ Lỗi kiểm tra queue: {e}")
+            log.error("Lỗi kiểm tra queue: %s", e)
             return -1
 
 # Sử dụng
@@ -698,7 +967,23 @@ if __name__ == '__main__':
     if len(sys.argv) > 1:
         if sys.argv[1] == 'service':
             # Chạy như service
-            handler = SimpleSMSHandler('/dev/ttyUSB2')
+            setup_logging()
+            ports = sys.argv[2:] or ['/dev/ttyUSB2']
+            # SMS_TRACE_DIR: ghi lại lưu lượng serial của từng modem để phát lại khi điều tra lỗi
+            trace_dir = os.environ.get('SMS_TRACE_DIR')
+            if len(ports) > 1:
+                # Nhiều modem: một vòng select nghe tất cả cổng
+                from sms_multiport import MultiPortListener
+                handler = MultiPortListener(ports, store_path=DEFAULT_STORE_PATH, store_retention_days=90,
+                                            webhook_url=os.environ.get('SMS_WEBHOOK_URL'), queue_dir=QUEUE_DIR,
+                                            trace_dir=trace_dir, autoreply_rules=AUTOREPLY_RULES,
+                                            cluster_queue=CLUSTER_QUEUE, reassembly_checkpoint=REASSEMBLY_CHECKPOINT)
+            else:
+                handler = SimpleSMSHandler(ports[0], store_path=DEFAULT_STORE_PATH, store_retention_days=90,
+                                           webhook_url=os.environ.get('SMS_WEBHOOK_URL'), queue_dir=QUEUE_DIR,
+                                           trace_path=trace_path_for(trace_dir, ports[0]) if trace_dir else None,
+                                           autoreply_rules=AUTOREPLY_RULES, cluster_queue=CLUSTER_QUEUE,
+                                           reassembly_checkpoint=REASSEMBLY_CHECKPOINT)
             
             if handler.connect():
                 try:
@@ -713,27 +998,138 @@ if __name__ == '__main__':
                 print("❌ Không thể kết nối tới modem!")
                 
         elif sys.argv[1] == 'send':
-            if len(sys.argv) >= 4:
-                phone = sys.argv[2]
-                message = ' '.join(sys.argv[3:])
+            args = sys.argv[2:]
+            options = {'--key': None, '--producer': None, '--at': None, '--throttle': None}
+            while len(args) >= 2 and args[0] in options:
+                options[args[0]], args = args[1], args[2:]
+            if len(args) >= 2:
+                phone = args[0]
+                message = ' '.join(args[1:])
                 
-                handler = SimpleSMSHandler()
-                if handler.add_to_queue(phone, message):
+                handler = SimpleSMSHandler(queue_dir=QUEUE_DIR, cluster_queue=CLUSTER_QUEUE)
+                throttle = handler.scheduler.use_throttle(options['--throttle']) if options['--throttle'] else None
+                result = handler.add_to_queue(phone, message, options['--key'], options['--producer'],
+                                              options['--at'], throttle)
+                if result.duplicate:
+                    print(f"⚠️ Tin nhắn trùng, đã có trong queue")
+                elif result.scheduled:
+                    print(f"⏰ Đã hẹn giờ gửi lúc {datetime.fromtimestamp(result.send_at):%Y-%m-%d %H:%M:%S}")
+                elif result.rejected:
+                    print(f"⏳ Queue quá tải ({result.error}), thử lại sau {result.retry_after:.0f} giây")
+                    sys.exit(75)  # EX_TEMPFAIL: script gọi có thể thử lại
+                elif result:
                     print(f"✅ Tin nhắn đã được thêm vào queue")
                 else:
                     print(f"❌ Lỗi thêm tin nhắn vào queue")
             else:
-                print("Sử dụng: python sms_handler.py send <số_điện_thoại> <tin_nhắn>")
+                print("Sử dụng: python sms_handler.py send [--key <idempotency_key>] [--producer <tên>] "
+                      "[--at <thời_điểm|+30m>] [--throttle <tên[=N/phút][@HH:MM-HH:MM]>] <số_điện_thoại> <tin_nhắn>")
+                
+        elif sys.argv[1] == 'send-bulk':
+            args = sys.argv[2:]
+            # --wait: chờ theo retry_after khi queue đầy thay vì bỏ phần vượt giới hạn
+            wait = '--wait' in args
+            args = [arg for arg in args if arg != '--wait']
+            options = {'--producer': None, '--at': None, '--throttle': None}
+            while len(args) >= 2 and args[0] in options:
+                options[args[0]], args = args[1], args[2:]
+            if args:
+                from bulk_import import run_bulk_import
+                fmt = args[1] if len(args) >= 2 else None
+                handler = SimpleSMSHandler(queue_dir=QUEUE_DIR, cluster_queue=CLUSTER_QUEUE)
+                # --throttle: chiến dịch lớn chỉ nhả N tin/phút (và chỉ trong khung giờ nếu có)
+                throttle = handler.scheduler.use_throttle(options['--throttle']) if options['--throttle'] else None
+                run_bulk_import(handler, args[0], fmt, producer=options['--producer'], wait=wait,
+                                send_at=options['--at'], throttle=throttle)
+            else:
+                print("Sử dụng: python sms_handler.py send-bulk [--wait] [--producer <tên>] [--at <thời_điểm>] "
+                      "[--throttle <tên[=N/phút][@HH:MM-HH:MM]>] <file.csv|file.jsonl|-> [csv|jsonl]")
                 
         elif sys.argv[1] == 'status':
-            handler = SimpleSMSHandler()
+            handler = SimpleSMSHandler(queue_shards=None, queue_dir=QUEUE_DIR, cluster_queue=CLUSTER_QUEUE)
             count = handler.get_queue_status()
             if count >= 0:
                 print(f"📊 Số tin nhắn trong queue: {count}")
+                status = handler.admission.status()
+                print(f"🚚 Tốc độ gửi: {status['drain_per_minute']} tin/phút, "
+                      f"chờ dự kiến {status['estimated_wait_s'] / 60:.0f} phút "
+                      f"(giới hạn {status['max_depth'] or '∞'} tin, {round(status['max_age'] / 60) or '∞'} phút)")
+                if handler.cluster_queue:
+                    cluster = handler.file_queue.status()
+                    print(f"🖧 Queue dùng chung: {cluster['waiting']} chờ claim, {sum(cluster['held'].values())} "
+                          f"đang được giữ, {cluster['expired']} lease hết hạn")
+                    for node in cluster['nodes']:
+                        print(f"   🖥️ {node['name']}: đã gửi {node['completed']}, lấy lại {node['reclaimed']}, "
+                              f"heartbeat {time.time() - node['heartbeat']:.0f}s trước")
+                if os.path.exists(schedule_path(handler.queue_file, handler.queue_dir)):
+                    schedule = handler.scheduler.status()
+                    if schedule['pending']:
+                        print(f"⏰ Tin nhắn hẹn giờ: {schedule['pending']}, sớm nhất lúc "
+                              f"{datetime.fromtimestamp(schedule['next_due']):%Y-%m-%d %H:%M:%S}")
+                    for window in schedule['throttles']:
+                        print(f"   🐢 {window.name}: {schedule['by_throttle'].get(window.name, 0)} tin chờ, "
+                              f"{window.per_minute or '∞'} tin/phút"
+                              + (f", {window.start}-{window.end}" if window.start else ''))
             else:
                 print("❌ Lỗi kiểm tra queue")
+                
+        elif sys.argv[1] == 'peek':
+            import argparse
+            from itertools import islice
+            parser = argparse.ArgumentParser(prog='python sms_handler.py peek')
+            parser.add_argument('--phone', help='Số người nhận')
+            parser.add_argument('--since', help='Thêm vào từ thời điểm (YYYY-MM-DD[ HH:MM:SS])')
+            parser.add_argument('--until', help='Thêm vào đến thời điểm (YYYY-MM-DD[ HH:MM:SS])')
+            parser.add_argument('--limit', type=int, default=50)
+            args = parser.parse_args(sys.argv[2:])
+            
+            # Duyệt lười: queue nhiều GB không bị nạp vào bộ nhớ
+            handler = SimpleSMSHandler(queue_shards=None, queue_dir=QUEUE_DIR, cluster_queue=CLUSTER_QUEUE)
+            shown = 0
+            for record in islice(handler.file_queue.records(args.phone, args.since, args.until), args.limit):
+                print(f"[{record.timestamp or '-'}] {record.phone}: {record.message}")
+                shown += 1
+            print(f"🔎 {shown} tin nhắn chờ gửi" + (f" (tối đa {args.limit})" if shown == args.limit else ''))
+            
+        elif sys.argv[1] == 'query':
+            import argparse
+            parser = argparse.ArgumentParser(prog='python sms_handler.py query')
+            parser.add_argument('--sender', help='Số người gửi')
+            parser.add_argument('--since', help='Từ thời điểm (YYYY-MM-DD[ HH:MM:SS])')
+            parser.add_argument('--until', help='Đến thời điểm (YYYY-MM-DD[ HH:MM:SS])')
+            parser.add_argument('--text', help='Cụm từ trong nội dung')
+            parser.add_argument('--limit', type=int, default=50)
+            parser.add_argument('--db', default=DEFAULT_STORE_PATH)
+            args = parser.parse_args(sys.argv[2:])
+            
+            store = SMSStore(args.db)
+            start = time.perf_counter()
+            rows = store.query(args.sender, args.since, args.until, args.text, args.limit)
+            elapsed = time.perf_counter() - start
+            for row in rows:
+                print(f"[{row['time'].strftime('%Y-%m-%d %H:%M:%S')}] {row['sender']}: {row['content']}")
+            print(f"🔎 Tìm thấy {len(rows)} tin nhắn ({elapsed * 1000:.1f} ms)")
+            
+        elif sys.argv[1] == 'bench':
+            # Cả luồng gửi/nhận trên cổng null-modem trong bộ nhớ: trần phần mềm, không phụ thuộc sóng
+            from sms_loopback import bench
+            args = [arg for arg in sys.argv[2:] if arg != '--tracemalloc']
+            bench(int(args[0]) if args else 2000, int(args[1]) if len(args) > 1 else 1,
+                  int(args[2]) if len(args) > 2 else 100, '--tracemalloc' in sys.argv)
+            
+        elif sys.argv[1] == 'prune':
+            if len(sys.argv) >= 3:
+                deleted = SMSStore(DEFAULT_STORE_PATH).prune(float(sys.argv[2]))
+                print(f"🧹 Đã xóa {deleted} tin nhắn cũ hơn {sys.argv[2]} ngày")
+            else:
+                print("Sử dụng: python sms_handler.py prune <số_ngày>")
     else:
         print("Sử dụng:")
-        print("  python sms_handler.py service        # Chạy service")
-        print("  python sms_handler.py send <sdt> <msg>  # Gửi tin nhắn")
+        print("  python sms_handler.py service [cổng ...]  # Chạy service (nhiều cổng: nghe chung một luồng; SMS_TRACE_DIR: ghi trace serial; SMS_AUTOREPLY_RULES: luật trả lời tự động; SMS_CLUSTER_QUEUE: queue dùng chung nhiều gateway; SMS_STORED_SEND=1: nội dung lặp lại gửi bằng AT+CMSS; SMS_REASSEMBLY_CHECKPOINT: lưu tin nhắn đang ghép dở)")
+        print("  python sms_handler.py send [--key K] [--producer P] [--at T] [--throttle R] <sdt> <msg>  # Gửi tin nhắn (K: idempotency key chống gửi trùng, P: tên producer cho quota, T: hẹn giờ)")
+        print("  python sms_handler.py send-bulk [--wait] [--producer P] [--at T] [--throttle R] <file|-> [csv|jsonl]  # Gửi hàng loạt từ file/stdin (R: tên=N/phút@HH:MM-HH:MM)")
         print("  python sms_handler.py status         # Kiểm tra queue")
+        print("  python sms_handler.py peek [--phone P] [--since T] [--until T] [--limit N]  # Xem tin nhắn chờ gửi")
+        print("  python sms_handler.py query [--sender S] [--since T] [--text X]  # Tra cứu tin nhắn đã nhận")
+        print("  python sms_handler.py prune <số_ngày>   # Xóa tin nhắn cũ")
+        print("  python sms_handler.py bench [số_tin] [số_cổng] [độ_dài] [--tracemalloc]  # Đo tin/giây cả luồng trên LoopbackSerial")
@@ -4,11 +4,13 @@ import re
 import random
 import threading
 import os
+import shutil
 from smspdudecoder.fields import SMSDeliver
 from io import StringIO
 from collections import defaultdict
 from datetime import timezone, timedelta
 from queue import Queue
+from sms_queue import file_lock
 
 class SMSHandlerWithFileQueue:
     def __init__(self, port='/dev/ttyUSB2', baudrate=115200, timeout=3, queue_file='/tmp/sms_queue.txt'):
@@ -122,30 +124,26 @@ class SMSHandlerWithFileQueue:
         while self.is_listening:
             try:
                 if os.path.exists(self.queue_file):
+                    # Chỉ đọc dòng đầu, không nạp cả file
                     with open(self.queue_file, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()
+                        line = f.readline().strip()
                     
-                    if lines:
+                    if line:
                         # Xử lý tin nhắn đầu tiên
-                        line = lines[0].strip()
                         if '|' in line:
                             phone_number, message = line.split('|', 1)
                             print(f"Đang xử lý tin nhắn từ file queue...")
                             
                             if self._send_pdu_sms(phone_number, message):
                                 # Xóa tin nhắn đã gửi thành công
-                                remaining_lines = lines[1:]
-                                with open(self.queue_file, 'w', encoding='utf-8') as f:
-                                    f.writelines(remaining_lines)
+                                self._drop_first_line()
                                 print(f"Đã xóa tin nhắn khỏi queue")
                             else:
                                 print(f"Gửi tin nhắn thất bại, giữ lại trong queue")
                                 time.sleep(10)  # Chờ 10 giây trước khi thử lại
                         else:
                             # Dòng không hợp lệ, xóa nó
-                            remaining_lines = lines[1:]
-                            with open(self.queue_file, 'w', encoding='utf-8') as f:
-                                f.writelines(remaining_lines)
+                            self._drop_first_line()
                     else:
                         time.sleep(1)  # Không có tin nhắn, chờ 1 giây
                 else:
@@ -154,6 +152,18 @@ class SMSHandlerWithFileQueue:
                 print(f"Lỗi xử lý file queue: {e}")
                 time.sleep(5)
     
+    def _drop_first_line(self):
+        """Bỏ dòng đầu: chép phần còn lại sang file tạm theo khối rồi thay file queue
+        
+        Giữ khóa của queue (như FileSMSClient) để dòng được ghi thêm lúc đang chép không bị mất.
+        """
+        tmp_path = self.queue_file + '.tmp'
+        with file_lock(self.queue_file):
+            with open(self.queue_file, 'rb') as src, open(tmp_path, 'wb') as dst:
+                src.readline()
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(tmp_path, self.queue_file)
+    
     def parse_pdu_raw(self, pdu_hex):
         """Phân tích PDU thô để tìm thông tin multipart"""
         try:
@@ -315,7 +325,7 @@ class SMSHandlerWithFileQueue:
     def add_to_queue(self, phone_number, message):
         """Thêm tin nhắn vào file queue"""
         try:
-            with open(self.queue_file, 'a', encoding='utf-8') as f:
+            with file_lock(self.queue_file), open(self.queue_file, 'a', encoding='utf-8') as f:
                 f.write(f"{phone_number}|{message}\n")
             print(f"✓ Đã thêm tin nhắn vào queue: {phone_number}")
             return True
@@ -327,9 +337,9 @@ class SMSHandlerWithFileQueue:
         """Kiểm tra trạng thái hàng đợi"""
         try:
             if os.path.exists(self.queue_file):
-                with open(self.queue_file, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                return len(lines)
+                # Đếm dòng theo khối, không nạp cả file
+                with open(self.queue_file, 'rb') as f:
+                    return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024 * 1024), b''))
             return 0
         except Exception as e:
             print(f"Lỗi kiểm tra queue: {e}")
@@ -0,0 +1,196 @@
+import time
+import threading
+from collections import deque
+from sms_logging import fields, get_logger
+
+log = get_logger('health')
+
+# Lệnh lấy mẫu và tiền tố dòng trả lời tương ứng
+HEALTH_PREFIXES = ('+CSQ:', '+CREG:', '+CEREG:', '+CPSI:')
+HEALTH_COMMANDS = ('AT+CSQ', 'AT+CREG?', 'AT+CEREG?', 'AT+CPSI?')
+
+REGISTERED = (1, 5)     # 1: mạng nhà, 5: roaming
+MIN_RSSI = 5            # -103 dBm, yếu hơn coi như không gửi được
+STEAL_MIN_SCORE = 0.3   # sóng yếu hơn thì chỉ gửi shard của mình, không steal
+
+
+class HealthSample:
+    """Một lần lấy mẫu tình trạng modem"""
+    __slots__ = ('time', 'rssi', 'ber', 'creg', 'cereg', 'system', 'status')
+
+    def __init__(self, sample_time):
+        self.time = sample_time
+        self.rssi = None        # 0-31, 99: không xác định
+        self.ber = None
+        self.creg = None        # trạng thái đăng ký mạng CS
+        self.cereg = None       # trạng thái đăng ký mạng LTE
+        self.system = None      # AT+CPSI: GSM/WCDMA/LTE/NO SERVICE
+        self.status = None
+
+    @property
+    def registered(self):
+        return self.creg in REGISTERED or self.cereg in REGISTERED
+
+    @property
+    def dbm(self):
+        return None if self.rssi in (None, 99) else -113 + 2 * self.rssi
+
+    @property
+    def healthy(self):
+        if self.system == 'NO SERVICE':
+            return False
+        if (self.creg is not None or self.cereg is not None) and not self.registered:
+            return False
+        return self.rssi is None or (self.rssi != 99 and self.rssi >= MIN_RSSI)
+
+
+def _registration_stat(value):
+    # Trả lời query: "<n>,<stat>[,...]"; URC: "<stat>[,...]"
+    parts = [part.strip() for part in value.split(',')]
+    if len(parts) >= 2 and parts[1].isdigit():
+        return int(parts[1])
+    return int(parts[0]) if parts[0].isdigit() else None
+
+
+class ModemHealth:
+    """Ring buffer các mẫu gần nhất của một modem"""
+    def __init__(self, port, maxlen=120, unhealthy_after=2):
+        self.port = port
+        self.samples = deque(maxlen=maxlen)
+        self.unhealthy_after = unhealthy_after  # số mẫu xấu liên tiếp trước khi coi là hỏng
+        self._current = None
+        self._bad_streak = 0
+        self.lock = threading.Lock()
+
+    def begin(self):
+        """Bắt đầu mẫu mới (mẫu trước thiếu trả lời vẫn được lưu)"""
+        with self.lock:
+            self._commit()
+            self._current = HealthSample(time.time())
+
+    def feed_line(self, line):
+        """Cập nhật mẫu hiện tại từ một dòng trả lời +CSQ/+CREG/+CEREG/+CPSI"""
+        prefix, _, value = line.partition(':')
+        value = value.strip()
+        with self.lock:
+            sample = self._current
+            if sample is None:
+                # URC đăng ký mạng ngoài chu kỳ lấy mẫu
+                if prefix not in ('+CREG', '+CEREG'):
+                    return
+                sample = self._current = HealthSample(time.time())
+            try:
+                if prefix == '+CSQ':
+                    rssi, ber = value.split(',')[:2]
+                    sample.rssi, sample.ber = int(rssi), int(ber)
+                elif prefix == '+CREG':
+                    sample.creg = _registration_stat(value)
+                elif prefix == '+CEREG':
+                    sample.cereg = _registration_stat(value)
+                elif prefix == '+CPSI':
+                    parts = value.split(',')
+                    sample.system = parts[0].strip()
+                    sample.status = parts[1].strip() if len(parts) > 1 else None
+                    # +CPSI là trả lời cuối của một chu kỳ lấy mẫu
+                    self._commit()
+            except ValueError:
+                log.debug("Không phân tích được dòng health", extra=fields(modem=self.port, line=line))
+
+    def _commit(self):
+        sample, self._current = self._current, None
+        if sample is None:
+            return
+        was_healthy = self.healthy
+        self.samples.append(sample)
+        self._bad_streak = 0 if sample.healthy else self._bad_streak + 1
+        if was_healthy != self.healthy:
+            log.warning("Modem %s", 'hoạt động lại' if self.healthy else 'mất sóng/mất đăng ký mạng',
+                        extra=fields(modem=self.port, **self._latest_fields(sample)))
+        else:
+            log.debug("Mẫu health", extra=fields(modem=self.port, **self._latest_fields(sample)))
+
+    @staticmethod
+    def _latest_fields(sample):
+        return {'rssi': sample.rssi, 'dbm': sample.dbm, 'creg': sample.creg, 'cereg': sample.cereg,
+                'system': sample.system}
+
+    @property
+    def healthy(self):
+        """Chưa có mẫu thì coi là tốt, hỏng khi unhealthy_after mẫu xấu liên tiếp"""
+        return self._bad_streak < self.unhealthy_after
+
+    @property
+    def score(self):
+        """Trọng số 0..1 cho điều phối: 0 khi hỏng, còn lại theo RSSI trung bình gần đây"""
+        if not self.healthy:
+            return 0.0
+        recent = [sample.rssi for sample in list(self.samples)[-5:] if sample.rssi not in (None, 99)]
+        if not recent:
+            return 1.0
+        return min(1.0, sum(recent) / len(recent) / 20)
+
+    def metrics(self):
+        """Số liệu hiện tại và thống kê trên ring buffer"""
+        samples = list(self.samples)
+        latest = samples[-1] if samples else None
+        rssis = [sample.rssi for sample in samples if sample.rssi not in (None, 99)]
+        metrics = {
+            'modem': self.port,
+            'healthy': self.healthy,
+            'score': round(self.score, 2),
+            'samples': len(samples),
+            'registered_ratio': sum(sample.registered for sample in samples) / len(samples) if samples else None,
+            'rssi_avg': sum(rssis) / len(rssis) if rssis else None,
+            'rssi_min': min(rssis, default=None),
+            'last_sample_age': time.time() - latest.time if latest else None
+        }
+        if latest:
+            metrics.update(self._latest_fields(latest))
+        return metrics
+
+
+class HealthSampler:
+    """Thread nền lấy mẫu health cho các modem qua arbiter của từng handler
+
+    Lệnh lấy mẫu xếp hàng sau lần gửi đang chạy, không chen vào giữa AT+CMGS và PDU.
+    """
+    def __init__(self, handlers, interval=30, timeout=2):
+        self.handlers = list(handlers)
+        self.interval = interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            for handler in self.handlers:
+                try:
+                    self.sample(handler)
+                except Exception as e:
+                    log.error("Lỗi lấy mẫu health: %s", e, extra=fields(modem=handler.port))
+            self._stop.wait(self.interval)
+
+    def sample(self, handler):
+        """Gửi các lệnh lấy mẫu và cập nhật handler.health, trả về False nếu modem chưa kết nối"""
+        if not handler.connected.is_set():
+            return False
+        handler.health.begin()
+        commands = [handler.arbiter.submit(command, prefixes=(prefix,), timeout=self.timeout)
+                    for command, prefix in zip(HEALTH_COMMANDS, HEALTH_PREFIXES)]
+        for command in commands:
+            for line in command.wait().lines:
+                handler.health.feed_line(line)
+        return True
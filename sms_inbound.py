@@ -0,0 +1,325 @@
+import os
+import re
+import time
+import heapq
+import logging
+import threading
+from io import StringIO
+from itertools import count
+from collections import defaultdict
+from datetime import timezone, timedelta
+from sms_records import AssembledMessage, InboundPart, MultipartBuffer
+from sms_logging import fields, get_logger
+
+log = get_logger('inbound')
+inbox_log = get_logger('inbox')
+
+PDU_LINE_RE = re.compile(r'[0-9A-Fa-f]+')
+LOCAL_TZ = timezone(timedelta(hours=7))
+# Tin nhắn multipart chưa đủ phần sau MULTIPART_TIMEOUT giây: xuất phần đã có thay vì giữ mãi
+MULTIPART_TIMEOUT = float(os.environ.get('SMS_MULTIPART_TIMEOUT', '600'))
+
+
+def parse_pdu_raw(pdu_hex):
+    """Phân tích PDU thô để tìm thông tin multipart"""
+    try:
+        pdu_bytes = bytes.fromhex(pdu_hex)
+        smsc_len = pdu_bytes[0]
+        offset = 1 + smsc_len
+
+        pdu_type = pdu_bytes[offset]
+        udhi = (pdu_type & 0x40) != 0
+
+        if not udhi:
+            return None
+
+        offset += 1
+        sender_len = pdu_bytes[offset]
+        offset += 1
+        offset += 1  # sender type
+
+        sender_digits = (sender_len + 1) // 2
+        offset += sender_digits
+        offset += 1  # PID
+        offset += 1  # DCS
+        offset += 7  # Timestamp
+
+        udl = pdu_bytes[offset]
+        offset += 1
+
+        if offset < len(pdu_bytes):
+            udhl = pdu_bytes[offset]
+            offset += 1
+
+            udh_end = offset + udhl
+            while offset < udh_end:
+                iei = pdu_bytes[offset]
+                offset += 1
+                iedl = pdu_bytes[offset]
+                offset += 1
+
+                if iei == 0x00 and iedl == 3:
+                    ref_num = pdu_bytes[offset]
+                    total_parts = pdu_bytes[offset + 1]
+                    seq_num = pdu_bytes[offset + 2]
+                    return (ref_num, total_parts, seq_num)
+
+                offset += iedl
+
+        return None
+    except Exception as e:
+        log.error("Lỗi phân tích PDU thô: %s", e, extra=fields(pdu=pdu_hex))
+        return None
+
+
+def decode_pdu(pdu_line):
+    """Giải mã SMS-DELIVER PDU, trả về (sender, scts, content, multipart_info)"""
+    # smspdudecoder (kéo theo bitstring) chỉ nạp khi có tin nhắn đến
+    from smspdudecoder.fields import SMSDeliver
+    sms = SMSDeliver.decode(StringIO(pdu_line))
+    sender = sms['sender']['number']
+    scts = sms['scts'].astimezone(LOCAL_TZ)
+    content = sms['user_data']['data']
+    return sender, scts, content, parse_pdu_raw(pdu_line)
+
+
+def log_message(message):
+    """Sink mặc định: ghi tin nhắn hoàn chỉnh ra log 'sms.inbox'"""
+    tags = {'modem': message.modem, 'iccid': message.iccid} if message.modem else {}
+    inbox_log.info("%s", message.content, extra=fields(
+        kind=message.kind, sender=message.sender, time=message.time.strftime('%Y-%m-%d %H:%M:%S'),
+        parts=message.parts, **tags))
+
+
+class SenderOrderBuffer:
+    """Giữ tin nhắn hoàn chỉnh trong window giây rồi xuất theo SCTS tăng dần cho từng sender
+
+    Tin nhắn của cùng một người gửi đến qua nhiều modem có thể lệch thứ tự; bộ đệm này
+    sắp xếp lại trước khi chuyển cho các sink. Dùng như một sink của SMSReassembler.
+    on_delivered(message): gọi sau khi các sink đã nhận tin nhắn (SMSReassembler.ack).
+    """
+    def __init__(self, sinks, window=2.0, on_delivered=None):
+        self.sinks = list(sinks)
+        self.window = window
+        self.on_delivered = on_delivered
+        # sender -> heap [(scts, seq, arrival, message)]
+        self.pending = {}
+        self._seq = count()
+        self.lock = threading.Lock()
+
+    def add(self, message):
+        with self.lock:
+            heapq.heappush(self.pending.setdefault(message.sender, []),
+                           (message.time, next(self._seq), time.time(), message))
+
+    def flush(self, current_time=None):
+        """Xuất các tin nhắn đã giữ đủ window giây (flush(float('inf')) để xuất hết)"""
+        if current_time is None:
+            current_time = time.time()
+
+        ready = []
+        with self.lock:
+            for sender in list(self.pending):
+                heap = self.pending[sender]
+                # Tin có SCTS nhỏ nhất chưa đủ hạn thì các tin sau của sender này cũng phải chờ
+                while heap and current_time - heap[0][2] >= self.window:
+                    ready.append(heapq.heappop(heap)[3])
+                if not heap:
+                    del self.pending[sender]
+
+        for message in ready:
+            for sink in self.sinks:
+                try:
+                    sink(message)
+                except Exception as e:
+                    log.error("Lỗi xử lý tin nhắn ở sink: %s", e,
+                              extra=fields(sink=getattr(sink, '__qualname__', sink)))
+            if self.on_delivered:
+                self.on_delivered(message)
+
+
+class SMSReassembler:
+    """Ghép tin nhắn multipart (theo UDH) và tin nhắn rời (theo thời gian)
+
+    checkpoint_path: lưu các phần đang chờ ghép (ReassemblyCheckpoint) để khởi động lại không
+    mất phần nào; trạng thái được nạp lại ngay khi tạo. Tin nhắn đã ghép nhưng sink chưa nhận
+    xong vẫn nằm trong snapshot (inflight) cho tới khi ack. deferred_ack: sink cuối tự gọi
+    ack(message) khi đã chuyển tin nhắn đi (SenderOrderBuffer.on_delivered).
+    Multipart thiếu phần quá multipart_timeout giây được xuất với các phần đã nhận.
+    """
+    def __init__(self, sinks=None, merge_window=3, checkpoint_path=None, deferred_ack=False,
+                 multipart_timeout=MULTIPART_TIMEOUT):
+        self.merge_window = merge_window
+        self.multipart_timeout = multipart_timeout
+        # sender -> {ref_num: MultipartBuffer}
+        self.multipart_messages = defaultdict(dict)
+        # sender -> [InboundPart]
+        self.pending_messages = defaultdict(list)
+        self.sinks = list(sinks) if sinks is not None else [log_message]
+        # modem -> (iccid, imsi) để gắn thông tin SIM vào tin nhắn
+        self.sim_info = {}
+        self.lock = threading.Lock()
+        self.deferred_ack = deferred_ack
+        self.checkpoint = None
+        # id(message) -> (message, kind, sender, ref, buffer|parts): đã ghép, sink chưa nhận xong
+        self.inflight = {}
+        # Multipart đã ghép đủ trước khi dừng nhưng chưa ack: xuất lại ở lần check_pending đầu tiên
+        self._restored = []
+        if checkpoint_path:
+            from sms_checkpoint import ReassemblyCheckpoint
+            self.checkpoint = ReassemblyCheckpoint(checkpoint_path)
+            self.multipart_messages, self.pending_messages, self._restored = self.checkpoint.load()
+            # Gộp log vừa chạy lại vào snapshot mới
+            self._snapshot()
+
+    def add_sink(self, sink):
+        """Đăng ký hàm nhận tin nhắn hoàn chỉnh"""
+        self.sinks.append(sink)
+
+    def add(self, sender, scts, content, multipart_info, received_at=None, modem=None):
+        """Thêm một phần tin nhắn vừa nhận (modem: cổng đã nhận, các phần có thể đến từ nhiều cổng)"""
+        if received_at is None:
+            received_at = time.time()
+
+        if multipart_info:
+            # Xử lý tin nhắn multipart
+            ref_num, total_parts, seq_num = multipart_info
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Nhận phần tin nhắn", extra=fields(
+                    sender=sender, ref=ref_num, segment=f"{seq_num}/{total_parts}"))
+
+            with self.lock:
+                buffers = self.multipart_messages[sender]
+                buffer = buffers.get(ref_num)
+                if buffer is None:
+                    buffer = buffers[ref_num] = MultipartBuffer(total_parts, received_at, modem)
+                if self.checkpoint:
+                    self.checkpoint.part(sender, scts, content, received_at, modem, multipart_info, buffer.first_seen)
+
+                if not buffer.add(seq_num, content, scts):
+                    if self.checkpoint:
+                        self._maybe_snapshot()
+                    return
+
+                # Ghép tin nhắn hoàn chỉnh
+                del buffers[ref_num]
+                if not buffers:
+                    del self.multipart_messages[sender]
+                message = self._track(self._message('multipart', sender, buffer.timestamp, buffer.assemble(),
+                                                    buffer.total, buffer.modem), 'm', sender, ref_num, buffer)
+
+            self._emit(message)
+        else:
+            # Tin nhắn có thể là đơn hoặc cần ghép
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Nhận tin nhắn rời", extra=fields(sender=sender, chars=len(content)))
+
+            with self.lock:
+                self.pending_messages[sender].append(InboundPart(scts, content, received_at, modem))
+                if self.checkpoint:
+                    self.checkpoint.part(sender, scts, content, received_at, modem)
+                    self._maybe_snapshot()
+
+    def check_pending(self, current_time=None):
+        """Xử lý các tin nhắn đã chờ quá merge_window giây và multipart quá multipart_timeout giây"""
+        if current_time is None:
+            current_time = time.time()
+
+        ready = []
+        with self.lock:
+            restored, self._restored = self._restored, []
+            for _, sender, ref_num, buffer in restored:
+                ready.append(self._track(self._message('multipart', sender, buffer.timestamp, buffer.assemble(),
+                                                       buffer.total, buffer.modem), 'm', sender, ref_num, buffer))
+
+            for sender in list(self.multipart_messages.keys()):
+                buffers = self.multipart_messages[sender]
+                for ref_num in [ref for ref, buffer in buffers.items()
+                                if current_time - buffer.first_seen > self.multipart_timeout]:
+                    buffer = buffers.pop(ref_num)
+                    log.warning("Tin nhắn multipart thiếu phần, xuất phần đã nhận", extra=fields(
+                        sender=sender, ref=ref_num, received=buffer.received, total=buffer.total))
+                    ready.append(self._track(self._message('multipart', sender, buffer.timestamp, buffer.assemble(),
+                                                           buffer.received, buffer.modem), 'm', sender, ref_num, buffer))
+                if not buffers:
+                    del self.multipart_messages[sender]
+
+            for sender in list(self.pending_messages.keys()):
+                messages = self.pending_messages[sender]
+                if not messages:
+                    continue
+
+                # Kiểm tra tin nhắn cũ nhất
+                oldest = min(msg.timestamp for msg in messages)
+                if current_time - oldest > self.merge_window:
+                    del self.pending_messages[sender]
+                    if len(messages) == 1:
+                        msg = messages[0]
+                        message = self._message('single', sender, msg.time, msg.content, 1, msg.modem)
+                    else:
+                        # Ghép nhiều tin nhắn theo thời gian gửi
+                        messages.sort(key=lambda x: x.time)
+                        content = ''.join([msg.content for msg in messages])
+                        message = self._message('merged', sender, messages[0].time, content, len(messages),
+                                                messages[0].modem)
+                    ready.append(self._track(message, 'd', sender, None, messages))
+
+        for message in ready:
+            self._emit(message)
+
+    def _track(self, message, kind, sender, ref_num, payload):
+        """Giữ tin nhắn vừa ghép trong inflight tới khi ack (gọi khi đang giữ lock)"""
+        if self.checkpoint:
+            self.inflight[id(message)] = (message, kind, sender, ref_num, payload)
+            self._maybe_snapshot()
+        return message
+
+    def ack(self, message):
+        """Sink cuối đã nhận tin nhắn: ghi vào checkpoint là đã xuất"""
+        if self.checkpoint is None:
+            return
+        with self.lock:
+            entry = self.inflight.pop(id(message), None)
+            if entry is None:
+                return
+            _, kind, sender, ref_num, payload = entry
+            if kind == 'm':
+                self.checkpoint.emitted_multipart(sender, ref_num, payload.first_seen)
+            else:
+                self.checkpoint.emitted_pending(sender, payload)
+            self._maybe_snapshot()
+
+    def _maybe_snapshot(self):
+        """Log checkpoint đủ dài: snapshot rồi cắt log (gọi khi đang giữ lock)"""
+        if self.checkpoint.due:
+            self._snapshot()
+
+    def _snapshot(self):
+        inflight = [entry[1:] for entry in self.inflight.values()] + self._restored
+        self.checkpoint.snapshot(self.multipart_messages, self.pending_messages, inflight)
+
+    def close(self):
+        """Lưu snapshot cuối, trả về True nếu các phần đang chờ được giữ lại cho lần chạy sau
+
+        False (không có checkpoint): người gọi nên check_pending(float('inf')) để xuất nốt.
+        """
+        if self.checkpoint is None:
+            return False
+        with self.lock:
+            self._snapshot()
+            self.checkpoint.close()
+        return True
+
+    def _message(self, kind, sender, scts, content, parts, modem):
+        iccid, imsi = self.sim_info.get(modem, (None, None))
+        return AssembledMessage(kind, sender, scts, content, parts, modem, iccid, imsi)
+
+    def _emit(self, message):
+        for sink in self.sinks:
+            try:
+                sink(message)
+            except Exception as e:
+                log.error("Lỗi xử lý tin nhắn ở sink: %s", e, extra=fields(sink=getattr(sink, '__qualname__', sink)))
+        # Chỉ đánh dấu đã xuất sau khi sink nhận: dừng giữa chừng thì xuất lại chứ không mất
+        if not self.deferred_ack:
+            self.ack(message)
@@ -0,0 +1,78 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER_NAME = 'sms'
+DEFAULT_FORMAT = '%(asctime)s %(levelname)-5s %(name)s: %(message)s'
+
+_listener = None
+
+
+def fields(**kwargs):
+    """Trường có cấu trúc cho log: log.info("...", extra=fields(modem=..., phone=...))"""
+    return {'fields': kwargs}
+
+
+def get_logger(name=None):
+    return logging.getLogger(f'{LOGGER_NAME}.{name}' if name else LOGGER_NAME)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Thêm các trường có cấu trúc dạng key=value vào cuối dòng log"""
+    def format(self, record):
+        line = super().format(record)
+        record_fields = getattr(record, 'fields', None)
+        if record_fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in record_fields.items())
+        return line
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Chỉ đưa record vào queue, việc format do thread ghi log nền đảm nhận"""
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=None, stream=None, fmt=DEFAULT_FORMAT):
+    """Cấu hình logger 'sms': hot path chỉ put vào queue, thread nền format và ghi ra stream
+
+    Gọi lại trong process con (multiprocessing) vì thread ghi log không tồn tại sau fork.
+    """
+    global _listener
+
+    if level is None:
+        level = os.environ.get('SMS_LOG_LEVEL', 'INFO').upper()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    shutdown_logging()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(StructuredFormatter(fmt))
+
+    log_queue = queue.SimpleQueue()
+    _listener = QueueListener(log_queue, output)
+    _listener.start()
+
+    logger.addHandler(DeferredQueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
+
+
+def shutdown_logging():
+    """Ghi nốt các record còn trong queue và dừng thread ghi log"""
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        try:
+            listener.stop()
+        except Exception:
+            pass
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,279 @@
+import os
+import sys
+import time
+import threading
+from datetime import datetime
+from sms_trace import PipeSerial
+from sms_logging import get_logger
+
+log = get_logger('loopback')
+
+# Trả lời cố định cho các lệnh chỉ đọc (SIM, sóng, đăng ký mạng)
+FIXED_RESPONSES = {
+    '+CSQ': '+CSQ: 25,99',
+    '+CREG?': '+CREG: 0,1',
+    '+CEREG?': '+CEREG: 0,1',
+    '+CPSI?': '+CPSI: LTE,Online,452-04,0x1234,12345678,123,EUTRAN-BAND3,1650,5,5,-80,-1000,-700,15',
+    '+CICCID': '+ICCID: 8984049000000000000',
+    '+CIMI': '452040000000000',
+}
+
+
+def _semi_octets(value):
+    return f"{value % 100:02d}"[::-1]
+
+
+def scts_hex(now=None):
+    """SCTS (7 octet semi-octet đảo) của thời điểm now theo giờ máy"""
+    local = datetime.fromtimestamp(now or time.time()).astimezone()
+    quarters = int(local.utcoffset().total_seconds() // 900)
+    tz = _semi_octets(abs(quarters))
+    if quarters < 0:
+        # Bit dấu nằm ở chữ số hàng chục (nibble thấp của octet)
+        tz = f"{tz[0]}{int(tz[1], 16) | 0x8:X}"
+    return ''.join(_semi_octets(v) for v in (local.year, local.month, local.day, local.hour, local.minute,
+                                             local.second)) + tz
+
+
+def submit_to_deliver(pdu, now=None):
+    """Đổi SMS-SUBMIT (PDUEncoder) thành SMS-DELIVER từ chính số nhận, giữ nguyên PID/DCS/UDH/UD"""
+    pos = 2 + int(pdu[0:2], 16) * 2         # bỏ SCA
+    first = int(pdu[pos:pos + 2], 16)
+    pos += 4                                # first octet + MR
+    digits = int(pdu[pos:pos + 2], 16)
+    address = pdu[pos:pos + 4 + digits + digits % 2]
+    pos += len(address)
+    pid_dcs = pdu[pos:pos + 4]
+    pos += 4
+    vpf = (first >> 3) & 0x3
+    pos += {0: 0, 2: 2}.get(vpf, 14)        # bỏ validity period
+    # DELIVER: MTI=00, MMS=1 (không còn tin chờ), giữ cờ UDHI
+    deliver_first = 0x04 | (first & 0x40)
+    return f"00{deliver_first:02X}{address}{pid_dcs}{scts_hex(now)}{pdu[pos:]}"
+
+
+class LoopbackSerial(PipeSerial):
+    """Cổng serial null-modem trong bộ nhớ: trả lời lệnh AT như SIM7600, ACK AT+CMGS ngay
+
+    echo=True: mỗi PDU gửi đi được phát lại thành +CMT (SMS-DELIVER từ chính số nhận) nên cả
+    luồng gửi lẫn luồng nhận chạy hết tốc độ CPU, không phụ thuộc sóng. Cài đặt AT+X=... được
+    nhớ và trả lại cho AT+X? (CMGF/CNMI của configure). Dùng qua SimpleSMSHandler(transport=
+    LoopbackSerial.transport()).
+    """
+    def __init__(self, port='loopback', timeout=None, echo=True):
+        super().__init__(port, timeout)
+        self.echo = echo
+        self.settings = {}
+        self._tx = bytearray()
+        self._pdu_length = None     # đang chờ PDU sau dấu nhắc '>' của AT+CMGS/AT+CMGW
+        self._pdu_command = None
+        self._reference = 0
+        # Bộ nhớ tin nhắn (AT+CMGW/AT+CMSS/AT+CMGD): ô -> PDU
+        self.storage = {}
+        self.lock = threading.Lock()
+        self.stats = {'commands': 0, 'pdus': 0, 'echoed': 0, 'tx_bytes': 0}
+
+    @classmethod
+    def transport(cls, **kwargs):
+        """Hàm mở cổng cho SimpleSMSHandler(transport=...)"""
+        def open_port(port, baudrate=None, timeout=None):
+            return cls(port, timeout=timeout, **kwargs)
+        return open_port
+
+    def write(self, data):
+        with self.lock:
+            self.stats['tx_bytes'] += len(data)
+            self._tx += data
+            while self._process():
+                pass
+        return len(data)
+
+    def _process(self):
+        """Xử lý một lệnh/PDU đủ trong _tx, trả về False khi cần thêm dữ liệu"""
+        tx = self._tx
+        if self._pdu_length is not None:
+            end = tx.find(b'\x1a')
+            cancel = tx.find(b'\x1b')
+            if cancel >= 0 and (end < 0 or cancel < end):
+                # ESC: host hủy lệnh đang chờ PDU
+                del tx[:cancel + 1]
+                self._pdu_length = None
+                return True
+            if end < 0:
+                return False
+            pdu = tx[:end].decode(errors='ignore').strip()
+            del tx[:end + 1]
+            self._pdu_length = None
+            if self._pdu_command == 'CMGW':
+                self._store(pdu)
+            else:
+                self._submit(pdu)
+            return True
+        end = tx.find(b'\r')
+        if end < 0:
+            return False
+        command = tx[:end].decode(errors='ignore').strip()
+        del tx[:end + 1]
+        if command:
+            self._command(command)
+        return True
+
+    def _command(self, command):
+        self.stats['commands'] += 1
+        upper = command.upper()
+        if not upper.startswith('AT'):
+            self._deliver(b'\r\nERROR\r\n')
+            return
+        if upper.startswith(('AT+CMGS=', 'AT+CMGW=')):
+            self._pdu_command = upper[3:7]
+            self._pdu_length = int(upper[8:].split(',')[0] or 0)
+            self._deliver(b'\r\n> ')
+            return
+        if upper.startswith('AT+CMSS='):
+            self._send_stored(command[8:])
+            return
+        if upper.startswith('AT+CMGD='):
+            index = int(upper[8:].split(',')[0] or -1)
+            self._deliver(b'\r\nOK\r\n' if self.storage.pop(index, None) else b'\r\n+CMS ERROR: 321\r\n')
+            return
+        lines = []
+        # AT+CMGF=0;+CNMI=2,2,0,0,0 và AT+CMGF?;+CNMI? là nhiều lệnh ghép
+        for part in upper[2:].split(';'):
+            name, sep, value = part.partition('=')
+            if sep:
+                self.settings[name] = value
+            elif name.endswith('?') and name[:-1] in self.settings:
+                lines.append(f"{name[:-1]}: {self.settings[name[:-1]]}")
+            elif name in FIXED_RESPONSES:
+                lines.append(FIXED_RESPONSES[name])
+        self._deliver(''.join(f"\r\n{line}\r\n" for line in lines).encode() + b'\r\nOK\r\n')
+
+    def _submit(self, pdu, prefix='+CMGS'):
+        self.stats['pdus'] += 1
+        self._reference = (self._reference + 1) % 256
+        reply = f"\r\n{prefix}: {self._reference}\r\n\r\nOK\r\n"
+        if self.echo:
+            try:
+                deliver = submit_to_deliver(pdu)
+                reply += f"\r\n+CMT: ,{len(deliver) // 2 - 1}\r\n{deliver}\r\n"
+                self.stats['echoed'] += 1
+            except ValueError:
+                log.debug("PDU không đúng định dạng SMS-SUBMIT, không phát lại")
+        self._deliver(reply.encode())
+
+    def _store(self, pdu):
+        index = next(i for i in range(len(self.storage) + 1) if i not in self.storage)
+        self.storage[index] = pdu
+        self._deliver(f"\r\n+CMGW: {index}\r\n\r\nOK\r\n".encode())
+
+    def _send_stored(self, args):
+        """AT+CMSS=<ô>[,"<số>"[,<kiểu>]]: gửi PDU đã lưu, thay số nhận nếu có"""
+        index, _, rest = args.partition(',')
+        pdu = self.storage.get(int(index) if index.strip().isdigit() else -1)
+        if pdu is None:
+            self._deliver(b'\r\n+CMS ERROR: 321\r\n')
+            return
+        number = rest.split(',')[0].strip().strip('"')
+        if number:
+            # Thay địa chỉ nhận trong SMS-SUBMIT (sau SCA, first octet và MR)
+            pos = 2 + int(pdu[0:2], 16) * 2 + 4
+            digits = int(pdu[pos:pos + 2], 16)
+            padded = number + 'F' if len(number) % 2 else number
+            swapped = ''.join(padded[i + 1] + padded[i] for i in range(0, len(padded), 2))
+            pdu = f"{pdu[:pos]}{len(number):02X}91{swapped}{pdu[pos + 4 + digits + digits % 2:]}"
+        self._submit(pdu, '+CMSS')
+
+    def reset_input_buffer(self):
+        while self.is_open and self.in_waiting:
+            os.read(self._read_fd, self.in_waiting)
+
+
+def bench(count=2000, ports=1, length=100, trace_alloc=False):
+    """Chạy cả luồng enqueue -> gửi -> +CMT -> giải mã -> ghép -> sink trên LoopbackSerial
+
+    In số tin nhắn/giây từ lúc thêm vào queue tới khi sink nhận đủ, và số block bộ nhớ cấp
+    phát thêm (sys.getallocatedblocks); trace_alloc: tracemalloc đỉnh và các dòng giữ nhiều bộ nhớ nhất
+    sau khi chạy (chậm hơn nhiều, chỉ để tìm chỗ cấp phát).
+    """
+    import gc
+    import tempfile
+    from sms_admission import AdmissionController
+    from sms_handler import SimpleSMSHandler
+    from sms_multiport import MultiPortListener
+    from sms_pacing import SendPacer
+
+    import tracemalloc
+    with tempfile.TemporaryDirectory() as tmp:
+        queue_file = os.path.join(tmp, 'queue.txt')
+        names = [f'loop{i}' for i in range(ports)]
+        listener = MultiPortListener(names, queue_file=queue_file, transport=LoopbackSerial.transport(),
+                                     reorder_window=0)
+        received = []
+        listener.ordered.sinks = [received.append]
+        for handler in listener.handlers:
+            handler.timeout = 0.2
+            # Không giới hạn tốc độ/độ sâu: đo trần phần mềm
+            handler.pacer = SendPacer(handler.port, min_gap=1e-6, initial_gap=1e-6, max_per_minute=0,
+                                      max_per_hour=0)
+            handler.admission = AdmissionController(queue_file, max_depth=0, max_age=0)
+            handler.dedupe_window = 0
+        listener.reassembler.merge_window = 0
+        if not listener.connect():
+            print("❌ Không kết nối được LoopbackSerial")
+            return None
+
+        # Mỗi tin một số nhận khác nhau (dạng 84 + 10 số như PDUEncoder): tin nhắn rời không bị ghép
+        text = ('Tin nhắn thử nghiệm loopback ' * (length // 29 + 1))[:length]
+        messages = [(f'849{i:09d}', f'{i} {text}') for i in range(count)]
+        gc.collect()
+        if trace_alloc:
+            # Chỉ theo dõi phần đo (không tính import và kết nối), so với ảnh chụp trước khi chạy
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+        blocks = sys.getallocatedblocks()
+        collections = sum(stat['collections'] for stat in gc.get_stats())
+        start = time.perf_counter()
+        listener.handlers[0].add_many_to_queue(messages)
+        enqueued = time.perf_counter()
+        thread = threading.Thread(target=listener.listen_sms, daemon=True)
+        thread.start()
+        deadline = time.time() + max(60, count / 50)
+        while len(received) < count and time.time() < deadline:
+            time.sleep(0.005)
+            listener.reassembler.check_pending()
+            listener.ordered.flush()
+        elapsed = time.perf_counter() - start
+        delivered = len(received)
+        blocks = sys.getallocatedblocks() - blocks
+        collections = sum(stat['collections'] for stat in gc.get_stats()) - collections
+        if trace_alloc:
+            peak = tracemalloc.get_traced_memory()[1]
+            top = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:10]
+            tracemalloc.stop()
+        # Dừng vòng select trước khi đóng selector
+        listener.is_listening = False
+        thread.join(timeout=5)
+        listener.stop_listening()
+        listener.disconnect()
+
+    parts = sum(message.parts for message in received)
+    print(f"🔁 {delivered}/{count} tin nhắn ({parts} phần, {ports} cổng) trong {elapsed:.2f}s: "
+          f"{delivered / elapsed:,.0f} tin/giây (thêm vào queue {(enqueued - start) * 1000:.0f} ms)")
+    print(f"🧮 +{blocks:,} block bộ nhớ ({blocks / max(delivered, 1):.1f}/tin), {collections} lần gc")
+    if trace_alloc:
+        print(f"📈 tracemalloc đỉnh {peak / 1e6:.1f} MB")
+        for stat in top:
+            print(f"   {stat}")
+    return delivered / elapsed
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    trace_alloc = '--tracemalloc' in args
+    args = [arg for arg in args if arg != '--tracemalloc']
+    if args and args[0] == 'bench':
+        bench(int(args[1]) if len(args) > 1 else 2000, int(args[2]) if len(args) > 2 else 1,
+              int(args[3]) if len(args) > 3 else 100, trace_alloc)
+    else:
+        print("Sử dụng:")
+        print("  python sms_loopback.py bench [số_tin] [số_cổng] [độ_dài] [--tracemalloc]  # Đo trần phần mềm cả luồng gửi/nhận")
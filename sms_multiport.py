@@ -0,0 +1,179 @@
+import time
+import queue
+import selectors
+import threading
+from functools import partial
+from sms_handler import SimpleSMSHandler
+from sms_inbound import SMSReassembler, SenderOrderBuffer, decode_pdu, log_message
+from sms_store import SMSStore
+from sms_webhook import WebhookForwarder
+from sms_health import HealthSampler
+from sms_trace import trace_path_for
+from sms_logging import fields, get_logger
+
+log = get_logger('multiport')
+
+
+class MultiPortListener:
+    """Nghe nhiều modem trong một thread (selectors), ghép tin nhắn chung cho mọi cổng
+
+    Các phần của một tin nhắn multipart có thể đến qua các modem khác nhau; tin nhắn hoàn
+    chỉnh được gắn modem/ICCID/IMSI và xuất theo thứ tự SCTS của từng người gửi.
+    Mỗi modem vẫn gửi tin nhắn từ shard queue của mình (steal từ shard khác khi rảnh).
+    """
+    def __init__(self, ports, baudrate=115200, queue_file='/tmp/sms_queue.txt', queue_dir=None, store_path=None,
+                 store_retention_days=None, webhook_url=None, reorder_window=2.0, transport=None, trace_dir=None,
+                 autoreply_rules=None, cluster_queue=None, reassembly_checkpoint=None):
+        self.ports = list(ports)
+        self.handlers = [SimpleSMSHandler(port, baudrate, queue_file=queue_file, queue_shards=len(self.ports),
+                                          shard_index=index, queue_dir=queue_dir, transport=transport,
+                                          trace_path=trace_path_for(trace_dir, port) if trace_dir else None,
+                                          cluster_queue=cluster_queue)
+                         for index, port in enumerate(self.ports)]
+        if cluster_queue:
+            # Một LeasedQueue cho mọi modem (lô claim giữ theo shard_index), dừng thì trả lại hết
+            for handler in self.handlers[1:]:
+                handler.file_queue = self.handlers[0].file_queue
+        sinks = [log_message]
+        self.store = None
+        if store_path:
+            self.store = SMSStore(store_path, retention_days=store_retention_days)
+            sinks.append(self.store.add)
+        self.webhook = None
+        if webhook_url:
+            self.webhook = WebhookForwarder(webhook_url)
+            sinks.append(self.webhook.add)
+        # Trả lời qua queue chung: modem nào rảnh thì gửi (shard theo số người nhận)
+        self.autoreply = None
+        if autoreply_rules:
+            from sms_autoreply import AutoReplyEngine
+            self.autoreply = AutoReplyEngine(autoreply_rules, self.handlers[0].add_to_queue)
+            sinks.append(self.autoreply.add)
+        self.ordered = SenderOrderBuffer(sinks, reorder_window)
+        self.reassembler = SMSReassembler(sinks=[self.ordered.add], checkpoint_path=reassembly_checkpoint,
+                                          deferred_ack=True)
+        # Checkpoint chỉ đánh dấu đã xuất khi SenderOrderBuffer đã chuyển tin nhắn cho các sink
+        self.ordered.on_delivered = self.reassembler.ack
+        self.selector = None
+        # Cổng đã kết nối lại (từ thread reconnect), vòng select đăng ký lại
+        self._reconnected = queue.SimpleQueue()
+        self.health_sampler = None
+        self.is_listening = False
+        self.stats = {'pdus': 0, 'decode_errors': 0}
+
+    def connect(self):
+        """Kết nối các modem, đọc thông tin SIM; trả về True nếu có ít nhất một modem"""
+        connected = 0
+        for handler in self.handlers:
+            if handler.connect():
+                self.reassembler.sim_info[handler.port] = handler.read_sim_info()
+                connected += 1
+        log.info("Đã kết nối modem", extra=fields(connected=connected, total=len(self.handlers)))
+        return connected > 0
+
+    def disconnect(self):
+        for handler in self.handlers:
+            handler.disconnect()
+
+    def listen_sms(self):
+        """Vòng select đọc tất cả cổng, kiểm tra tin nhắn chờ mỗi giây"""
+        self.is_listening = True
+        self.selector = selectors.DefaultSelector()
+        for handler in self.handlers:
+            handler.is_listening = True
+            threading.Thread(target=handler._process_file_queue, daemon=True).start()
+            if handler.ser is None or not handler.ser.is_open:
+                # Không kết nối được lúc đầu: thử lại với backoff như cổng bị mất kết nối
+                threading.Thread(target=self._reconnect_port, args=(handler,), daemon=True).start()
+                continue
+            self._register(handler)
+        self.handlers[0].file_queue.start_compactor()
+        # Một scheduler cho mọi modem: nhả tin nhắn hẹn giờ rồi đánh thức thread gửi của tất cả
+        scheduler = self.handlers[0].scheduler
+        scheduler.on_release = self._wake_senders
+        scheduler.start()
+        # Một thread lấy mẫu cho mọi modem (bỏ qua modem chưa kết nối), trả lời đi qua vòng select
+        self.health_sampler = HealthSampler(self.handlers).start()
+        log.info("Đang lắng nghe tin nhắn SMS", extra=fields(ports=len(self.selector.get_map())))
+
+        last_check = time.time()
+        while self.is_listening:
+            while not self._reconnected.empty():
+                self._register(self._reconnected.get())
+
+            if self.selector.get_map():
+                events = self.selector.select(timeout=0.5)
+            else:
+                events = []
+                time.sleep(0.5)  # mọi cổng đang kết nối lại
+            for key, _ in events:
+                handler, on_pdu = key.data
+                try:
+                    ser = handler.ser
+                    handler.feed(ser.read(ser.in_waiting or 1), on_pdu)
+                except Exception as e:
+                    if not self.is_listening:
+                        break
+                    log.error("Lỗi đọc serial, đang kết nối lại: %s", e, extra=fields(modem=handler.port))
+                    self.selector.unregister(key.fileobj)
+                    # Kết nối lại ở thread riêng để các cổng khác vẫn được đọc
+                    threading.Thread(target=self._reconnect_port, args=(handler,), daemon=True).start()
+
+            now = time.time()
+            if now - last_check >= 1:
+                self.reassembler.check_pending(now)
+                self.ordered.flush(now)
+                last_check = now
+
+    def _wake_senders(self):
+        for handler in self.handlers:
+            handler.wakeup.set()
+
+    def _reconnect_port(self, handler):
+        if handler.reconnect():
+            self._reconnected.put(handler)
+            # SIM có thể đã bị thay khi mất kết nối: đọc lại qua arbiter, vòng select đọc trả lời
+            self.reassembler.sim_info[handler.port] = handler.read_sim_info(arbiter=True)
+
+    def _register(self, handler):
+        # Handler tự tách dòng (PDU, trả lời AT+CMGS, mẫu health), listener chỉ nhận PDU
+        self.selector.register(handler.ser, selectors.EVENT_READ, (handler, partial(self._handle_pdu, handler.port)))
+
+    def _handle_pdu(self, port, pdu_line):
+        self.stats['pdus'] += 1
+        try:
+            sender, scts, content, multipart_info = decode_pdu(pdu_line)
+            self.reassembler.add(sender, scts, content, multipart_info, modem=port)
+        except Exception as e:
+            self.stats['decode_errors'] += 1
+            log.error("Lỗi phân tích PDU: %s", e, extra=fields(modem=port, pdu=pdu_line))
+
+    def health_metrics(self):
+        """Số liệu health của từng modem"""
+        return [handler.health.metrics() for handler in self.handlers]
+
+    def pacing_metrics(self):
+        """Tốc độ gửi hiện tại của từng modem"""
+        return [handler.pacer.metrics() for handler in self.handlers]
+
+    def stop_listening(self):
+        """Dừng nghe, xuất nốt tin nhắn đang chờ rồi dừng các sink"""
+        self.is_listening = False
+        for handler in self.handlers:
+            handler.is_listening = False
+        self.handlers[0].file_queue.close()
+        self.handlers[0].scheduler.stop()
+        if self.health_sampler:
+            self.health_sampler.stop()
+        if self.reassembler.checkpoint is None:
+            # Không có checkpoint: xuất nốt thay vì bỏ các phần đang chờ
+            self.reassembler.check_pending(float('inf'))
+        self.ordered.flush(float('inf'))
+        self.reassembler.close()
+        if self.store:
+            self.store.stop()
+        if self.webhook:
+            self.webhook.stop()
+        if self.selector:
+            self.selector.close()
+        log.info("Đã dừng lắng nghe tin nhắn", extra=fields(ports=len(self.handlers)))
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+from collections import deque
+from sms_logging import fields, get_logger
+
+log = get_logger('pacing')
+
+# Giới hạn của nhà mạng cho mỗi SIM (0: không giới hạn)
+MAX_PER_MINUTE = int(os.environ.get('SMS_MAX_PER_MINUTE', '30'))
+MAX_PER_HOUR = int(os.environ.get('SMS_MAX_PER_HOUR', '0'))
+
+# +CMS ERROR cho thấy mạng đang nghẽn/giới hạn: giảm tốc độ
+THROTTLE_CODES = {38, 41, 42, 47, 331, 332}
+
+
+class SendPacer:
+    """Điều chỉnh khoảng cách giữa các tin nhắn theo AIMD từ phản hồi thực tế của modem
+
+    Mỗi tin nhắn (segment) gửi thành công tăng tốc độ thêm increase_step tin/giây;
+    +CMS ERROR do nghẽn mạng, timeout hoặc độ trễ ack tăng vọt thì tốc độ giảm một nửa.
+    Tốc độ luôn nằm trong [1/max_gap, 1/min_gap] và giới hạn theo phút/giờ của nhà mạng.
+    """
+    def __init__(self, port=None, min_gap=0.5, max_gap=30.0, initial_gap=2.0, increase_step=0.05,
+                 decrease_factor=0.5, max_per_minute=MAX_PER_MINUTE, max_per_hour=MAX_PER_HOUR,
+                 slow_ack_factor=3.0):
+        self.port = port
+        self.min_rate = 1.0 / max_gap
+        self.max_rate = 1.0 / min_gap
+        self.rate = min(self.max_rate, max(self.min_rate, 1.0 / initial_gap))
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.max_per_minute = max_per_minute
+        self.max_per_hour = max_per_hour
+        self.slow_ack_factor = slow_ack_factor
+        self.latency_ewma = None
+        self.latency_floor = None   # độ trễ ack thấp nhất (đã làm mượt) khi mạng tốt
+        self.outcomes = deque(maxlen=100)
+        self._sent = deque()        # thời điểm gửi trong giờ gần nhất
+        self._last_send = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'sent': 0, 'errors': 0, 'throttled': 0, 'timeouts': 0, 'increases': 0, 'decreases': 0,
+                      'last_decision': None, 'last_error': None}
+
+    @property
+    def gap(self):
+        return 1.0 / self.rate
+
+    def delay(self, now=None):
+        """Số giây cần chờ trước khi gửi segment tiếp theo"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            wait = self._last_send + self.gap - now
+            while self._sent and now - self._sent[0] >= 3600:
+                self._sent.popleft()
+            if self.max_per_minute:
+                minute = [t for t in self._sent if now - t < 60]
+                if len(minute) >= self.max_per_minute:
+                    wait = max(wait, minute[-self.max_per_minute] + 60 - now)
+            if self.max_per_hour and len(self._sent) >= self.max_per_hour:
+                wait = max(wait, self._sent[-self.max_per_hour] + 3600 - now)
+        return max(0.0, wait)
+
+    def wait(self):
+        time.sleep(self.delay())
+
+    def sent(self, now=None):
+        """Gọi ngay khi ghi PDU ra modem"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self._last_send = now
+            self._sent.append(now)
+
+    def record(self, latency, error_code=None, timeout=False):
+        """Kết quả một segment: latency là thời gian từ lúc ghi PDU tới +CMGS/+CMS ERROR"""
+        with self.lock:
+            self.outcomes.append(not timeout and error_code is None)
+            if timeout:
+                self.stats['timeouts'] += 1
+                self._decrease('timeout')
+                return
+            if error_code is not None:
+                self.stats['errors'] += 1
+                self.stats['last_error'] = error_code
+                if error_code in THROTTLE_CODES:
+                    self.stats['throttled'] += 1
+                    self._decrease(f'cms_{error_code}')
+                else:
+                    # Lỗi của riêng tin nhắn (số sai, PDU sai...): giữ nguyên tốc độ
+                    self.stats['last_decision'] = 'hold'
+                return
+
+            self.stats['sent'] += 1
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            if self.latency_floor is None or self.latency_ewma < self.latency_floor:
+                self.latency_floor = self.latency_ewma
+            if self.latency_ewma > self.slow_ack_factor * self.latency_floor and self.latency_ewma > 1.0:
+                # Ack chậm dần: mạng sắp nghẽn, giảm trước khi bị từ chối
+                self._decrease('slow_ack')
+            else:
+                self._increase()
+
+    def _increase(self):
+        rate = min(self.max_rate, self.rate + self.increase_step)
+        self.stats['last_decision'] = 'increase' if rate > self.rate else 'hold'
+        if rate > self.rate:
+            self.stats['increases'] += 1
+        self.rate = rate
+
+    def _decrease(self, reason):
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        self.stats['decreases'] += 1
+        self.stats['last_decision'] = f'decrease:{reason}'
+        log.warning("Giảm tốc độ gửi", extra=fields(modem=self.port, reason=reason, gap_s=round(self.gap, 2)))
+
+    def metrics(self):
+        """Quyết định hiện tại của bộ điều tốc"""
+        with self.lock:
+            now = time.time()
+            metrics = dict(self.stats)
+            metrics.update({
+                'modem': self.port,
+                'gap_s': round(self.gap, 3),
+                'rate_per_minute': round(min(self.rate * 60, self.max_per_minute or float('inf')), 1),
+                'ack_latency_ms': round(self.latency_ewma * 1000) if self.latency_ewma is not None else None,
+                'error_rate': 1 - sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0,
+                'sent_last_minute': sum(1 for t in self._sent if now - t < 60)
+            })
+        return metrics
+
+
+# Hàm utility để mô phỏng
+def simulate(messages=300, capacity_per_minute=20):
+    """Mô phỏng nhà mạng trả +CMS ERROR 42 khi vượt capacity_per_minute, in tốc độ hội tụ"""
+    pacer = SendPacer('sim', max_per_minute=0)
+    now = 0.0
+    accepted = []
+    for i in range(messages):
+        now += pacer.delay(now)
+        pacer.sent(now)
+        accepted = [t for t in accepted if now - t < 60]
+        if len(accepted) >= capacity_per_minute:
+            pacer.record(0.5, error_code=42)
+        else:
+            accepted.append(now)
+            pacer.record(0.5)
+        now += 0.5
+        if (i + 1) % 50 == 0:
+            m = pacer.metrics()
+            print(f"{i + 1:4d} tin: gap {m['gap_s']:.2f}s, lỗi {m['error_rate']:.0%}, "
+                  f"đã gửi {m['sent']} trong {now / 60:.1f} phút ({m['sent'] / now * 60:.1f} tin/phút)")
+
+
+if __name__ == '__main__':
+    simulate()
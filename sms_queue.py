@@ -0,0 +1,598 @@
+import os
+import re
+import glob
+import time
+import zlib
+import mmap
+import fcntl
+import shutil
+import itertools
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from sms_records import QueueRecord
+from sms_logging import fields, get_logger
+
+log = get_logger('queue')
+
+SEGMENT_RE = re.compile(r'seg-(\d{8})-(\d+)\.log$')
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_SEGMENT_AGE = 3600
+# Kích thước khối khi đếm dòng để nhảy tới số thứ tự dòng
+SCAN_CHUNK = 1024 * 1024
+
+
+@contextmanager
+def file_lock(path):
+    """Khóa độc quyền giữa các process bằng flock trên file .lock riêng"""
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def as_datetime(value):
+    """datetime, epoch hoặc chuỗi ISO -> datetime (None giữ nguyên)"""
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return datetime.fromisoformat(str(value))
+
+
+def _skip_lines(mm, pos, count):
+    """Vị trí sau count dòng tính từ pos, đếm theo khối SCAN_CHUNK (không tách từng dòng)"""
+    size = len(mm)
+    while count > 0 and pos < size:
+        chunk = mm[pos:pos + SCAN_CHUNK]
+        lines = chunk.count(b'\n')
+        if lines < count:
+            count -= lines
+            pos += len(chunk)
+            continue
+        end = -1
+        for _ in range(count):
+            end = chunk.find(b'\n', end + 1)
+        return pos + end + 1
+    return size if count > 0 else pos
+
+
+def iter_records(path, offset=0, record=0, phone=None, since=None, until=None):
+    """Duyệt lười các tin nhắn trong một file queue qua mmap, trả về QueueRecord
+
+    Bộ nhớ dùng không phụ thuộc kích thước file: chỉ dòng đang xét được copy ra và parse.
+    offset: bắt đầu từ byte này (giữa dòng thì sang dòng sau); record: bỏ qua thêm chừng ấy dòng.
+    phone: chỉ tin nhắn tới số này (lọc thô bằng bytes trước khi parse); since/until (datetime,
+    epoch hoặc ISO): theo thời gian ghi trong dòng, dòng không có thời gian bị bỏ qua.
+    Dòng không hợp lệ bị bỏ qua; dòng cuối chưa có xuống dòng (producer đang ghi) không được đọc.
+    """
+    since, until = as_datetime(since), as_datetime(until)
+    needle = phone.encode('utf-8') if phone else None
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0 or offset >= size:
+            return
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            pos = offset
+            if pos > 0 and mm[pos - 1] != 0x0A:
+                pos = mm.find(b'\n', pos) + 1 or size
+            # Số thứ tự dòng chỉ biết khi đọc từ đầu file
+            number = record if offset == 0 else None
+            pos = _skip_lines(mm, pos, record)
+            while pos < size:
+                if needle is not None:
+                    # Nhảy thẳng tới dòng tiếp theo có chứa số cần tìm
+                    hit = mm.find(needle, pos)
+                    if hit < 0:
+                        break
+                    line_start = max(pos, mm.rfind(b'\n', pos, hit) + 1)
+                    if number is not None and line_start > pos:
+                        number += mm[pos:line_start].count(b'\n')
+                    pos = line_start
+                end = mm.find(b'\n', pos)
+                if end < 0:
+                    break
+                start, pos = pos, end + 1
+                index = number
+                if number is not None:
+                    number += 1
+                raw = mm[start:end]
+                if needle is not None and needle not in raw:
+                    continue
+                item = QueueRecord.parse(raw.decode('utf-8', errors='replace'), start, index)
+                if item is None or (phone and item.phone != phone):
+                    continue
+                if since or until:
+                    written_at = item.written_at
+                    if written_at is None or (since and written_at < since) or (until and written_at > until):
+                        continue
+                yield item
+
+
+class QueueClaim:
+    """Tin nhắn đã được consumer lấy ra, chờ ack/nack"""
+    __slots__ = ('line', 'shard', 'stolen', 'position')
+
+    def __init__(self, line, shard, stolen=False, position=None):
+        self.line = line
+        self.shard = shard
+        self.stolen = stolen
+        self.position = position  # (segment_id, offset, next_offset, base) trong shard
+
+
+class FileQueueShard:
+    """Một shard của queue: các segment chỉ ghi thêm và một cursor đọc
+
+    - segmented=False: path là file queue cũ, chính nó là segment duy nhất,
+      cursor lưu ở path.cursor. Phần đã đọc dài quá max_segment_bytes được cắt bỏ
+      (base: tổng số byte đã cắt, để ack của dòng đang gửi vẫn đúng vị trí).
+    - segmented=True: path là thư mục chứa seg-<id>-<tạo lúc>.log, tự xoay segment
+      theo kích thước/thời gian.
+    Consumer chỉ dịch cursor, không bao giờ ghi lại file đang dùng. Segment đã đọc
+    hết được compact() xóa hoặc chuyển vào archive_dir.
+    """
+    def __init__(self, path, segmented=False, max_segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 max_segment_age=DEFAULT_SEGMENT_AGE, archive_dir=None):
+        self.path = path
+        self.segmented = segmented
+        self.max_segment_bytes = max_segment_bytes
+        self.max_segment_age = max_segment_age
+        self.archive_dir = archive_dir
+        if segmented:
+            os.makedirs(path, exist_ok=True)
+            self.lock_path = os.path.join(path, 'queue')
+            self.cursor_path = os.path.join(path, 'cursor')
+            self.pause_path = os.path.join(path, 'paused')
+            self.drain_path = os.path.join(path, 'drain')
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.lock_path = path
+            self.cursor_path = path + '.cursor'
+            self.pause_path = path + '.paused'
+            self.drain_path = path + '.drain'
+
+    # --- segment & cursor ---
+
+    def _segments(self):
+        """Danh sách (id, tạo_lúc, đường_dẫn) theo thứ tự"""
+        if not self.segmented:
+            return [(0, 0, self.path)] if os.path.exists(self.path) else []
+        segments = []
+        for name in os.listdir(self.path):
+            m = SEGMENT_RE.match(name)
+            if m:
+                segments.append((int(m.group(1)), int(m.group(2)), os.path.join(self.path, name)))
+        segments.sort()
+        return segments
+
+    def _load_cursor(self):
+        """(segment_id, offset, base) như đã ghi"""
+        try:
+            with open(self.cursor_path, 'r') as f:
+                values = [int(value) for value in f.read().split()]
+            return values[0], values[1], values[2] if len(values) > 2 else 0
+        except (OSError, ValueError, IndexError):
+            return 0, 0, 0
+
+    def _read_cursor(self, segments):
+        seg_id, offset, _ = self._load_cursor()
+        if segments and seg_id < segments[0][0]:
+            seg_id, offset = segments[0][0], 0
+        return seg_id, offset
+
+    def _write_cursor(self, seg_id, offset, base=None):
+        if base is None:
+            base = self._load_cursor()[2]
+        tmp_path = self.cursor_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(f"{seg_id} {offset} {base}\n" if base else f"{seg_id} {offset}\n")
+        os.replace(tmp_path, self.cursor_path)
+
+    def _new_segment(self, segments):
+        seg_id = segments[-1][0] + 1 if segments else 1
+        now = int(time.time())
+        path = os.path.join(self.path, f"seg-{seg_id:08d}-{now}.log")
+        open(path, 'ab').close()
+        return seg_id, now, path
+
+    # --- producer ---
+
+    def append_lines(self, lines):
+        """Ghi thêm các dòng vào cuối segment đang mở (xoay segment nếu cần)"""
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        with file_lock(self.lock_path):
+            self._append_data(data)
+
+    def _append_data(self, data):
+        """Ghi data vào segment đang mở (gọi khi đang giữ khóa)"""
+        if self.segmented:
+            segments = self._segments()
+            if not segments:
+                segments.append(self._new_segment(segments))
+            seg_id, created, path = segments[-1]
+            size = os.path.getsize(path)
+            if size and (size >= self.max_segment_bytes or time.time() - created >= self.max_segment_age):
+                seg_id, created, path = self._new_segment(segments)
+        else:
+            path = self.path
+        with open(path, 'ab') as f:
+            f.write(data)
+
+    # --- consumer ---
+
+    def _head(self, segments, seg_id, offset):
+        """Vị trí (segment_id, offset, next_offset) và nội dung dòng đầu chưa xử lý"""
+        for sid, _, path in segments:
+            if sid < seg_id:
+                continue
+            if sid > seg_id:
+                offset = 0
+            with open(path, 'rb') as f:
+                if offset > os.fstat(f.fileno()).st_size:
+                    offset = 0  # file đã bị ghi lại từ bên ngoài
+                f.seek(offset)
+                raw = f.readline()
+            if raw.endswith(b'\n'):
+                return raw, (sid, offset, offset + len(raw))
+            if raw:
+                return None  # producer đang ghi dở dòng cuối
+        return None
+
+    def peek(self):
+        """Dòng đầu tiên chưa xử lý: (line, position) hoặc None"""
+        with file_lock(self.lock_path):
+            segments = self._segments()
+            head = self._head(segments, *self._read_cursor(segments))
+            base = self._load_cursor()[2]
+        if head is None:
+            return None
+        raw, position = head
+        return raw.decode('utf-8', errors='replace').strip(), (*position, base)
+
+    def ack(self, position):
+        """Dịch cursor qua dòng đã xử lý"""
+        sid, offset, next_offset, base = position
+        with file_lock(self.lock_path):
+            cur_sid, cur_offset = self._read_cursor(self._segments())
+            # compact() đã cắt phần đầu file từ lúc peek: dời vị trí theo số byte đã cắt
+            next_offset -= self._load_cursor()[2] - base
+            if (sid, next_offset) > (cur_sid, cur_offset):
+                self._write_cursor(sid, next_offset)
+
+    def move_tail(self, target):
+        """Chuyển dòng cuối cùng chưa xử lý (trừ dòng đầu) sang cuối shard target (modem khác steal)
+
+        Ghi vào target trước rồi mới cắt ở shard này, dưới khóa của cả hai shard (lấy theo thứ
+        tự đường dẫn để hai modem steal lẫn nhau không bị deadlock): process chết giữa chừng thì
+        tin nhắn có thể bị gửi hai lần chứ không mất. Trả về dòng đã chuyển hoặc None.
+        """
+        first, second = sorted((self.lock_path, target.lock_path))
+        with file_lock(first), file_lock(second):
+            tail = self._tail()
+            if tail is None:
+                return None
+            path, start, raw = tail
+            target._append_data(raw)
+            os.truncate(path, start)
+        return raw.decode('utf-8', errors='replace').strip()
+
+    def _tail(self):
+        """(segment, vị trí, nội dung) của dòng cuối có thể steal, None nếu không có (gọi khi đang giữ khóa)"""
+        segments = self._segments()
+        head = self._head(segments, *self._read_cursor(segments))
+        if head is None:
+            return None
+        # Không lấy dòng đầu: modem sở hữu shard có thể đang gửi nó (trừ khi shard đang tạm dừng)
+        head_sid, head_start, head_end = head[1]
+        head_floor = head_start if self.paused else head_end
+        for sid, _, path in reversed(segments):
+            if sid < head_sid:
+                break
+            floor = head_floor if sid == head_sid else 0
+            size = os.path.getsize(path)
+            if size <= floor:
+                continue
+            start = self._last_line_start(path, floor, size)
+            if start is None:
+                return None
+            with open(path, 'rb') as f:
+                f.seek(start)
+                return path, start, f.read(size - start)
+        return None
+
+    @property
+    def paused(self):
+        return os.path.exists(self.pause_path)
+
+    def set_paused(self, paused):
+        """Tạm dừng shard (modem sở hữu không gửi được): modem khác được lấy cả dòng đầu"""
+        with file_lock(self.lock_path):
+            if paused:
+                open(self.pause_path, 'a').close()
+            elif os.path.exists(self.pause_path):
+                os.remove(self.pause_path)
+
+    @staticmethod
+    def _last_line_start(path, floor, size):
+        block = 4096
+        with open(path, 'rb') as f:
+            while True:
+                read_from = max(floor, size - block)
+                f.seek(read_from)
+                data = f.read(size - read_from)
+                if not data.endswith(b'\n'):
+                    return None  # dòng cuối chưa ghi xong
+                idx = data.rfind(b'\n', 0, len(data) - 1)
+                if idx != -1:
+                    return read_from + idx + 1
+                if read_from == floor:
+                    return floor
+                block *= 4
+
+    def records(self, phone=None, since=None, until=None):
+        """Duyệt lười các tin nhắn chưa xử lý (từ cursor), lọc như iter_records"""
+        segments = self._segments()
+        seg_id, offset = self._read_cursor(segments)
+        for sid, _, path in segments:
+            if sid >= seg_id:
+                yield from iter_records(path, offset if sid == seg_id else 0, phone=phone, since=since, until=until)
+
+    def size(self):
+        """Tổng số byte các segment (kể cả phần đã xử lý chưa được dọn)"""
+        total = 0
+        for _, _, path in self._segments():
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+        return total
+
+    def pending_bytes(self):
+        """Số byte chưa xử lý (ước lượng độ dài shard mà không phải đọc file)"""
+        segments = self._segments()
+        seg_id, offset = self._read_cursor(segments)
+        total = 0
+        for sid, _, path in segments:
+            if sid >= seg_id:
+                try:
+                    total += max(0, os.path.getsize(path) - (offset if sid == seg_id else 0))
+                except OSError:
+                    pass
+        return total
+
+    def count(self):
+        """Số dòng chưa xử lý"""
+        segments = self._segments()
+        seg_id, offset = self._read_cursor(segments)
+        count = 0
+        for sid, _, path in segments:
+            if sid < seg_id:
+                continue
+            with open(path, 'rb') as f:
+                if sid == seg_id and offset <= os.fstat(f.fileno()).st_size:
+                    f.seek(offset)
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    count += chunk.count(b'\n')
+        return count
+
+    # --- compaction ---
+
+    def compact(self):
+        """Xóa/lưu trữ các segment đã đọc hết, trả về số segment đã dọn"""
+        removed = 0
+        with file_lock(self.lock_path):
+            segments = self._segments()
+            seg_id, offset = self._read_cursor(segments)
+
+            if not self.segmented:
+                if not segments or not offset:
+                    return removed
+                base = self._load_cursor()[2] + offset
+                if offset == os.path.getsize(self.path):
+                    # Đã đọc hết: cắt về 0
+                    if self.archive_dir:
+                        self._archive(self.path, copy=True)
+                    os.truncate(self.path, 0)
+                    self._write_cursor(0, 0, base)
+                    removed = 1
+                elif offset >= self.max_segment_bytes:
+                    # Queue không bao giờ rỗng: chép phần chưa đọc sang file mới rồi thay thế (producer
+                    # ghi dưới cùng khóa nên không mất dòng nào)
+                    tmp_path = self.path + '.compact'
+                    with open(self.path, 'rb') as src:
+                        if self.archive_dir:
+                            self._archive_prefix(src, offset)
+                        src.seek(offset)
+                        with open(tmp_path, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, SCAN_CHUNK)
+                    os.replace(tmp_path, self.path)
+                    self._write_cursor(0, 0, base)
+                    removed = 1
+                return removed
+
+            # Segment đang ghi (cuối cùng) luôn được giữ lại
+            for sid, _, path in segments[:-1]:
+                size = os.path.getsize(path)
+                consumed = sid < seg_id or (sid == seg_id and offset >= size)
+                # Segment rỗng (bị steal hết) cũng không còn gì để đọc
+                if not consumed and size:
+                    break
+                if self.archive_dir:
+                    self._archive(path)
+                else:
+                    os.remove(path)
+                removed += 1
+        return removed
+
+    def _archive_prefix(self, src, length):
+        """Lưu trữ length byte đầu của file queue (phần đã gửi)"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        target = os.path.join(self.archive_dir, f"{int(time.time())}-{os.path.basename(self.path)}")
+        src.seek(0)
+        with open(target, 'ab') as dst:
+            while length > 0:
+                chunk = src.read(min(SCAN_CHUNK, length))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                length -= len(chunk)
+
+    def _archive(self, path, copy=False):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        target = os.path.join(self.archive_dir, f"{int(time.time())}-{os.path.basename(path)}")
+        if copy:
+            shutil.copyfile(path, target)
+        else:
+            os.replace(path, target)
+
+
+class ShardedFileQueue:
+    """File queue chia shard theo modem, modem rảnh steal từ shard dài nhất
+
+    Khi không có queue_dir: shard 0 chính là queue_file, các shard khác là
+    queue_file.1, queue_file.2, ... nên producer cũ (chỉ ghi vào queue_file) vẫn
+    hoạt động bình thường.
+    Khi có queue_dir: mỗi shard là thư mục queue_dir/shard-<i> chứa các segment.
+    """
+    def __init__(self, queue_file='/tmp/sms_queue.txt', shards=1, mode='hash', queue_dir=None,
+                 max_segment_bytes=DEFAULT_SEGMENT_BYTES, max_segment_age=DEFAULT_SEGMENT_AGE, archive_dir=None):
+        self.queue_file = queue_file
+        self.queue_dir = queue_dir
+        if shards is None:
+            shards = self.discover_shards(queue_file, queue_dir)
+        self.mode = mode  # 'hash': theo số điện thoại, 'round_robin': xoay vòng
+        self.shards = [
+            FileQueueShard(self.shard_path(queue_file, i, queue_dir), segmented=bool(queue_dir),
+                           max_segment_bytes=max_segment_bytes, max_segment_age=max_segment_age,
+                           archive_dir=archive_dir)
+            for i in range(max(1, shards))
+        ]
+        self._round_robin = itertools.count()
+        self._compactor = None
+        self._compactor_stop = threading.Event()
+
+    @staticmethod
+    def shard_path(queue_file, index, queue_dir=None):
+        if queue_dir:
+            return os.path.join(queue_dir, f"shard-{index}")
+        return queue_file if index == 0 else f"{queue_file}.{index}"
+
+    @staticmethod
+    def discover_shards(queue_file, queue_dir=None):
+        """Số shard đang có trên đĩa"""
+        if queue_dir:
+            pattern = re.compile(r'shard-(\d+)$')
+            names = os.listdir(queue_dir) if os.path.isdir(queue_dir) else []
+        else:
+            pattern = re.compile(re.escape(queue_file) + r'\.(\d+)$')
+            names = glob.glob(glob.escape(queue_file) + '.*')
+        indexes = [int(m.group(1)) for m in map(pattern.match, names) if m]
+        return max(indexes, default=0) + 1
+
+    def shard_for(self, phone_number=None):
+        """Chọn shard cho tin nhắn mới"""
+        if len(self.shards) == 1:
+            return 0
+        if self.mode == 'hash' and phone_number:
+            # crc32 ổn định giữa các process, giữ thứ tự tin nhắn cho cùng người nhận
+            return zlib.crc32(phone_number.encode('utf-8')) % len(self.shards)
+        return next(self._round_robin) % len(self.shards)
+
+    def append(self, line, phone_number=None):
+        self.shards[self.shard_for(phone_number)].append_lines([line])
+
+    def append_many(self, items):
+        """Ghi nhiều (line, phone_number), gom theo shard để mỗi shard chỉ mở file một lần"""
+        grouped = {}
+        for line, phone_number in items:
+            grouped.setdefault(self.shard_for(phone_number), []).append(line)
+        for index, lines in grouped.items():
+            self.shards[index].append_lines(lines)
+
+    def next_job(self, shard_index=0, steal=True):
+        """Lấy tin nhắn tiếp theo cho modem: shard của mình trước, sau đó steal"""
+        shard_index %= len(self.shards)
+        head = self.shards[shard_index].peek()
+        if head is not None:
+            line, position = head
+            return QueueClaim(line, shard_index, position=position)
+
+        if steal and len(self.shards) > 1:
+            victims = sorted(((shard.pending_bytes(), i) for i, shard in enumerate(self.shards) if i != shard_index),
+                             reverse=True)
+            own = self.shards[shard_index]
+            for pending, victim in victims:
+                if pending == 0:
+                    break
+                # Dòng steal được nằm trong shard của mình tới khi ack như mọi tin nhắn khác
+                stolen = self.shards[victim].move_tail(own)
+                if stolen is not None:
+                    head = own.peek()
+                    if head is not None:
+                        line, position = head
+                        return QueueClaim(line, shard_index, stolen=line == stolen, position=position)
+        return None
+
+    def ack(self, claim):
+        """Xác nhận đã xử lý xong tin nhắn"""
+        self.shards[claim.shard].ack(claim.position)
+
+    def nack(self, claim):
+        """Xử lý thất bại: dòng vẫn ở đầu shard (kể cả dòng steal được), lần sau gửi lại"""
+
+    def set_paused(self, shard_index, paused):
+        self.shards[shard_index % len(self.shards)].set_paused(paused)
+
+    def drain_path(self, shard_index=0):
+        """File tốc độ gửi (DrainMeter) của modem sở hữu shard"""
+        return self.shards[shard_index % len(self.shards)].drain_path
+
+    def drain_paths(self):
+        return [shard.drain_path for shard in self.shards]
+
+    def records(self, phone=None, since=None, until=None):
+        """Duyệt lười tin nhắn chưa xử lý của mọi shard (theo thứ tự shard)"""
+        for shard in self.shards:
+            yield from shard.records(phone, since, until)
+
+    def counts(self):
+        return [shard.count() for shard in self.shards]
+
+    def count(self):
+        return sum(self.counts())
+
+    def compact(self):
+        return sum(shard.compact() for shard in self.shards)
+
+    def start_compactor(self, interval=60):
+        """Thread nền dọn các segment đã đọc hết"""
+        if self._compactor is None:
+            self._compactor_stop.clear()
+            self._compactor = threading.Thread(target=self._compact_loop, args=(interval,), daemon=True)
+            self._compactor.start()
+
+    def stop_compactor(self):
+        if self._compactor is not None:
+            self._compactor_stop.set()
+            self._compactor.join(timeout=5)
+            self._compactor = None
+
+    def close(self):
+        self.stop_compactor()
+
+    def _compact_loop(self, interval):
+        while not self._compactor_stop.wait(interval):
+            try:
+                removed = self.compact()
+                if removed:
+                    log.info("Đã dọn segment queue", extra=fields(segments=removed))
+            except Exception as e:
+                log.error("Lỗi dọn segment queue: %s", e)
@@ -0,0 +1,249 @@
+import re
+import json
+import base64
+import binascii
+import time
+from datetime import datetime
+
+ENCODED_LINE_RE = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\|[^|]*\|[A-Za-z0-9+/=]*\|END')
+
+
+class InboundPart:
+    """Một tin nhắn rời đang chờ ghép theo thời gian"""
+    __slots__ = ('time', 'content', 'timestamp', 'modem')
+
+    def __init__(self, time, content, timestamp, modem=None):
+        self.time = time            # SCTS (thời gian gửi theo tổng đài)
+        self.content = content
+        self.timestamp = timestamp  # thời điểm nhận (time.time())
+        self.modem = modem          # cổng modem đã nhận
+
+
+class MultipartBuffer:
+    """Các phần của một tin nhắn multipart (cùng sender + ref)"""
+    __slots__ = ('total', 'parts', 'received', 'timestamp', 'first_seen', 'modem')
+
+    def __init__(self, total, first_seen, modem=None):
+        self.total = total
+        self.parts = [None] * total
+        self.received = 0
+        self.timestamp = None       # SCTS sớm nhất trong các phần
+        self.first_seen = first_seen
+        self.modem = modem          # modem nhận phần đầu tiên (các phần có thể đến qua modem khác)
+
+    def add(self, seq_num, content, scts):
+        """Thêm phần thứ seq_num (bắt đầu từ 1), trả về True khi đã đủ phần"""
+        if 1 <= seq_num <= self.total:
+            if self.parts[seq_num - 1] is None:
+                self.received += 1
+            self.parts[seq_num - 1] = content
+        if self.timestamp is None or scts < self.timestamp:
+            self.timestamp = scts
+        return self.received == self.total
+
+    def assemble(self):
+        return ''.join(part for part in self.parts if part is not None)
+
+
+class AssembledMessage:
+    """Tin nhắn đến hoàn chỉnh được đưa tới các sink"""
+    __slots__ = ('kind', 'sender', 'time', 'content', 'parts', 'modem', 'iccid', 'imsi')
+
+    def __init__(self, kind, sender, time, content, parts=1, modem=None, iccid=None, imsi=None):
+        self.kind = kind            # 'single' | 'merged' | 'multipart'
+        self.sender = sender
+        self.time = time
+        self.content = content
+        self.parts = parts
+        self.modem = modem          # cổng modem nhận tin nhắn
+        self.iccid = iccid          # SIM nhận tin nhắn
+        self.imsi = imsi
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __repr__(self):
+        return (f"AssembledMessage({self.kind!r}, {self.sender!r}, {self.time!r}, {self.content!r}, {self.parts}, "
+                f"modem={self.modem!r})")
+
+
+class OutboundJob:
+    """Tin nhắn chờ gửi, parse một lần từ dòng trong file queue"""
+    __slots__ = ('phone', 'message', 'line')
+
+    def __init__(self, phone, message, line=None):
+        self.phone = phone
+        self.message = message
+        self.line = line
+
+    @classmethod
+    def parse(cls, line):
+        """Parse dòng queue (phone|message, JSON hoặc Base64 của FileSMSClient), None nếu không hợp lệ"""
+        line = line.strip()
+        if not line:
+            return None
+
+        if line.startswith('{'):
+            try:
+                data = json.loads(line)
+                return cls(data['phone'], data['message'], line)
+            except (ValueError, KeyError, TypeError):
+                return None
+
+        if line.endswith('|END') and ENCODED_LINE_RE.fullmatch(line):
+            _, phone, encoded_msg, _ = line.split('|')
+            try:
+                return cls(phone, base64.b64decode(encoded_msg).decode('utf-8'), line)
+            except (binascii.Error, UnicodeDecodeError):
+                return None
+
+        if '|' in line:
+            phone, message = line.split('|', 1)
+            return cls(phone, message, line)
+        return None
+
+    def to_line(self):
+        """Dòng ghi vào queue: phone|message, hoặc JSON nếu tin nhắn có xuống dòng"""
+        if '\n' in self.message or '\r' in self.message:
+            return json.dumps({'phone': self.phone, 'message': self.message}, ensure_ascii=False)
+        return f"{self.phone}|{self.message}"
+
+
+class QueueRecord:
+    """Một tin nhắn trong file queue khi duyệt lười (sms_queue.iter_records): vị trí và nội dung"""
+    __slots__ = ('offset', 'number', 'phone', 'message', 'timestamp')
+
+    def __init__(self, offset, number, phone, message, timestamp=None):
+        self.offset = offset        # byte đầu dòng trong file
+        self.number = number        # số thứ tự dòng (từ 0) trong file
+        self.phone = phone
+        self.message = message
+        self.timestamp = timestamp  # chuỗi thời gian ghi trong dòng (JSON/Base64 của FileSMSClient), None nếu không có
+
+    @classmethod
+    def parse(cls, line, offset=None, number=None):
+        """Parse dòng queue như OutboundJob.parse, kèm thời gian nếu dòng có; None nếu không hợp lệ"""
+        line = line.strip()
+        if line.startswith('{'):
+            try:
+                data = json.loads(line)
+                return cls(offset, number, data['phone'], data['message'], data.get('timestamp'))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return None
+        job = OutboundJob.parse(line)
+        if job is None:
+            return None
+        timestamp = line[:19] if line.endswith('|END') and ENCODED_LINE_RE.fullmatch(line) else None
+        return cls(offset, number, job.phone, job.message, timestamp)
+
+    @property
+    def written_at(self):
+        """timestamp dạng datetime (giờ máy), None nếu không có/không đọc được"""
+        if not self.timestamp:
+            return None
+        try:
+            return datetime.fromisoformat(self.timestamp)
+        except (TypeError, ValueError):
+            return None
+
+    def as_dict(self):
+        return {'timestamp': self.timestamp, 'phone': self.phone, 'message': self.message}
+
+
+class EnqueueResult:
+    """Kết quả thêm tin nhắn vào queue; bool() là True nếu tin nhắn sẽ được gửi (kể cả khi trùng)"""
+    __slots__ = ('status', 'phone', 'error', 'retry_after', 'send_at')
+
+    QUEUED = 'queued'
+    SCHEDULED = 'scheduled'     # hẹn giờ, chuyển vào queue lúc send_at (epoch)
+    DUPLICATE = 'duplicate'     # đã có tin nhắn cùng idempotency key/nội dung trong cửa sổ chống trùng
+    REJECTED = 'rejected'       # admission control: queue đầy/chờ quá lâu/hết quota, thử lại sau retry_after giây
+    ERROR = 'error'
+
+    def __init__(self, status, phone=None, error=None, retry_after=None, send_at=None):
+        self.status = status
+        self.phone = phone
+        self.error = error
+        self.retry_after = retry_after
+        self.send_at = send_at
+
+    @property
+    def duplicate(self):
+        return self.status == self.DUPLICATE
+
+    @property
+    def rejected(self):
+        return self.status == self.REJECTED
+
+    @property
+    def scheduled(self):
+        return self.status == self.SCHEDULED
+
+    def __bool__(self):
+        return self.status in (self.QUEUED, self.SCHEDULED, self.DUPLICATE)
+
+    def as_dict(self):
+        result = {'status': self.status, 'phone': self.phone}
+        if self.error:
+            result['message'] = self.error
+        if self.retry_after is not None:
+            result['retry_after'] = round(self.retry_after, 1)
+        if self.send_at is not None:
+            result['send_at'] = datetime.fromtimestamp(self.send_at).isoformat(timespec='seconds')
+        return result
+
+    def __repr__(self):
+        if self.rejected:
+            return f"EnqueueResult({self.status!r}, {self.phone!r}, {self.error!r}, retry_after={self.retry_after!r})"
+        if self.scheduled:
+            return f"EnqueueResult({self.status!r}, {self.phone!r}, send_at={self.send_at!r})"
+        return f"EnqueueResult({self.status!r}, {self.phone!r})"
+
+
+class BatchEnqueueResult:
+    """Kết quả thêm một lô tin nhắn: số đã thêm, số trùng và phần bị admission control từ chối"""
+    __slots__ = ('queued', 'duplicates', 'rejected', 'rejection', 'send_at', 'error')
+
+    def __init__(self, queued=0, duplicates=0, rejected=(), rejection=None, send_at=None, error=None):
+        self.queued = queued            # số tin nhắn đã thêm (hoặc đã hẹn giờ nếu có send_at)
+        self.duplicates = duplicates
+        self.rejected = list(rejected)  # (phone, message, idempotency_key) chưa được thêm, theo thứ tự
+        self.rejection = rejection      # EnqueueResult rejected (lý do, retry_after) hoặc None
+        self.send_at = send_at          # thời điểm gửi (epoch) của lô hẹn giờ
+        self.error = error              # lỗi (send_at không hợp lệ, lỗi ghi): cả lô chưa được thêm
+
+    def __repr__(self):
+        if self.error:
+            return f"BatchEnqueueResult(error={self.error!r})"
+        return (f"BatchEnqueueResult(queued={self.queued}, duplicates={self.duplicates}, "
+                f"rejected={len(self.rejected)})")
+
+
+# Hàm utility để đo bộ nhớ
+def measure_memory(count=100000):
+    """So sánh bộ nhớ của count phần tin nhắn: dict so với InboundPart"""
+    import tracemalloc
+    scts = datetime.now()
+    now = time.time()
+
+    def measure(factory):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        items = [factory(i) for i in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del items
+        return after - before
+
+    contents = [f"Phần {i}" for i in range(count)]
+    dict_bytes = measure(lambda i: {'time': scts, 'content': contents[i], 'timestamp': now})
+    slots_bytes = measure(lambda i: InboundPart(scts, contents[i], now))
+
+    print(f"=== BỘ NHỚ CHO {count:,} PHẦN TIN NHẮN ===")
+    print(f"dict:        {dict_bytes / 1024 / 1024:.2f} MB ({dict_bytes / count:.0f} bytes/phần)")
+    print(f"InboundPart: {slots_bytes / 1024 / 1024:.2f} MB ({slots_bytes / count:.0f} bytes/phần)")
+    print(f"Tiết kiệm: {100 * (1 - slots_bytes / dict_bytes):.0f}%")
+
+
+if __name__ == '__main__':
+    measure_memory()
@@ -0,0 +1,308 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from sms_queue import ShardedFileQueue
+from sms_records import OutboundJob
+from sms_logging import fields, get_logger
+
+log = get_logger('schedule')
+
+# Lịch do process khác thêm (sớm hơn lần thức tiếp theo) được thấy sau tối đa RECHECK giây
+RECHECK = float(os.environ.get('SMS_SCHEDULE_RECHECK', '30'))
+# Số tin nhắn chuyển sang file queue trong một transaction
+RELEASE_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled (
+    id       INTEGER PRIMARY KEY,
+    due      REAL    NOT NULL,   -- thời điểm gửi (epoch giây)
+    phone    TEXT    NOT NULL,
+    message  TEXT    NOT NULL,
+    throttle TEXT,               -- tên throttle, NULL: chuyển sang queue ngay khi đến hạn
+    created  REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_scheduled_due ON scheduled(due);
+CREATE INDEX IF NOT EXISTS idx_scheduled_throttle_due ON scheduled(throttle, due);
+
+CREATE TABLE IF NOT EXISTS throttles (
+    name         TEXT    PRIMARY KEY,
+    per_minute   INTEGER NOT NULL,              -- 0: không giới hạn số lượng
+    window_start TEXT,                          -- khung giờ gửi hằng ngày 'HH:MM', NULL: cả ngày
+    window_end   TEXT,
+    minute       INTEGER NOT NULL DEFAULT 0,    -- phút (epoch // 60) của bộ đếm released
+    released     INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+RELATIVE_RE = re.compile(r'\+(\d+(?:\.\d+)?)([smhd])')
+UNIT_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+WINDOW_RE = re.compile(r'(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})')
+
+
+def schedule_path(queue_file, queue_dir=None):
+    return os.path.join(queue_dir, 'schedule.db') if queue_dir else queue_file + '.schedule.db'
+
+
+def parse_send_at(value, now=None):
+    """send_at -> epoch giây (None: gửi ngay)
+
+    Nhận epoch, datetime, 'YYYY-MM-DD HH:MM[:SS]'/ISO (giờ máy) hoặc tương đối '+30m', '+2h', '+1d'.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    value = str(value).strip()
+    match = RELATIVE_RE.fullmatch(value)
+    if match:
+        return (now or time.time()) + float(match.group(1)) * UNIT_SECONDS[match.group(2)]
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+class ReleaseWindow:
+    """Throttle của một đợt gửi: tối đa per_minute tin nhắn/phút, chỉ trong khung giờ start-end mỗi ngày
+
+    Khung giờ có thể qua nửa đêm ('22:00-06:00'); start == end hoặc None: cả ngày.
+    """
+    def __init__(self, name, per_minute=0, start=None, end=None):
+        self.name = name
+        self.per_minute = int(per_minute or 0)
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def parse(cls, spec):
+        """'promo=60@22:00-06:00', 'promo=60' hoặc 'promo@22:00-06:00'"""
+        head, _, window = spec.partition('@')
+        name, _, per_minute = head.partition('=')
+        start = end = None
+        if window:
+            if not WINDOW_RE.fullmatch(window):
+                raise ValueError(f"Khung giờ không hợp lệ: {window} (dạng HH:MM-HH:MM)")
+            start, end = window.split('-')
+        if not name:
+            raise ValueError(f"Thiếu tên throttle: {spec}")
+        return cls(name.strip(), int(per_minute or 0), start, end)
+
+    @staticmethod
+    def _minutes(value):
+        hour, minute = value.split(':')
+        return int(hour) * 60 + int(minute)
+
+    def next_open(self, now):
+        """now nếu đang trong khung giờ, ngược lại thời điểm khung giờ mở tiếp theo"""
+        if not self.start or not self.end or self.start == self.end:
+            return now
+        dt = datetime.fromtimestamp(now)
+        current = dt.hour * 60 + dt.minute
+        start, end = self._minutes(self.start), self._minutes(self.end)
+        if (start <= current < end) if start < end else (current >= start or current < end):
+            return now
+        opens = dt.replace(hour=start // 60, minute=start % 60, second=0, microsecond=0)
+        if opens <= dt:
+            opens += timedelta(days=1)
+        return opens.timestamp()
+
+    def __repr__(self):
+        window = f"@{self.start}-{self.end}" if self.start else ''
+        return f"ReleaseWindow({self.name}={self.per_minute}{window})"
+
+
+class SendScheduler:
+    """Tin nhắn hẹn giờ trong SQLite (index theo thời điểm gửi), chuyển sang file queue khi đến hạn
+
+    Thread nhả ngủ tới đúng lịch sớm nhất (hoặc khi process này thêm lịch mới) thay vì quét
+    định kỳ. Mỗi lần nhả là một transaction BEGIN IMMEDIATE nên nhiều process có thể cùng chạy
+    mà không gửi trùng. Tin nhắn gắn throttle chỉ được nhả trong khung giờ và tối đa
+    per_minute tin/phút của throttle đó (bộ đếm lưu trong database, dùng chung giữa process).
+    """
+    def __init__(self, path, file_queue=None, on_release=None, recheck=RECHECK):
+        self.path = path
+        self.file_queue = file_queue
+        self.on_release = on_release    # gọi sau mỗi lần nhả (đánh thức thread gửi)
+        self.recheck = recheck
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'scheduled': 0, 'released': 0}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def add(self, phone_number, message, send_at, throttle=None):
+        """Hẹn giờ một tin nhắn, trả về thời điểm gửi (epoch)"""
+        return self.add_many([(phone_number, message)], send_at, throttle)
+
+    def add_many(self, items, send_at, throttle=None):
+        """Hẹn giờ nhiều (phone_number, message) cùng thời điểm trong một transaction"""
+        due = parse_send_at(send_at) or time.time()
+        now = time.time()
+        rows = [(due, phone, message, throttle, now) for phone, message, *_ in items]
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('BEGIN')
+                conn.executemany('INSERT INTO scheduled (due, phone, message, throttle, created) '
+                                 'VALUES (?, ?, ?, ?, ?)', rows)
+        finally:
+            conn.close()
+        self.stats['scheduled'] += len(rows)
+        log.debug("Đã hẹn giờ tin nhắn", extra=fields(count=len(rows), due=datetime.fromtimestamp(due).isoformat(),
+                                                       throttle=throttle))
+        # Lịch mới có thể sớm hơn lần thức hiện tại
+        self._wakeup.set()
+        return due
+
+    def set_throttle(self, window):
+        """Lưu (hoặc đổi) throttle, áp dụng cho mọi tin nhắn hẹn giờ cùng tên"""
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO throttles (name, per_minute, window_start, window_end) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(name) DO UPDATE SET per_minute = excluded.per_minute, '
+                         'window_start = excluded.window_start, window_end = excluded.window_end',
+                         (window.name, window.per_minute, window.start, window.end))
+        finally:
+            conn.close()
+        self._wakeup.set()
+
+    def use_throttle(self, spec):
+        """'promo=60@22:00-06:00' (lưu throttle) hoặc chỉ tên 'promo' (throttle đã lưu), trả về tên"""
+        window = ReleaseWindow.parse(spec)
+        if window.per_minute or window.start:
+            self.set_throttle(window)
+        return window.name
+
+    def release_due(self, now=None):
+        """Chuyển tin nhắn đến hạn sang file queue, trả về (số tin đã nhả, thời điểm cần thức tiếp theo)"""
+        now = now or time.time()
+        minute = int(now // 60)
+        wake = []
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            windows = {}
+            for name, per_minute, start, end, counted_minute, released in conn.execute('SELECT * FROM throttles'):
+                windows[name] = (ReleaseWindow(name, per_minute, start, end),
+                                 released if counted_minute == minute else 0)
+
+            rows = conn.execute('SELECT id, phone, message FROM scheduled WHERE throttle IS NULL AND due <= ? '
+                                'ORDER BY due, id LIMIT ?', (now, RELEASE_BATCH)).fetchall()
+            if len(rows) == RELEASE_BATCH:
+                wake.append(now)
+            throttled = [name for name, in conn.execute(
+                'SELECT DISTINCT throttle FROM scheduled WHERE throttle IS NOT NULL AND due <= ?', (now,))]
+            for name in throttled:
+                # Throttle chưa được khai báo: không giới hạn
+                window, used = windows.get(name, (ReleaseWindow(name), 0))
+                opens = window.next_open(now)
+                if opens > now:
+                    wake.append(opens)
+                    continue
+                limit = min(RELEASE_BATCH, window.per_minute - used) if window.per_minute else RELEASE_BATCH
+                batch = conn.execute('SELECT id, phone, message FROM scheduled WHERE throttle = ? AND due <= ? '
+                                     'ORDER BY due, id LIMIT ?', (name, now, max(0, limit))).fetchall()
+                rows.extend(batch)
+                if window.per_minute:
+                    conn.execute('UPDATE throttles SET minute = ?, released = ? WHERE name = ?',
+                                 (minute, used + len(batch), name))
+                if len(batch) == limit:
+                    # Hết lượt trong phút này (hoặc còn lô tiếp theo)
+                    wake.append((minute + 1) * 60 if window.per_minute and used + len(batch) >= window.per_minute
+                                else now)
+
+            if rows:
+                if self.file_queue is None:
+                    raise RuntimeError('SendScheduler chưa có file_queue để nhả tin nhắn')
+                self.file_queue.append_many((OutboundJob(phone, message).to_line(), phone)
+                                            for _, phone, message in rows)
+                conn.executemany('DELETE FROM scheduled WHERE id = ?', ((row[0],) for row in rows))
+            next_due, = conn.execute('SELECT MIN(due) FROM scheduled WHERE due > ?', (now,)).fetchone()
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        if next_due is not None:
+            wake.append(next_due)
+        if rows:
+            self.stats['released'] += len(rows)
+            log.info("Đã chuyển tin nhắn hẹn giờ sang queue", extra=fields(count=len(rows)))
+        return len(rows), min(wake) if wake else None
+
+    def start(self):
+        """Khởi động thread nhả tin nhắn đến hạn"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                released, wake = self.release_due()
+                if released and self.on_release:
+                    self.on_release()
+            except Exception as e:
+                log.error("Lỗi nhả tin nhắn hẹn giờ: %s", e, extra=fields(path=self.path))
+                wake = time.time() + 5
+            timeout = self.recheck if wake is None else min(max(0.0, wake - time.time()), self.recheck)
+            self._wakeup.wait(timeout)
+
+    def pending(self):
+        """Số tin nhắn hẹn giờ chưa đến hạn/chưa được nhả và thời điểm gửi sớm nhất"""
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT COUNT(*), MIN(due) FROM scheduled').fetchone()
+        finally:
+            conn.close()
+
+    def status(self):
+        """Số tin nhắn chờ theo throttle và các throttle đã khai báo"""
+        conn = self._connect()
+        try:
+            count, next_due = conn.execute('SELECT COUNT(*), MIN(due) FROM scheduled').fetchone()
+            by_throttle = dict(conn.execute('SELECT COALESCE(throttle, \'\'), COUNT(*) FROM scheduled '
+                                            'GROUP BY throttle'))
+            throttles = [ReleaseWindow(name, per_minute, start, end) for name, per_minute, start, end in
+                         conn.execute('SELECT name, per_minute, window_start, window_end FROM throttles')]
+        finally:
+            conn.close()
+        return {'pending': count, 'next_due': next_due, 'by_throttle': by_throttle, 'throttles': throttles}
+
+
+def open_scheduler(queue_file='/tmp/sms_queue.txt', queue_dir=None, on_release=None):
+    """SendScheduler của queue (file queue tự phát hiện số shard khi nhả)"""
+    return SendScheduler(schedule_path(queue_file, queue_dir), ShardedFileQueue(queue_file, None, queue_dir=queue_dir),
+                         on_release)
@@ -0,0 +1,70 @@
+import json
+import socketserver
+from sms_client import validate_phone
+from sms_handler import CLUSTER_QUEUE, QUEUE_DIR, SimpleSMSHandler
+from sms_records import EnqueueResult
+from sms_logging import fields, get_logger, setup_logging
+
+log = get_logger('server')
+
+
+class SMSRequestHandler(socketserver.StreamRequestHandler):
+    """Mỗi kết nối: một dòng JSON từ SMSClient, trả về một dòng JSON"""
+    def handle(self):
+        try:
+            line = self.rfile.readline(64 * 1024)
+            response = self.server.dispatch(json.loads(line.decode('utf-8')), self.client_address[0])
+        except (ValueError, UnicodeDecodeError, TypeError, AttributeError) as e:
+            response = {'status': EnqueueResult.ERROR, 'message': f'Dữ liệu không hợp lệ: {e}'}
+        self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+
+
+class SMSServer(socketserver.ThreadingTCPServer):
+    """Nhận yêu cầu gửi tin nhắn qua socket (SMSClient) và thêm vào queue (file hoặc SMS_CLUSTER_QUEUE)"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='0.0.0.0', port=8888, handler=None):
+        self.handler = handler or SimpleSMSHandler(queue_dir=QUEUE_DIR, cluster_queue=CLUSTER_QUEUE)
+        super().__init__((host, port), SMSRequestHandler)
+
+    def dispatch(self, data, client_address=None):
+        if not isinstance(data, dict):
+            return {'status': EnqueueResult.ERROR, 'message': 'Dữ liệu không hợp lệ: cần một object JSON'}
+        if data.get('action') != 'send_sms':
+            return {'status': EnqueueResult.ERROR, 'message': f"Action không hỗ trợ: {data.get('action')}"}
+        # Các trường chuỗi: phone/message bắt buộc, còn lại có thể bỏ trống (send_at còn nhận epoch)
+        for name in ('phone', 'message', 'idempotency_key', 'producer', 'throttle', 'send_at'):
+            value = data.get(name)
+            if value is not None and not isinstance(value, str) and not (
+                    name == 'send_at' and isinstance(value, (int, float)) and not isinstance(value, bool)):
+                return {'status': EnqueueResult.ERROR, 'message': f'Dữ liệu không hợp lệ: {name} phải là chuỗi'}
+        phone, message = data.get('phone'), data.get('message')
+        if not validate_phone(phone):
+            return {'status': EnqueueResult.ERROR, 'message': f'Số điện thoại không hợp lệ: {phone}'}
+        if not message or not message.strip():
+            return {'status': EnqueueResult.ERROR, 'message': 'Tin nhắn không được để trống'}
+
+        # Producer không tự khai báo: tính quota theo địa chỉ client
+        producer = data.get('producer') or client_address
+        result = self.handler.add_to_queue(phone, message, data.get('idempotency_key'), producer,
+                                           data.get('send_at'), data.get('throttle'))
+        log.info("Yêu cầu gửi tin nhắn", extra=fields(phone=phone, status=result.status, producer=producer,
+                                                       key=data.get('idempotency_key'), send_at=data.get('send_at')))
+        return result.as_dict()
+
+
+# Sử dụng
+if __name__ == '__main__':
+    import sys
+
+    setup_logging()
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8888
+    server = SMSServer(port=port)
+    print(f"🚀 SMS Server đang nghe trên cổng {port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n⏹️ Đang dừng SMS Server...")
+    finally:
+        server.server_close()
@@ -0,0 +1,216 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+from sms_logging import fields, get_logger
+
+log = get_logger('store')
+
+DEFAULT_STORE_PATH = '/tmp/sms_inbox.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id          INTEGER PRIMARY KEY,
+    sender      TEXT    NOT NULL,
+    scts        INTEGER NOT NULL,   -- thời gian gửi (epoch giây)
+    received_at REAL    NOT NULL,   -- thời điểm lưu (epoch giây)
+    kind        TEXT    NOT NULL,
+    parts       INTEGER NOT NULL,
+    content     TEXT    NOT NULL,
+    modem       TEXT,               -- cổng modem nhận
+    iccid       TEXT,
+    imsi        TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_scts ON messages(sender, scts);
+CREATE INDEX IF NOT EXISTS idx_messages_scts ON messages(scts);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+# Cột thêm sau phiên bản đầu, bổ sung cho database cũ
+MIGRATIONS = {
+    'modem': 'ALTER TABLE messages ADD COLUMN modem TEXT',
+    'iccid': 'ALTER TABLE messages ADD COLUMN iccid TEXT',
+    'imsi': 'ALTER TABLE messages ADD COLUMN imsi TEXT'
+}
+
+
+def _to_epoch(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp())
+
+
+class SMSStore:
+    """Lưu tin nhắn đến vào SQLite (index theo sender/SCTS, FTS5 theo nội dung)"""
+    def __init__(self, path=DEFAULT_STORE_PATH, batch_size=500, flush_interval=0.5, retention_days=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self._queue = queue.Queue()
+        self._writer = None
+        self._stopped = threading.Event()
+        self.stats = {'inserted': 0, 'batches': 0, 'pruned': 0}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executescript(SCHEMA)
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+                for column, sql in MIGRATIONS.items():
+                    if column not in columns:
+                        conn.execute(sql)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def start(self):
+        """Khởi động thread ghi theo lô (group commit)"""
+        if self._writer is None:
+            self._stopped.clear()
+            self._writer = threading.Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+        return self
+
+    def stop(self):
+        """Ghi nốt các tin nhắn còn trong hàng đợi rồi dừng"""
+        if self._writer is not None:
+            self._stopped.set()
+            self._queue.put(None)
+            self._writer.join(timeout=10)
+            self._writer = None
+
+    def add(self, message):
+        """Sink cho SMSReassembler: đưa tin nhắn vào hàng đợi ghi"""
+        if self._writer is None:
+            self.start()
+        self._queue.put((message.sender, _to_epoch(message.time), time.time(),
+                         message.kind, message.parts, message.content, message.modem, message.iccid, message.imsi))
+
+    def _write_loop(self):
+        conn = self._connect()
+        last_prune = 0
+        try:
+            while True:
+                batch = []
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    item = ()
+                deadline = time.time() + self.flush_interval
+                while item is not None:
+                    if item:
+                        batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get(timeout=max(0, deadline - time.time()))
+                    except queue.Empty:
+                        break
+
+                if batch:
+                    try:
+                        with conn:
+                            conn.executemany(
+                                'INSERT INTO messages (sender, scts, received_at, kind, parts, content, modem, iccid, imsi) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                        self.stats['inserted'] += len(batch)
+                        self.stats['batches'] += 1
+                    except sqlite3.Error as e:
+                        log.error("Lỗi ghi tin nhắn vào store: %s", e, extra=fields(rows=len(batch)))
+
+                if self.retention_days and time.time() - last_prune > 3600:
+                    last_prune = time.time()
+                    try:
+                        self._prune(conn, self.retention_days)
+                    except sqlite3.Error as e:
+                        # Ví dụ database đang bị CLI query/prune khóa: thử lại sau một phút, thread ghi vẫn chạy
+                        log.error("Lỗi xóa tin nhắn cũ: %s", e, extra=fields(path=self.path))
+                        last_prune -= 3600 - 60
+
+                if item is None or (self._stopped.is_set() and self._queue.empty()):
+                    break
+        finally:
+            conn.close()
+
+    def query(self, sender=None, since=None, until=None, text=None, limit=100):
+        """Tìm tin nhắn theo sender, khoảng thời gian SCTS và/hoặc nội dung"""
+        sql = 'SELECT m.id, m.sender, m.scts, m.kind, m.parts, m.content, m.modem, m.iccid FROM messages m'
+        where, params = [], []
+        if text:
+            sql += ' JOIN messages_fts f ON f.rowid = m.id'
+            where.append('messages_fts MATCH ?')
+            # Tìm nguyên cụm từ, tránh lỗi cú pháp FTS với ký tự đặc biệt
+            params.append('"' + text.replace('"', '""') + '"')
+        if sender:
+            where.append('m.sender = ?')
+            params.append(sender)
+        if since is not None:
+            where.append('m.scts >= ?')
+            params.append(_to_epoch(since))
+        if until is not None:
+            where.append('m.scts < ?')
+            params.append(_to_epoch(until))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY m.scts DESC LIMIT ?'
+        params.append(limit)
+
+        conn = self._connect()
+        try:
+            return [{
+                'id': row[0],
+                'sender': row[1],
+                'time': datetime.fromtimestamp(row[2]),
+                'kind': row[3],
+                'parts': row[4],
+                'content': row[5],
+                'modem': row[6],
+                'iccid': row[7]
+            } for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+    def prune(self, retention_days):
+        """Xóa tin nhắn cũ hơn retention_days ngày"""
+        conn = self._connect()
+        try:
+            return self._prune(conn, retention_days)
+        finally:
+            conn.close()
+
+    def _prune(self, conn, retention_days, chunk=5000):
+        cutoff = int(time.time() - retention_days * 86400)
+        deleted = 0
+        while True:
+            # Xóa theo từng phần để không giữ khóa ghi quá lâu
+            with conn:
+                cursor = conn.execute(
+                    'DELETE FROM messages WHERE id IN '
+                    '(SELECT id FROM messages WHERE scts < ? ORDER BY scts LIMIT ?)', (cutoff, chunk))
+            deleted += cursor.rowcount
+            if cursor.rowcount < chunk:
+                break
+        self.stats['pruned'] += deleted
+        return deleted
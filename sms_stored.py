@@ -0,0 +1,206 @@
+import os
+import time
+import random
+from collections import OrderedDict
+from pdu_encoder import LRUCache
+from sms_logging import fields, get_logger
+
+log = get_logger('stored')
+
+# Gửi nội dung lặp lại từ bộ nhớ modem: AT+CMGW một lần, AT+CMSS cho từng người nhận
+STORED_SEND = os.environ.get('SMS_STORED_SEND', '0') == '1'
+# Số nội dung giữ trong bộ nhớ modem cùng lúc (mỗi segment chiếm một ô)
+MAX_TEMPLATES = int(os.environ.get('SMS_STORED_TEMPLATES', '4'))
+# AT+CMGW lỗi (bộ nhớ đầy, modem không hỗ trợ): gửi bằng AT+CMGS trong chừng này giây
+DISABLE_SECONDS = 600
+WRITE_TIMEOUT = 10
+SEND_TIMEOUT = 60
+# +CMS ERROR: 321 - ô nhớ không hợp lệ (modem đã xóa/khởi động lại)
+CMS_INVALID_INDEX = 321
+
+
+class StoredTemplate:
+    """Một nội dung đã ghi vào bộ nhớ modem: chỉ số ô của từng segment theo thứ tự"""
+    __slots__ = ('message', 'indexes', 'ref', 'sent')
+
+    def __init__(self, message, indexes, ref):
+        self.message = message
+        self.indexes = indexes
+        self.ref = ref      # ref UDH chung cho mọi người nhận của đợt gửi
+        self.sent = 0
+
+
+class StoredSender:
+    """Gửi nội dung lặp lại (broadcast) từ bộ nhớ modem thay vì đẩy cả PDU qua UART mỗi lần
+
+    Nội dung gặp lần thứ hai trong các tin gửi gần đây được ghi vào bộ nhớ modem bằng
+    AT+CMGW (mỗi segment một ô, kể cả multipart), các lần sau chỉ gửi AT+CMSS=<ô>,"<số>",145
+    (~30 byte thay vì ~450 byte một segment). Tối đa max_templates nội dung, nội dung cũ nhất
+    bị xóa (AT+CMGD) khi cần chỗ và mọi ô được xóa khi queue rỗng. Ghi lỗi thì tạm quay về
+    AT+CMGS; ô không còn hợp lệ (+CMS ERROR: 321) thì ghi lại ở lần thử tiếp theo.
+    """
+    def __init__(self, handler, max_templates=MAX_TEMPLATES, seen_size=256):
+        self.handler = handler
+        self.max_templates = max_templates
+        self.templates = OrderedDict()      # message -> StoredTemplate, cũ nhất ở đầu
+        self.seen = LRUCache(seen_size)     # nội dung đã gửi bằng AT+CMGS gần đây
+        self.disabled_until = 0.0
+        self.stats = {'written': 0, 'stored_sends': 0, 'deleted': 0, 'write_errors': 0}
+
+    def send(self, phone_number, message):
+        """Gửi từ bộ nhớ modem: True/False, None nếu nên gửi bằng AT+CMGS"""
+        template = self.templates.get(message)
+        if template is None:
+            if self.seen.get(message) is None:
+                self.seen.put(message, True)
+                return None
+            if time.time() < self.disabled_until:
+                return None
+            template = self._write(phone_number, message)
+            if template is None:
+                return None
+        self.templates.move_to_end(message)
+        return self._send(template, phone_number)
+
+    def _write(self, phone_number, message):
+        """Ghi các segment vào bộ nhớ modem, trả về StoredTemplate hoặc None nếu lỗi"""
+        while len(self.templates) >= max(1, self.max_templates):
+            self._delete(self.templates.popitem(last=False)[1])
+        ref = random.randint(0, 255)
+        indexes = []
+        for pdu, length in self.handler.pdu_encoder.build_pdus(phone_number, message, ref):
+            # stat 2: STO UNSENT
+            command = self.handler.arbiter.execute(f'AT+CMGW={length},2', prefixes=('+CMGW:',),
+                                                   data=(pdu + "\x1a").encode(), timeout=WRITE_TIMEOUT)
+            index = None
+            if command.ok and command.lines:
+                _, _, value = command.lines[0].partition(':')
+                index = int(value.strip()) if value.strip().isdigit() else None
+            if index is None:
+                self.stats['write_errors'] += 1
+                self.disabled_until = time.time() + DISABLE_SECONDS
+                log.warning("Không ghi được tin nhắn vào bộ nhớ modem, gửi bằng AT+CMGS", extra=fields(
+                    modem=self.handler.port, error=command.result or command.error))
+                self._delete(StoredTemplate(message, indexes, ref))
+                return None
+            indexes.append(index)
+        template = self.templates[message] = StoredTemplate(message, indexes, ref)
+        self.stats['written'] += 1
+        log.info("Đã ghi tin nhắn vào bộ nhớ modem", extra=fields(
+            modem=self.handler.port, indexes=indexes, ref=ref, chars=len(message)))
+        return template
+
+    def _send(self, template, phone_number):
+        handler = self.handler
+        start = time.perf_counter()
+        handler.pacer.wait()
+        number = phone_number.lstrip('+').replace(' ', '')
+        for part_num, index in enumerate(template.indexes, 1):
+            if part_num > 1:
+                handler.pacer.wait()
+            error, code = self._send_segment(index, number)
+            if error:
+                log.warning("Modem từ chối gửi từ bộ nhớ", extra=fields(
+                    modem=handler.port, phone=phone_number, index=index,
+                    segment=f"{part_num}/{len(template.indexes)}", error=error))
+                if code == CMS_INVALID_INDEX:
+                    # Ô đã mất: lần thử lại ghi nội dung vào ô mới
+                    self.templates.pop(template.message, None)
+                return False
+        template.sent += 1
+        self.stats['stored_sends'] += 1
+        log.info("Đã gửi tin nhắn", extra=fields(
+            modem=handler.port, phone=phone_number, ref=template.ref, parts=len(template.indexes), stored=True,
+            latency_ms=round((time.perf_counter() - start) * 1000)))
+        return True
+
+    def _send_segment(self, index, number):
+        """AT+CMSS một ô, trả về (lỗi, mã +CMS ERROR), (None, None) nếu thành công"""
+        from sms_handler import cms_error_code
+
+        pacer = self.handler.pacer
+        command = self.handler.arbiter.execute(f'AT+CMSS={index},"{number}",145', prefixes=('+CMSS:',),
+                                               timeout=SEND_TIMEOUT)
+        if command.written_at is None or command.result is None:
+            if command.written_at is not None:
+                pacer.sent(command.written_at)
+                pacer.record(time.time() - command.written_at, timeout=True)
+            return command.error or 'không có +CMSS', None
+        pacer.sent(command.written_at)
+        latency = command.finished_at - command.written_at
+        if command.ok:
+            pacer.record(latency)
+            return None, None
+        code = cms_error_code(command.result)
+        pacer.record(latency, error_code=code)
+        return command.result, code
+
+    def _delete(self, template):
+        for index in template.indexes:
+            command = self.handler.arbiter.execute(f'AT+CMGD={index}')
+            if command.ok:
+                self.stats['deleted'] += 1
+            else:
+                log.warning("Không xóa được ô nhớ modem", extra=fields(
+                    modem=self.handler.port, index=index, error=command.result or command.error))
+
+    def flush(self):
+        """Xóa mọi nội dung đã ghi (queue rỗng: đợt broadcast đã xong)"""
+        while self.templates:
+            _, template = self.templates.popitem(last=False)
+            self._delete(template)
+            log.debug("Đã xóa tin nhắn khỏi bộ nhớ modem", extra=fields(
+                modem=self.handler.port, indexes=template.indexes, sent=template.sent))
+
+
+def bench(recipients=200, length=200):
+    """So sánh byte serial và thời gian mỗi người nhận giữa AT+CMGS và AT+CMSS trên LoopbackSerial"""
+    import threading
+    from sms_handler import SimpleSMSHandler
+    from sms_loopback import LoopbackSerial
+    from sms_pacing import SendPacer
+
+    text = ('Thông báo bảo trì hệ thống từ 22h đến 23h. ' * (length // 44 + 1))[:length]
+    phones = [f'849{i:09d}' for i in range(recipients)]
+    results = {}
+    for label, stored in (('AT+CMGS', False), ('AT+CMSS', True)):
+        handler = SimpleSMSHandler('loopback', transport=LoopbackSerial.transport(echo=False), timeout=0.2,
+                                   pacer=SendPacer('loopback', min_gap=1e-6, initial_gap=1e-6, max_per_minute=0,
+                                                   max_per_hour=0), stored_send=stored)
+        if not handler.connect():
+            print("❌ Không kết nối được LoopbackSerial")
+            return None
+        handler.is_listening = True
+        reader = threading.Thread(target=handler._read_loop, args=(lambda pdu_line: None,), daemon=True)
+        reader.start()
+        # Lần đầu gặp nội dung luôn gửi bằng AT+CMGS: không tính vào phần đo
+        handler._send_pdu_sms(phones[0], text)
+        tx_bytes = handler.ser.stats['tx_bytes']
+        start = time.perf_counter()
+        sent = sum(handler._send_pdu_sms(phone, text) for phone in phones[1:])
+        elapsed = time.perf_counter() - start
+        tx_bytes = handler.ser.stats['tx_bytes'] - tx_bytes
+        if handler.stored:
+            handler.stored.flush()
+        handler.is_listening = False
+        handler.arbiter.stop()
+        reader.join(timeout=2)
+        handler.disconnect()
+        count = max(1, len(phones) - 1)
+        results[label] = (tx_bytes / count, elapsed / count)
+        print(f"📤 {label}: {sent}/{len(phones) - 1} người nhận, {tx_bytes / count:,.0f} byte serial/người "
+              f"({tx_bytes * 10 / 115200 / count * 1000:.1f} ms ở 115200 baud), "
+              f"{elapsed / count * 1000:.2f} ms/người trên loopback")
+    cmgs, cmss = results['AT+CMGS'], results['AT+CMSS']
+    print(f"\nÍt hơn x{cmgs[0] / cmss[0]:.1f} byte serial mỗi người nhận")
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 200, int(sys.argv[3]) if len(sys.argv) > 3 else 200)
+    else:
+        print("Sử dụng:")
+        print("  python sms_stored.py bench [số_người_nhận] [độ_dài]  # So sánh AT+CMGS và AT+CMSS trên LoopbackSerial")
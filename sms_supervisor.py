@@ -0,0 +1,249 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing as mp
+from sms_handler import SimpleSMSHandler
+from sms_health import HealthSampler
+from sms_inbound import SMSReassembler, decode_pdu
+from sms_store import DEFAULT_STORE_PATH, SMSStore
+from sms_webhook import WebhookForwarder
+from sms_logging import fields, get_logger, setup_logging
+
+log = get_logger('supervisor')
+
+# Kiến trúc đa tiến trình:
+#   serial-owner (1 process/modem) --raw PDU--> decoder (N process) --> reassembly + sink (1 process)
+#   tin nhắn gửi đi: mỗi serial-owner xử lý shard queue của mình và steal từ shard dài nhất khi rảnh
+
+
+def _serial_owner_main(port, shard_index, shard_count, queue_file, queue_dir, raw_queue, status_queue, stop_event,
+                       cluster_queue=None):
+    """Process sở hữu cổng serial: đọc PDU và gửi tin nhắn từ shard của mình"""
+    setup_logging()
+    handler = SimpleSMSHandler(port, queue_file=queue_file, queue_shards=shard_count, shard_index=shard_index,
+                               queue_dir=queue_dir, cluster_queue=cluster_queue)
+    if not handler.connect():
+        status_queue.put(('down', port))
+        return
+
+    handler.is_listening = True
+    handler.file_queue.start_compactor()
+    # Mỗi owner nhả lịch hẹn giờ (transaction SQLite, không nhả trùng) và đánh thức thread gửi của mình
+    handler.scheduler.start()
+    sampler = HealthSampler([handler]).start()
+    status_queue.put(('up', port))
+
+    def stop_watcher():
+        stop_event.wait()
+        handler.is_listening = False
+
+    threading.Thread(target=handler._process_file_queue, daemon=True).start()
+    threading.Thread(target=stop_watcher, daemon=True).start()
+
+    try:
+        handler._read_loop(lambda pdu_line: raw_queue.put((port, pdu_line, time.time())))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handler.is_listening = False
+        sampler.stop()
+        handler.scheduler.stop()
+        # Queue dùng chung: trả lại lô đang giữ cho gateway khác
+        handler.file_queue.close()
+        handler.disconnect()
+        status_queue.put(('down', port))
+
+
+def _decoder_main(raw_queue, decoded_queue):
+    """Process giải mã PDU"""
+    setup_logging()
+    while True:
+        try:
+            item = raw_queue.get()
+        except KeyboardInterrupt:
+            continue
+        if item is None:
+            break
+        port, pdu_line, received_at = item
+        try:
+            sender, scts, content, multipart_info = decode_pdu(pdu_line)
+            decoded_queue.put((port, sender, scts, content, multipart_info, received_at))
+        except Exception as e:
+            log.error("Lỗi phân tích PDU: %s", e, extra=fields(modem=port, pdu=pdu_line))
+
+
+def _reassembly_main(decoded_queue, queue_file=None, queue_dir=None, autoreply_rules=None, cluster_queue=None,
+                     reassembly_checkpoint=None, store_path=None, store_retention_days=None, webhook_url=None):
+    """Process ghép tin nhắn và xuất ra sink (log, SQLite, webhook, trả lời tự động)"""
+    setup_logging()
+    reassembler = SMSReassembler(checkpoint_path=reassembly_checkpoint)
+    store = None
+    if store_path:
+        store = SMSStore(store_path, retention_days=store_retention_days)
+        reassembler.add_sink(store.add)
+    webhook = None
+    if webhook_url:
+        webhook = WebhookForwarder(webhook_url)
+        reassembler.add_sink(webhook.add)
+    if autoreply_rules:
+        # Tin trả lời vào queue chung, serial-owner gửi như tin nhắn thường
+        from sms_autoreply import AutoReplyEngine
+        enqueuer = SimpleSMSHandler(queue_file=queue_file, queue_shards=None, queue_dir=queue_dir,
+                                    cluster_queue=cluster_queue)
+        reassembler.add_sink(AutoReplyEngine(autoreply_rules, enqueuer.add_to_queue).add)
+    last_check = time.time()
+    while True:
+        try:
+            item = decoded_queue.get(timeout=1)
+        except queue.Empty:
+            item = ()
+        except KeyboardInterrupt:
+            continue
+        if item is None:
+            break
+        # Lỗi ở một tin nhắn không được làm dừng process (không có gì khởi động lại nó)
+        if item:
+            port, sender, scts, content, multipart_info, received_at = item
+            try:
+                reassembler.add(sender, scts, content, multipart_info, received_at, modem=port)
+            except Exception as e:
+                log.error("Lỗi ghép tin nhắn: %s", e, extra=fields(modem=port, sender=sender))
+
+        now = time.time()
+        if now - last_check >= 1:
+            try:
+                reassembler.check_pending(now)
+            except Exception as e:
+                log.error("Lỗi kiểm tra tin nhắn chờ: %s", e)
+            last_check = now
+    if not reassembler.close():
+        reassembler.check_pending(float('inf'))
+    if store:
+        store.stop()
+    if webhook:
+        webhook.stop()
+
+
+class SMSSupervisor:
+    """Khởi động và giám sát các process cho nhiều modem trên cùng một máy"""
+    def __init__(self, ports, queue_file='/tmp/sms_queue.txt', decoder_workers=None, queue_dir=None,
+                 autoreply_rules=None, cluster_queue=None, reassembly_checkpoint=None, store_path=None,
+                 store_retention_days=None, webhook_url=None):
+        self.ports = list(ports)
+        self.queue_file = queue_file
+        self.queue_dir = queue_dir
+        self.autoreply_rules = autoreply_rules
+        self.cluster_queue = cluster_queue
+        self.reassembly_checkpoint = reassembly_checkpoint
+        self.store_path = store_path
+        self.store_retention_days = store_retention_days
+        self.webhook_url = webhook_url
+        self.decoder_workers = decoder_workers or max(1, min(len(self.ports), (os.cpu_count() or 2) - 1))
+        self.raw_queue = mp.Queue()
+        self.decoded_queue = mp.Queue()
+        self.status_queue = mp.Queue()
+        self.stop_event = mp.Event()
+        self.owners = {}
+        self.decoders = []
+        self.reassembly = None
+        self.alive_ports = set()
+        self.is_running = False
+
+    def start(self):
+        """Khởi động tất cả process"""
+        self.reassembly = mp.Process(target=_reassembly_main,
+                                     args=(self.decoded_queue, self.queue_file, self.queue_dir, self.autoreply_rules,
+                                           self.cluster_queue, self.reassembly_checkpoint, self.store_path,
+                                           self.store_retention_days, self.webhook_url),
+                                     name='sms-reassembly', daemon=True)
+        self.reassembly.start()
+
+        for i in range(self.decoder_workers):
+            worker = mp.Process(target=_decoder_main, args=(self.raw_queue, self.decoded_queue),
+                                name=f'sms-decoder-{i}', daemon=True)
+            worker.start()
+            self.decoders.append(worker)
+
+        for port in self.ports:
+            self._start_owner(port)
+
+        self.is_running = True
+        log.info("Đã khởi động supervisor", extra=fields(owners=len(self.ports), decoders=self.decoder_workers))
+
+    def _start_owner(self, port):
+        owner = mp.Process(target=_serial_owner_main,
+                           args=(port, self.ports.index(port), len(self.ports), self.queue_file, self.queue_dir,
+                                 self.raw_queue, self.status_queue, self.stop_event, self.cluster_queue),
+                           name=f'sms-serial-{os.path.basename(port)}', daemon=True)
+        owner.start()
+        self.owners[port] = owner
+
+    def run(self):
+        """Vòng lặp chính: theo dõi trạng thái và khởi động lại serial-owner bị dừng"""
+        while self.is_running:
+            try:
+                self._drain_status()
+                self._restart_dead_owners()
+                time.sleep(1)
+            except Exception as e:
+                log.error("Lỗi supervisor: %s", e)
+                time.sleep(5)
+
+    def _drain_status(self):
+        while True:
+            try:
+                status, port = self.status_queue.get_nowait()
+            except queue.Empty:
+                return
+            if status == 'up':
+                self.alive_ports.add(port)
+            else:
+                self.alive_ports.discard(port)
+
+    def _restart_dead_owners(self):
+        for port, owner in list(self.owners.items()):
+            if not owner.is_alive() and not self.stop_event.is_set():
+                log.warning("Serial-owner đã dừng, khởi động lại", extra=fields(modem=port))
+                self.alive_ports.discard(port)
+                self._start_owner(port)
+                time.sleep(1)
+
+    def stop(self):
+        """Dừng tất cả process"""
+        self.is_running = False
+        self.stop_event.set()
+        for owner in self.owners.values():
+            owner.join(timeout=5)
+        for _ in self.decoders:
+            self.raw_queue.put(None)
+        for worker in self.decoders:
+            worker.join(timeout=5)
+        self.decoded_queue.put(None)
+        if self.reassembly:
+            self.reassembly.join(timeout=5)
+        log.info("Đã dừng supervisor")
+
+
+# Sử dụng
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) > 1:
+        setup_logging()
+        supervisor = SMSSupervisor(sys.argv[1:], queue_dir=os.environ.get('SMS_QUEUE_DIR'),
+                                   autoreply_rules=os.environ.get('SMS_AUTOREPLY_RULES'),
+                                   cluster_queue=os.environ.get('SMS_CLUSTER_QUEUE'),
+                                   reassembly_checkpoint=os.environ.get('SMS_REASSEMBLY_CHECKPOINT'),
+                                   store_path=DEFAULT_STORE_PATH, store_retention_days=90,
+                                   webhook_url=os.environ.get('SMS_WEBHOOK_URL'))
+        supervisor.start()
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            print("\n⏹️ Đang dừng supervisor...")
+        finally:
+            supervisor.stop()
+    else:
+        print("Sử dụng:")
+        print("  python sms_supervisor.py <cổng_1> [<cổng_2> ...]  # Mỗi modem một process")
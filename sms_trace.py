@@ -0,0 +1,368 @@
+import os
+import time
+import fcntl
+import select
+import struct
+import termios
+import threading
+from sms_logging import fields, get_logger
+
+log = get_logger('trace')
+
+# File trace: MAGIC rồi các bản ghi RECORD (thời điểm epoch, hướng, độ dài) + dữ liệu thô
+MAGIC = b'SMSTRC1\n'
+RECORD = struct.Struct('<dBH')
+RX, TX = 0, 1
+MAX_CHUNK = 0xFFFF
+
+
+def trace_path_for(trace_dir, port):
+    """File trace của một cổng trong thư mục trace (mỗi modem một file)"""
+    return os.path.join(trace_dir, os.path.basename(port.rstrip('/')) + '.trace')
+
+
+def read_trace(path):
+    """Đọc lần lượt (time, direction, data) từ file trace"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'Không phải file trace: {path}')
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            record_time, direction, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return  # bản ghi cuối ghi dở (process bị kill)
+            yield record_time, direction, data
+
+
+class TraceWriter:
+    """Ghi trace nối tiếp vào file, dùng chung cho luồng đọc và luồng gửi"""
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.lock = threading.Lock()
+
+    def write(self, direction, data):
+        now = time.time()
+        with self.lock:
+            for start in range(0, len(data), MAX_CHUNK):
+                chunk = data[start:start + MAX_CHUNK]
+                self.file.write(RECORD.pack(now, direction, len(chunk)))
+                self.file.write(chunk)
+            # Lưu lượng serial nhỏ: flush ngay để trace còn nguyên khi process chết
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingSerial:
+    """Bọc một cổng serial, ghi lại mọi byte đọc/ghi kèm thời điểm vào file trace"""
+    def __init__(self, ser, trace_path):
+        self.ser = ser
+        self.writer = TraceWriter(trace_path)
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.writer.write(RX, data)
+        return data
+
+    def readline(self):
+        data = self.ser.readline()
+        if data:
+            self.writer.write(RX, data)
+        return data
+
+    def write(self, data):
+        self.writer.write(TX, data)
+        return self.ser.write(data)
+
+    def close(self):
+        try:
+            self.ser.close()
+        finally:
+            self.writer.close()
+
+    def __getattr__(self, name):
+        # in_waiting, is_open, fileno, reset_input_buffer... của cổng thật
+        return getattr(self.ser, name)
+
+
+class PipeSerial:
+    """Cổng serial giả: dữ liệu nhận được đẩy qua một pipe nên dùng được với selectors như cổng thật"""
+    def __init__(self, port, timeout=None):
+        self.port = port
+        self.timeout = timeout
+        self._read_fd, self._write_fd = os.pipe()
+        self.is_open = True
+
+    def fileno(self):
+        return self._read_fd
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('I', fcntl.ioctl(self._read_fd, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def read(self, size=1):
+        data = b''
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while len(data) < size:
+            wait = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._read_fd], [], [], wait)
+            if not ready:
+                break
+            data += os.read(self._read_fd, size - len(data))
+        return data
+
+    def readline(self):
+        line = b''
+        while not line.endswith(b'\n'):
+            char = self.read(1)
+            if not char:
+                break
+            line += char
+        return line
+
+    def _deliver(self, data):
+        """Đưa dữ liệu vào phía đọc (chặn khi pipe đầy, như modem chờ host đọc)"""
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._write_fd, view):]
+
+    def _close_pipe(self):
+        os.close(self._write_fd)
+        os.close(self._read_fd)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self._close_pipe()
+
+
+class ReplaySerial(PipeSerial):
+    """Cổng serial giả phát lại phần nhận (RX) của một file trace
+
+    speed: 1 theo thời gian thực, 10 nhanh gấp 10, 0 nhanh nhất có thể.
+    sync_writes: dữ liệu nhận sau lần ghi thứ k trong trace chỉ được phát sau khi code
+    đang chạy ghi đủ k lần (trả lời AT/+CMGS đến đúng sau lệnh tương ứng); chờ quá
+    write_timeout giây thì phát luôn. max_idle: rút ngắn các khoảng lặng dài trong trace.
+    """
+    def __init__(self, trace_path, speed=1.0, sync_writes=True, write_timeout=10.0, max_idle=5.0, timeout=None):
+        super().__init__(trace_path, timeout)
+        self.trace_path = trace_path
+        self.speed = speed
+        self.sync_writes = sync_writes
+        self.write_timeout = write_timeout
+        self.max_idle = max_idle
+        self.finished = threading.Event()
+        self.stats = {'rx_bytes': 0, 'tx_writes': 0, 'tx_mismatches': 0, 'sync_timeouts': 0}
+        self._expected_tx = []
+        self._write_times = []
+        self._written = threading.Condition()
+        self._thread = threading.Thread(target=self._feed, args=(self._schedule(),), daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def transport(cls, trace, **kwargs):
+        """Hàm mở cổng cho SimpleSMSHandler(transport=...); trace là file hoặc thư mục trace_path_for"""
+        def open_port(port, baudrate=None, timeout=None):
+            path = trace_path_for(trace, port) if os.path.isdir(trace) else trace
+            return cls(path, timeout=timeout, **kwargs)
+        return open_port
+
+    def _schedule(self):
+        """(số lần ghi cần chờ, độ trễ tính từ lần ghi đó hoặc từ đầu trace, dữ liệu) cho mỗi RX"""
+        schedule = []
+        start = last = anchor_time = None
+        writes = 0
+        elapsed = 0.0
+        for record_time, direction, data in read_trace(self.trace_path):
+            if start is None:
+                start = last = anchor_time = record_time
+            # Khoảng lặng dài hơn max_idle (hoặc trace nối nhiều phiên) bị rút ngắn
+            gap = record_time - last
+            if self.max_idle is not None:
+                gap = min(gap, self.max_idle)
+            elapsed += max(0.0, gap)
+            last = record_time
+            if direction == TX:
+                writes += 1
+                self._expected_tx.append(data)
+                anchor_time = elapsed
+            elif self.sync_writes:
+                schedule.append((writes, elapsed - anchor_time, data))
+            else:
+                schedule.append((0, elapsed, data))
+        return schedule
+
+    def _feed(self, schedule):
+        start = time.monotonic()
+        try:
+            for writes, delay, data in schedule:
+                base = start
+                if writes:
+                    with self._written:
+                        if not self._written.wait_for(lambda: len(self._write_times) >= writes or not self.is_open,
+                                                      self.write_timeout):
+                            self.stats['sync_timeouts'] += 1
+                            log.debug("Code không ghi như trong trace, phát tiếp", extra=fields(
+                                trace=self.trace_path, expected_writes=writes, writes=len(self._write_times)))
+                        base = self._write_times[writes - 1] if len(self._write_times) >= writes else time.monotonic()
+                if not self.is_open:
+                    return
+                if self.speed:
+                    remaining = base + delay / self.speed - time.monotonic()
+                    if remaining > 0:
+                        time.sleep(remaining)
+                self._deliver(data)
+                self.stats['rx_bytes'] += len(data)
+        except OSError:
+            if self.is_open:
+                raise
+        finally:
+            self.finished.set()
+
+    @property
+    def drained(self):
+        """Đã phát hết trace và code đã đọc hết"""
+        return self.finished.is_set() and self.in_waiting == 0
+
+    def write(self, data):
+        with self._written:
+            index = len(self._write_times)
+            if index < len(self._expected_tx) and self._expected_tx[index] != bytes(data):
+                self.stats['tx_mismatches'] += 1
+            self._write_times.append(time.monotonic())
+            self.stats['tx_writes'] += 1
+            self._written.notify_all()
+        return len(data)
+
+    def reset_input_buffer(self):
+        # Trace chỉ chứa những gì code đã đọc, byte bị bỏ khi ghi trace không có trong đó
+        pass
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        with self._written:
+            self._written.notify_all()
+        self._thread.join(timeout=1)
+        self._close_pipe()
+
+
+# Hàm utility để xem, phát lại và benchmark trace
+def dump(path):
+    """In trace dạng text: thời điểm tương đối, hướng, dữ liệu"""
+    start = None
+    for record_time, direction, data in read_trace(path):
+        start = record_time if start is None else start
+        print(f"{record_time - start:10.3f} {'<<' if direction == RX else '>>'} {data!r}")
+
+
+def bench(path, repeat=5, profile=False):
+    """Giải mã + ghép tin nhắn từ RX của trace (không thread, không thời gian), in throughput"""
+    import tempfile
+    from sms_handler import SimpleSMSHandler
+
+    chunks = [data for _, direction, data in read_trace(path) if direction == RX]
+    total = sum(map(len, chunks))
+    with tempfile.TemporaryDirectory() as tmp:
+        best = None
+        for _ in range(repeat):
+            handler = SimpleSMSHandler('bench', queue_file=os.path.join(tmp, 'queue.txt'))
+            messages = []
+            handler.reassembler.sinks = [messages.append]
+            pdus = []
+
+            def on_pdu(line):
+                pdus.append(line)
+                handler._handle_pdu(line)
+
+            start = time.perf_counter()
+            for chunk in chunks:
+                handler.feed(chunk, on_pdu)
+            handler.reassembler.check_pending(float('inf'))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{len(chunks)} chunk, {total} byte, {len(pdus)} PDU -> {len(messages)} tin nhắn")
+        print(f"⏱️ {best * 1000:.1f} ms ({len(pdus) / best:.0f} PDU/s, {total / best / 1e6:.1f} MB/s), "
+              f"tốt nhất trong {repeat} lần")
+        if profile:
+            import cProfile
+            import pstats
+            handler = SimpleSMSHandler('bench', queue_file=os.path.join(tmp, 'queue.txt'))
+            handler.reassembler.sinks = []
+            profiler = cProfile.Profile()
+            profiler.enable()
+            for chunk in chunks:
+                handler.feed(chunk, handler._handle_pdu)
+            handler.reassembler.check_pending(float('inf'))
+            profiler.disable()
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+
+def replay(path, speed=1.0, write_timeout=1.0):
+    """Chạy connect + listen_sms của SimpleSMSHandler trên trace, in số tin nhắn nhận được
+
+    Queue rỗng nên lệnh gửi trong trace không được ghi lại: chỉ chờ write_timeout giây.
+    """
+    import tempfile
+    from sms_handler import SimpleSMSHandler
+
+    with tempfile.TemporaryDirectory() as tmp:
+        handler = SimpleSMSHandler('replay', timeout=0.5, queue_file=os.path.join(tmp, 'queue.txt'),
+                                   transport=ReplaySerial.transport(path, speed=speed, write_timeout=write_timeout))
+        messages = []
+        handler.reassembler.add_sink(messages.append)
+        start = time.perf_counter()
+        if not handler.connect():
+            print("❌ Trace không có phần kết nối modem (AT/ATE0/CMGF/CNMI)")
+            return
+        thread = threading.Thread(target=handler.listen_sms, daemon=True)
+        thread.start()
+        while not handler.ser.drained:
+            time.sleep(0.1)
+        handler.stop_listening()
+        handler.reassembler.check_pending(float('inf'))
+        thread.join(timeout=5)
+        elapsed = time.perf_counter() - start
+        stats = handler.ser.stats
+        handler.disconnect()
+    print(f"📼 {len(messages)} tin nhắn trong {elapsed:.2f}s (speed={speed}), "
+          f"RX {stats['rx_bytes']} byte, TX {stats['tx_writes']} lần ghi "
+          f"({stats['tx_mismatches']} khác trace, {stats['sync_timeouts']} lần chờ quá hạn)")
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) >= 3 and sys.argv[1] in ('dump', 'bench', 'replay'):
+        if sys.argv[1] == 'dump':
+            dump(sys.argv[2])
+        elif sys.argv[1] == 'bench':
+            bench(sys.argv[2], profile='--profile' in sys.argv[3:])
+        else:
+            replay(sys.argv[2], float(sys.argv[3]) if len(sys.argv) >= 4 else 1.0)
+    else:
+        print("Sử dụng:")
+        print("  python sms_trace.py dump <file.trace>           # In nội dung trace")
+        print("  python sms_trace.py bench <file.trace> [--profile]  # Benchmark giải mã/ghép tin nhắn")
+        print("  python sms_trace.py replay <file.trace> [speed]  # Phát lại qua listen_sms (0: nhanh nhất)")
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import queue
+import threading
+import http.client
+from urllib.parse import urlsplit
+from sms_logging import fields, get_logger
+
+log = get_logger('webhook')
+
+DEFAULT_SPILL_FILE = '/tmp/sms_webhook_spill.jsonl'
+
+
+class WebhookForwarder:
+    """Đẩy tin nhắn đến lên backend qua HTTP theo lô, không chặn luồng đọc serial"""
+    def __init__(self, url, batch_size=50, linger=1.0, max_queue=10000, spill_file=DEFAULT_SPILL_FILE,
+                 timeout=10, max_retries=3, headers=None):
+        parts = urlsplit(url)
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        self.batch_size = batch_size
+        self.linger = linger
+        self.spill_file = spill_file
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        self.headers.update(headers or {})
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._conn = None
+        self._thread = None
+        self._running = False
+        self._spill_lock = threading.Lock()
+        self.stats = {
+            'enqueued': 0, 'sent': 0, 'batches': 0, 'retries': 0, 'failed_posts': 0,
+            'spilled': 0, 'replayed': 0, 'last_latency_ms': 0.0
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """Gửi nốt hàng đợi (hoặc ghi ra đĩa) rồi dừng"""
+        if self._thread is not None:
+            self._running = False
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        # Phần còn lại chưa gửi được thì ghi ra đĩa để gửi lại lần sau
+        leftover = self._drain_nowait(self._queue.qsize())
+        if leftover:
+            self._spill(leftover)
+        self._close()
+
+    def add(self, message):
+        """Sink cho SMSReassembler: không bao giờ chặn, đầy hàng đợi thì ghi ra đĩa"""
+        record = {
+            'sender': message.sender,
+            'time': message.time.isoformat(),
+            'kind': message.kind,
+            'parts': message.parts,
+            'content': message.content
+        }
+        if message.modem:
+            record.update(modem=message.modem, iccid=message.iccid, imsi=message.imsi)
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+            self.stats['enqueued'] += 1
+        except queue.Full:
+            self._spill([record])
+
+    def metrics(self):
+        """Số liệu back-pressure và thông lượng"""
+        depth = self._queue.qsize()
+        metrics = dict(self.stats)
+        metrics.update({
+            'queue_depth': depth,
+            'queue_capacity': self._queue.maxsize,
+            'queue_fill': depth / self._queue.maxsize if self._queue.maxsize else 0.0,
+            'spill_bytes': os.path.getsize(self.spill_file) if os.path.exists(self.spill_file) else 0
+        })
+        return metrics
+
+    def _drain_nowait(self, limit):
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _next_batch(self):
+        try:
+            first = self._queue.get(timeout=self.linger)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.time() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        last_replay = 0
+        while self._running or not self._queue.empty():
+            batch = self._next_batch()
+            if batch:
+                if self._post_with_retry(batch):
+                    self.stats['sent'] += len(batch)
+                else:
+                    self._spill(batch)
+            elif not self._running:
+                break
+
+            # Endpoint đang ổn và hàng đợi rảnh: gửi lại phần đã ghi ra đĩa
+            if (self._queue.qsize() < self.batch_size and time.time() - last_replay > 30
+                    and os.path.exists(self.spill_file)):
+                last_replay = time.time()
+                try:
+                    self._replay_spill()
+                except Exception as e:
+                    # Lỗi gửi lại không được làm dừng thread (tin nhắn mới vẫn phải được đẩy đi)
+                    log.error("Lỗi gửi lại tin nhắn đã ghi ra đĩa: %s", e, extra=fields(spill=self.spill_file))
+
+    def _post_with_retry(self, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+                time.sleep(min(30, 0.5 * 2 ** attempt))
+                if not self._running and attempt > 1:
+                    break
+            try:
+                self._post(batch)
+                return True
+            except Exception as e:
+                self.stats['failed_posts'] += 1
+                log.warning("Lỗi gửi webhook: %s", e, extra=fields(batch=len(batch), attempt=attempt + 1))
+                self._close()
+        return False
+
+    def _post(self, batch):
+        if self._conn is None:
+            conn_class = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+            self._conn = conn_class(self.host, self.port, timeout=self.timeout)
+
+        body = json.dumps({'messages': batch}, ensure_ascii=False).encode('utf-8')
+        start = time.perf_counter()
+        self._conn.request('POST', self.path, body=body, headers=self.headers)
+        response = self._conn.getresponse()
+        response.read()  # đọc hết để tái sử dụng kết nối keep-alive
+        self.stats['last_latency_ms'] = (time.perf_counter() - start) * 1000
+        self.stats['batches'] += 1
+
+        if response.will_close:
+            self._close()
+        if not 200 <= response.status < 300:
+            raise RuntimeError(f"HTTP {response.status}")
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _spill(self, records, count=True):
+        with self._spill_lock:
+            with open(self.spill_file, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(r, ensure_ascii=False) + '\n' for r in records)
+        if count:
+            self.stats['spilled'] += len(records)
+
+    def _replay_spill(self):
+        replay_file = self.spill_file + '.replay'
+        with self._spill_lock:
+            if not os.path.exists(replay_file):
+                os.replace(self.spill_file, replay_file)
+
+        records, bad = [], []
+        with open(replay_file, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    bad.append(line if line.endswith('\n') else line + '\n')
+        if bad:
+            # Dòng ghi dở khi process bị dừng: chuyển sang file .bad để kiểm tra, không gửi lại
+            with open(self.spill_file + '.bad', 'a', encoding='utf-8') as f:
+                f.writelines(bad)
+            log.warning("Bỏ qua dòng hỏng trong file spill", extra=fields(lines=len(bad), spill=self.spill_file))
+
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            if not self._post_with_retry(batch):
+                self._spill(records[start:], count=False)
+                break
+            self.stats['replayed'] += len(batch)
+        os.remove(replay_file)
+
+
+# Hàm utility để test với HTTP server giả lập
+def run_stub_server(port=8099, fail_every=0):
+    """HTTP server giả lập backend (keep-alive), trả 503 mỗi fail_every request nếu > 0"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    counter = {'requests': 0, 'messages': 0}
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = 65536  # gửi header và body cùng lúc
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            counter['requests'] += 1
+            status = 503 if fail_every and counter['requests'] % fail_every == 0 else 200
+            if status == 200:
+                counter['messages'] += len(json.loads(body)['messages'])
+            self.send_response(status)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.counter = counter
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_forwarder(count=5000, port=8099):
+    """Đẩy count tin nhắn qua server giả lập và in số liệu"""
+    from datetime import datetime
+    from sms_records import AssembledMessage
+
+    server = run_stub_server(port, fail_every=7)
+    forwarder = WebhookForwarder(f'http://127.0.0.1:{port}/sms', linger=0.05,
+                                 spill_file='/tmp/sms_webhook_test_spill.jsonl').start()
+    start = time.perf_counter()
+    for i in range(count):
+        forwarder.add(AssembledMessage('single', f'+8490{i:07d}', datetime.now(), f'Tin nhắn {i}'))
+    while forwarder.stats['sent'] < count and time.perf_counter() - start < 60:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    forwarder.stop()
+    server.shutdown()
+
+    print(f"Đã gửi {forwarder.stats['sent']}/{count} tin trong {elapsed:.2f}s ({count / elapsed:,.0f} tin/giây)")
+    print(f"Server nhận: {server.counter}")
+    print(f"Metrics: {forwarder.metrics()}")
+
+
+if __name__ == '__main__':
+    test_forwarder()